@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 import os.path
+import sys
 from pathlib import Path
 
 # Build paths inside the core like this: BASE_DIR / 'subdir'.
@@ -37,12 +38,15 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'debug_toolbar',
     'captcha',
     'crm.apps.CrmConfig',
 ]
 
 MIDDLEWARE = [
+    'crm.assets.StaticFilesMiddleware',
+    'crm.metrics.MetricsMiddleware',
+    'crm.db_router.ReplicaRoutingMiddleware',
+    'crm.sharding.ShardRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -50,14 +54,24 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'crm.profiling.ProfilingMiddleware',
 ]
 
+
+# Serve the read-heavy views with their asynchronous versions, set by core/asgi.py
+ASYNC_VIEWS = os.environ.get('DJANGO_ASYNC_VIEWS') == '1'
+
+# The debug toolbar is only used in development; it does not support asynchronous views
+if DEBUG and not ASYNC_VIEWS:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.append('debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'core.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # The Django backend measuring the rendering time for crm.metrics.MetricsMiddleware
+        'BACKEND': 'crm.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -85,9 +99,49 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': 'localhost',
         'PORT': '',
+        # Connections are kept for the given number of seconds and checked before being reused
+        'CONN_MAX_AGE': int(os.environ.get('DJANGO_DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': os.environ.get('DJANGO_DB_CONN_HEALTH_CHECKS', '1') == '1',
     }
 }
 
+# Read replicas of the primary database, as a comma separated list of hosts. Their aliases are replica1,
+# replica2 and so on; test databases mirror the primary, so the tests run with a single server
+DATABASE_REPLICAS = []
+for number, host in enumerate(filter(None, os.environ.get('DJANGO_DB_REPLICA_HOSTS', '').split(',')), 1):
+    DATABASES['replica%d' % number] = dict(DATABASES['default'], HOST=host.strip(), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append('replica%d' % number)
+
+# Shards of the per-user data (ProdInfo units and their totals) as a comma separated list of hosts, see crm.sharding.
+# Their aliases are shard1, shard2 and so on; the default database is the first shard. Without hosts the data
+# is not sharded
+PRODINFO_SHARDS = []
+for number, host in enumerate(filter(None, os.environ.get('DJANGO_DB_SHARD_HOSTS', '').split(',')), 1):
+    DATABASES['shard%d' % number] = dict(DATABASES['default'], HOST=host.strip())
+    PRODINFO_SHARDS.append('shard%d' % number)
+if PRODINFO_SHARDS:
+    PRODINFO_SHARDS.insert(0, 'default')
+
+# The tests of the routing and the sharding use a replica and a shard alias; without configured ones,
+# under the test runner replica1 mirrors the default database and shard1 is a database of the default server.
+# Only the tests using an alias create its database
+if sys.argv[1:2] == ['test']:
+    if not DATABASE_REPLICAS:
+        DATABASES['replica1'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    if not PRODINFO_SHARDS:
+        DATABASES['shard1'] = dict(DATABASES['default'], TEST={'NAME': 'test_%s_shard1' % DATABASES['default']['NAME']})
+
+DATABASE_ROUTERS = ['crm.sharding.ShardRouter', 'crm.db_router.PrimaryReplicaRouter']
+
+# URL names of the read-only views whose GET requests read from the replicas
+DATABASE_REPLICA_VIEWS = [
+    'home', 'more_cards', 'more_cards_json', 'search_result', 'detail', 'ajax_load_objects', 'export_units', 'history',
+    'history_json', 'api_v1',
+]
+
+# Seconds the reads of a browser stay on the primary after it wrote, so the user sees their own changes
+DATABASE_PRIMARY_STICKY_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -127,9 +181,18 @@ STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 STATICFILES_DIRS = []
 
+# collectstatic stores the files under hashed names with gzip and Brotli variants,
+# crm.assets.StaticFilesMiddleware serves them; files without a hash in the name are cached for STATIC_MAX_AGE seconds
+STATICFILES_STORAGE = 'crm.assets.CompressedManifestStaticFilesStorage'
+STATIC_MAX_AGE = 60
+
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Widths of the resized variants of product photos and the number of threads generating them
+THUMBNAIL_WIDTHS = (240, 480, 960)
+THUMBNAIL_WORKERS = 2
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
@@ -140,11 +203,49 @@ INTERNAL_IPS = [
     "127.0.0.1",
 ]
 
+
+# Requests profiled with cProfile: staff requests with the X-Profile header or the _profile parameter,
+# and the given share of all requests, kept if they are slower than the threshold in seconds
+PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILING_SAMPLE_RATE = 0
+PROFILING_SLOW_THRESHOLD = 1.0
+PROFILING_MAX_FILES = 100
+
+# Captchas of the login and registration forms are taken from a pool refilled by the refill_captcha_pool command:
+# the number of available challenges it keeps and their lifetime in minutes
+CAPTCHA_POOL_SIZE = 500
+CAPTCHA_POOL_LIFETIME = 60
+
+# Addresses allowed to read the aggregated request metrics from /metrics
+METRICS_ALLOWED_IPS = [
+    "127.0.0.1",
+]
+
 CACHES = {
     'default': {
+        'BACKEND': 'crm.cache.TieredCache',
+        'LOCATION': 'shared',
+        'OPTIONS': {
+            'LOCAL_TIMEOUT': 5,
+            'LOCAL_MAX_ENTRIES': 1000,
+        },
+    },
+    'shared': {
         'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
         'LOCATION': os.path.join(BASE_DIR, 'storage_cache'),
-    }
+    },
 }
 
-EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
\ No newline at end of file
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+DEFAULT_FROM_EMAIL = 'admin@example.com'
+
+# Outbound emails are queued and sent by the send_queued_mail command: the number sent over one connection,
+# the number of attempts and the delay in seconds before the first retry, doubled for every next one
+MAIL_QUEUE_BATCH_SIZE = 100
+MAIL_QUEUE_MAX_ATTEMPTS = 5
+MAIL_QUEUE_RETRY_DELAY = 60
+# A unit is not full when its weight deviates from the reference weight of its product by more than the larger
+# of the absolute tolerance, in grams, and the relative one, a share of the reference weight.
+# The stored counters are not recounted when these change: run rebuild_inventory_summary afterwards
+NOT_FULL_ABS_TOLERANCE = 0.05
+NOT_FULL_REL_TOLERANCE = 0
@@ -35,7 +35,23 @@ class ProductAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('title',)}
 
 
+class InventorySummaryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'account', 'product', 'count', 'weight', 'not_full', 'cost')
+    list_display_links = ('id', 'product')
+    search_fields = ('account__username', 'product__title')
+    ordering = ('account', 'product')
+
+
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'refs', 'time_create')
+    list_display_links = ('id', 'name')
+    search_fields = ('name',)
+    ordering = ('id',)
+
+
 admin.site.register(ProdInfo, ProdInfoAdmin)
 admin.site.register(Company, CompanyAdmin)
 admin.site.register(Shop, ShopAdmin)
 admin.site.register(Product, ProductAdmin)
+admin.site.register(InventorySummary, InventorySummaryAdmin)
+admin.site.register(Blob, BlobAdmin)
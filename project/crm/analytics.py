@@ -0,0 +1,189 @@
+"""
+Vectorized statistics of the inventory of a user, computed with NumPy.
+
+The units of the requested products are loaded with one query into a structured array of 32 bytes per unit
+(id, product, weight and cost) and sorted by product, so every statistic is computed for all the products
+at once by NumPy operations over the groups, without a Python loop over the units. Hundreds of thousands
+of units take a few megabytes and are processed in milliseconds; loading them from the database dominates.
+
+Statistics of a product, see product_stats:
+
+    count, weight, cost
+        number of units, their total weight and cost
+    not_full
+        number of units deviating from ref_weight by more than the tolerance, see crm.models.is_not_full
+    fill_ratio
+        total weight divided by the weight of as many full units
+    percentiles
+        weight percentiles PERCENTILES, interpolated linearly like numpy.percentile
+    cost_per_gram
+        total cost divided by the total weight
+    outliers, outlier_ids
+        units whose price per gram lies outside the Tukey fences of the product,
+        [Q1 - OUTLIER_FACTOR * IQR, Q3 + OUTLIER_FACTOR * IQR]; units without a cost or a weight are left out
+"""
+
+import numpy as np
+
+from .models import ProdInfo, weight_tolerances
+
+"Weight percentiles of a product"
+PERCENTILES = (10, 50, 90)
+
+"Width of the Tukey fences in interquartile ranges"
+OUTLIER_FACTOR = 1.5
+
+"Minimum number of priced units of a product to look for outliers"
+MIN_OUTLIER_UNITS = 4
+
+UNIT_DTYPE = np.dtype([('pk', np.int64), ('product', np.int64), ('weight', np.float64), ('cost', np.float64)])
+
+
+def load_units(user, products, chunk_size=10000):
+    """
+    Function to load the units of the user for the given products into a structured array.
+
+    Parameters
+    ----------
+    user: User
+        Owner of the units
+    products: iterable
+        Product objects or ids
+    chunk_size: int, optional
+        Number of rows fetched from the database at once
+
+    Returns
+    ----------
+    units: ndarray
+        Array of UNIT_DTYPE
+    """
+
+    rows = (ProdInfo.objects.filter(account=user, title__in=products).order_by()
+            .values_list('pk', 'title', 'weight', 'cost').iterator(chunk_size=chunk_size))
+    return np.fromiter(rows, dtype=UNIT_DTYPE)
+
+
+def group_percentiles(values, starts, counts, q):
+    """
+    Function to compute a percentile of each group of values, the values being sorted within their groups.
+
+    Parameters
+    ----------
+    values: ndarray
+        Values sorted by group and within a group
+    starts, counts: ndarray
+        Index of the first value and the number of values of each group
+    q: float
+        Percentile, from 0 to 100
+
+    Returns
+    ----------
+    percentiles: ndarray
+        Percentile of each group, NaN for an empty one
+    """
+
+    result = np.full(len(counts), np.nan)
+    filled = counts > 0
+    position = starts[filled] + (counts[filled] - 1) * (q / 100)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, starts[filled] + counts[filled] - 1)
+    fraction = position - lower
+    result[filled] = values[lower] + (values[upper] - values[lower]) * fraction
+    return result
+
+
+def compute_stats(units, ref_weights):
+    """
+    Function to compute the statistics of each product from the array of its units.
+
+    Parameters
+    ----------
+    units: ndarray
+        Array of UNIT_DTYPE
+    ref_weights: dict
+        Reference weights of the products by id
+
+    Returns
+    ----------
+    stats: dict
+        Statistics of each product with units by id, see the module docstring
+    """
+
+    if not len(units):
+        return {}
+    units = units[np.lexsort((units['weight'], units['product']))]
+    products, starts, counts = np.unique(units['product'], return_index=True, return_counts=True)
+    groups = np.repeat(np.arange(len(products)), counts)
+    weight, cost = units['weight'], units['cost']
+
+    ref = np.array([ref_weights[pk] for pk in products.tolist()], dtype=np.float64)
+    abs_tolerance, rel_tolerance = weight_tolerances()
+    tolerance = np.maximum(abs_tolerance, rel_tolerance * ref)[groups]
+    not_full_units = (weight > ref[groups] + tolerance) | (weight < ref[groups] - tolerance)
+
+    total_weight = np.bincount(groups, weights=weight, minlength=len(products))
+    total_cost = np.bincount(groups, weights=cost, minlength=len(products))
+    full_weight = counts * ref
+    fill_ratio = np.divide(total_weight, full_weight, out=np.full(len(products), np.nan), where=full_weight > 0)
+    cost_per_gram = np.divide(total_cost, total_weight, out=np.full(len(products), np.nan), where=total_weight > 0)
+    percentiles = {q: group_percentiles(weight, starts, counts, q) for q in PERCENTILES}
+
+    # Price per gram of the priced units, sorted within the products
+    priced = (weight > 0) & (cost > 0)
+    price_groups, price, price_pk = groups[priced], cost[priced] / weight[priced], units['pk'][priced]
+    order = np.lexsort((price, price_groups))
+    price_groups, price, price_pk = price_groups[order], price[order], price_pk[order]
+    price_counts = np.bincount(price_groups, minlength=len(products))
+    price_starts = np.concatenate(([0], np.cumsum(price_counts)[:-1]))
+    q1 = group_percentiles(price, price_starts, price_counts, 25)
+    q3 = group_percentiles(price, price_starts, price_counts, 75)
+    spread = OUTLIER_FACTOR * (q3 - q1)
+    checked = (price_counts >= MIN_OUTLIER_UNITS)[price_groups]
+    outlier = checked & ((price < (q1 - spread)[price_groups]) | (price > (q3 + spread)[price_groups]))
+    outliers = np.bincount(price_groups[outlier], minlength=len(products))
+    outlier_ids = np.split(price_pk[outlier], np.cumsum(outliers)[:-1])
+    not_full = np.bincount(groups[not_full_units], minlength=len(products))
+
+    stats = {}
+    for index, pk in enumerate(products.tolist()):
+        stats[pk] = {
+            'count': int(counts[index]),
+            'weight': float(total_weight[index]),
+            'cost': float(total_cost[index]),
+            'not_full': int(not_full[index]),
+            'fill_ratio': number(fill_ratio[index]),
+            'percentiles': {q: float(values[index]) for q, values in percentiles.items()},
+            'cost_per_gram': number(cost_per_gram[index]),
+            'outliers': int(outliers[index]),
+            'outlier_ids': sorted(outlier_ids[index].tolist()),
+        }
+    return stats
+
+
+def number(value):
+    """Function to convert a NumPy float into a Python one, NaN into None"""
+
+    return None if np.isnan(value) else float(value)
+
+
+def product_stats(user, products):
+    """
+    Function to compute the statistics of the units of the user for the given products.
+
+    Parameters
+    ----------
+    user: User
+        Owner of the units
+    products: iterable
+        Product objects, whose ref_weight is used
+
+    Returns
+    ----------
+    stats: dict
+        Statistics of each product with units by id, see the module docstring
+    """
+
+    products = list(products)
+    if not products:
+        return {}
+    return compute_stats(load_units(user, products), {product.pk: product.ref_weight for product in products})
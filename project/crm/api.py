@@ -0,0 +1,209 @@
+"""
+Read-only JSON API, version 1, for integrations that would otherwise scrape the HTML pages.
+
+Every resource is served at /api/v1/<resource>/ to logged in users:
+
+    products, companies, shops
+        shared by all users
+    cards
+        the InventorySummary row of each product of the user, identified by the product id
+    units
+        the ProdInfo units of the user
+
+GET parameters:
+
+    fields
+        comma separated names of the fields to return, by default all of them
+    ids
+        comma separated ids to fetch in one request, at most MAX_IDS; the result is not paginated
+    after, limit
+        cursor pagination by id: the next page starts after the 'next' value of the previous one
+
+Each page is loaded with a single query selecting only the columns of the requested fields,
+related names are joined in the same query, so the number of queries does not depend on the page size.
+Responses carry an ETag of their content and a matching If-None-Match gets 304 Not Modified.
+"""
+
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_safe
+
+from .models import Company, InventorySummary, ProdInfo, Product, Shop
+
+"Default and maximum number of objects on a page"
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+"Maximum number of ids of a batch fetch"
+MAX_IDS = 200
+
+
+def photo_url(name):
+    return Product._meta.get_field('photo').storage.url(name) if name else None
+
+
+class Resource:
+    """
+    Objects of a model served by the API.
+
+    Parameters
+    ----------
+    model: Model
+        Model of the objects
+    fields: dict
+        Names of the fields of the API mapped to the lookups of their values
+    key: str, optional
+        Lookup of the id of an object, used by batch fetch and pagination
+    owner: str, optional
+        Lookup of the user owning an object; objects of the other users are not served
+    converters: dict, optional
+        Functions converting the values of the fields, e.g. a file name into its URL
+    """
+
+    def __init__(self, model, fields, key='pk', owner=None, converters=None):
+        self.model = model
+        self.fields = fields
+        self.key = key
+        self.owner = owner
+        self.converters = converters or {}
+
+    def queryset(self, user):
+        objects = self.model.objects.all()
+        if self.owner:
+            objects = objects.filter(**{self.owner: user})
+        return objects.order_by(self.key)
+
+    def rows(self, objects, fields):
+        """Function to load the given fields of the objects with a single query"""
+
+        lookups = [self.fields[field] for field in fields]
+        converters = [self.converters.get(field) for field in fields]
+        return [{field: converter(value) if converter else value
+                 for field, converter, value in zip(fields, converters, row)}
+                for row in objects.values_list(*lookups)]
+
+
+RESOURCES = {
+    'products': Resource(Product, {
+        'id': 'pk', 'title': 'title', 'slug': 'slug', 'company': 'company_id', 'company_name': 'company__company',
+        'ref_weight': 'ref_weight', 'photo': 'photo', 'time_update': 'time_update',
+    }, converters={'photo': photo_url}),
+    'companies': Resource(Company, {'id': 'pk', 'company': 'company', 'slug': 'slug'}),
+    'shops': Resource(Shop, {'id': 'pk', 'shop': 'shop', 'slug': 'slug'}),
+    'cards': Resource(InventorySummary, {
+        'id': 'product_id', 'title': 'product__title', 'slug': 'product__slug', 'company': 'product__company_id',
+        'company_name': 'product__company__company', 'ref_weight': 'product__ref_weight',
+        'photo': 'product__photo', 'count': 'count', 'weight': 'weight', 'not_full': 'not_full', 'cost': 'cost',
+    }, key='product_id', owner='account', converters={'photo': photo_url}),
+    'units': Resource(ProdInfo, {
+        'id': 'pk', 'product': 'title_id', 'title': 'title__title', 'company': 'company_id', 'shop': 'shop_id',
+        'shop_name': 'shop__shop', 'cost': 'cost', 'weight': 'weight', 'time_create': 'time_create',
+    }, owner='account'),
+}
+
+
+class BadRequest(Exception):
+    """Invalid GET parameters of an API request"""
+
+
+def parse_ids(value, name):
+    try:
+        ids = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise BadRequest('%s: ожидается список целых чисел' % name)
+    return ids
+
+
+def parse_query(resource, params):
+    """
+    Function to validate the GET parameters of a request.
+
+    Returns
+    ----------
+    query: dict
+        'fields' (a list), 'ids' (a list or None), 'after' (an id or None) and 'limit'
+    """
+
+    fields = [field.strip() for field in params.get('fields', '').split(',') if field.strip()]
+    unknown = [field for field in fields if field not in resource.fields]
+    if unknown:
+        raise BadRequest('Неизвестные поля: %s' % ', '.join(unknown))
+
+    ids = None
+    if 'ids' in params:
+        ids = parse_ids(params['ids'], 'ids')
+        if len(ids) > MAX_IDS:
+            raise BadRequest('ids: не больше %d значений' % MAX_IDS)
+
+    after = None
+    if params.get('after'):
+        after = parse_ids(params['after'], 'after')
+        if len(after) != 1:
+            raise BadRequest('after: ожидается одно число')
+        after = after[0]
+
+    try:
+        limit = int(params.get('limit') or PAGE_SIZE)
+    except ValueError:
+        raise BadRequest('limit: ожидается целое число')
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise BadRequest('limit: от 1 до %d' % MAX_PAGE_SIZE)
+    return {'fields': fields or list(resource.fields), 'ids': ids, 'after': after, 'limit': limit}
+
+
+def fetch(resource, user, fields, ids=None, after=None, limit=PAGE_SIZE):
+    """
+    Function to load the objects of a resource for a user.
+
+    Returns
+    ----------
+    data: dict
+        'results' with the objects and 'next', the cursor of the next page or None
+    """
+
+    objects = resource.queryset(user)
+    if ids is not None:
+        return {'results': resource.rows(objects.filter(**{resource.key + '__in': ids}), fields), 'next': None}
+
+    if after is not None:
+        objects = objects.filter(**{resource.key + '__gt': after})
+    # The id is selected to build the cursor, and one more object to tell whether there is a next page
+    rows = resource.rows(objects[:limit + 1], fields + ['id'] if 'id' not in fields else fields)
+    next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+    rows = rows[:limit]
+    if 'id' not in fields:
+        for row in rows:
+            del row['id']
+    return {'results': rows, 'next': next_cursor}
+
+
+def json_response(request, data, status=200):
+    """Function to build a JSON response with an ETag of its content, answering 304 to a matching request"""
+
+    content = json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False).encode()
+    response = HttpResponse(content, status=status, content_type='application/json')
+    if status == 200:
+        response['ETag'] = quote_etag(hashlib.md5(content).hexdigest())
+        response = get_conditional_response(request, etag=response['ETag'], response=response)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@require_safe
+def resource_view(request, resource):
+    """Serves a resource of the API, see the module docstring for the parameters"""
+
+    if resource not in RESOURCES:
+        raise Http404
+    if not request.user.is_authenticated:
+        return json_response(request, {'error': 'Требуется авторизация'}, status=401)
+    try:
+        query = parse_query(RESOURCES[resource], request.GET)
+    except BadRequest as error:
+        return json_response(request, {'error': str(error)}, status=400)
+    return json_response(request, fetch(RESOURCES[resource], request.user, **query))
@@ -1,7 +1,15 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class CrmConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'crm'
 
+    def ready(self):
+        from . import metrics, profiling, signals
+
+        post_migrate.connect(signals.install_search_index, sender=self)
+        connection_created.connect(metrics.install_sql_wrapper)
+        connection_created.connect(profiling.install_sql_wrapper)
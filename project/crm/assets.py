@@ -0,0 +1,199 @@
+"""
+Static files with fingerprinted names, compressed in advance and served by the application itself.
+
+CompressedManifestStaticFilesStorage, the STATICFILES_STORAGE of the project, stores the files collected
+by collectstatic under names carrying a hash of their content, e.g. crm/css/styles.3b5e2c1f9a0d.css,
+and writes a gzip variant (.gz) next to every compressible file, and a Brotli one (.br) when the brotli
+package is installed. {% static %} links to the hashed names, so a changed file gets a new URL; before
+collectstatic has run, e.g. in development and in tests, the original names are used.
+
+StaticFilesMiddleware serves the files of STATIC_ROOT, so a small deployment needs no separate web server.
+The files are indexed when the process starts. A request gets the smallest variant its Accept-Encoding allows;
+hashed names never change and are cached by browsers for a year without revalidation, the other names
+for STATIC_MAX_AGE seconds. The index is not refreshed: restart the process after collectstatic.
+"""
+
+import asyncio
+import gzip
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.http import FileResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"Extensions of the files worth compressing; images and fonts are compressed already"
+COMPRESSIBLE = ('.css', '.js', '.mjs', '.map', '.svg', '.txt', '.html', '.json', '.xml', '.ico')
+
+"Files smaller than this, in bytes, are not compressed: the saving does not cover the headers"
+MIN_COMPRESS_SIZE = 200
+
+"Cache lifetime of the files with hashed names, in seconds"
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+"Encodings of the variants in the order of preference, with their file suffixes"
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+
+
+def compress(path):
+    """
+    Function to write the compressed variants of a file next to it.
+    A variant is kept only if it is smaller than the file.
+
+    Returns
+    ----------
+    variants: list
+        Paths of the written variants
+    """
+
+    with open(path, 'rb') as file:
+        content = file.read()
+    compressors = [('.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        compressors.append(('.br', lambda data: brotli.compress(data, quality=11)))
+
+    variants = []
+    for suffix, compressor in compressors:
+        compressed = compressor(content)
+        if len(compressed) < len(content):
+            with open(path + suffix, 'wb') as file:
+                file.write(compressed)
+            variants.append(path + suffix)
+    return variants
+
+
+def is_compressible(path):
+    return path.endswith(COMPRESSIBLE) and os.path.getsize(path) >= MIN_COMPRESS_SIZE
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ManifestStaticFilesStorage compressing the collected files and falling back to the original names"""
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        # Both the original and the hashed files are compressed, as both are served
+        for name in list(paths) + list(self.hashed_files.values()):
+            path = self.path(name)
+            if os.path.exists(path) and is_compressible(path):
+                for variant in compress(path):
+                    yield os.path.relpath(variant, self.location), variant, True
+
+    def stored_name(self, name):
+        # Without a manifest collectstatic has not run yet, there are no hashed files to link to
+        if not self.hashed_files and not self.exists(self.manifest_name):
+            return name
+        return super().stored_name(name)
+
+
+class StaticFile:
+    """A file of STATIC_ROOT with its compressed variants"""
+
+    __slots__ = ('path', 'size', 'mtime', 'content_type', 'variants', 'immutable')
+
+    def __init__(self, path, variants):
+        stat = os.stat(path)
+        self.path = path
+        self.size = stat.st_size
+        self.mtime = int(stat.st_mtime)
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.variants = variants
+        self.immutable = bool(HASHED_NAME.search(os.path.basename(path)))
+
+    def choose(self, accept_encoding):
+        """Function to choose the variant for the Accept-Encoding header, as (path, size, encoding)"""
+
+        accepted = {part.split(';')[0].strip() for part in accept_encoding.lower().split(',')}
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and suffix in self.variants:
+                return self.path + suffix, self.variants[suffix], encoding
+        return self.path, self.size, None
+
+
+def build_index(root):
+    """
+    Function to index the files of a directory by their URL path relative to it.
+
+    Returns
+    ----------
+    files: dict
+        StaticFile objects by relative path with forward slashes; variants are not indexed on their own
+    """
+
+    files = {}
+    suffixes = tuple(suffix for _, suffix in ENCODINGS)
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            if name.endswith(suffixes) and os.path.exists(path[:-len(os.path.splitext(name)[1])]):
+                continue
+            variants = {suffix: os.path.getsize(path + suffix) for suffix in suffixes
+                        if os.path.exists(path + suffix)}
+            files[os.path.relpath(path, root).replace(os.sep, '/')] = StaticFile(path, variants)
+    return files
+
+
+class StaticFilesMiddleware:
+    """
+    Serves the files of STATIC_ROOT under STATIC_URL before the other middleware runs;
+    the other requests go on unchanged. Must be the first middleware.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Mark the middleware as asynchronous for asynchronous handlers, like MiddlewareMixin does
+        self._is_coroutine = asyncio.coroutines._is_coroutine if asyncio.iscoroutinefunction(get_response) else None
+        self.prefix = settings.STATIC_URL if settings.STATIC_URL.startswith('/') else None
+        root = settings.STATIC_ROOT
+        self.files = build_index(root) if self.prefix and root and os.path.isdir(root) else {}
+
+    def __call__(self, request):
+        if self._is_coroutine:
+            return self.__acall__(request)
+        return self.serve(request) or self.get_response(request)
+
+    async def __acall__(self, request):
+        return self.serve(request) or await self.get_response(request)
+
+    def serve(self, request):
+        """Function to answer a request of a static file, None for the other requests"""
+
+        if not self.files or request.method not in ('GET', 'HEAD') or not request.path.startswith(self.prefix):
+            return None
+        static_file = self.files.get(request.path[len(self.prefix):])
+        if static_file is None:
+            return None
+
+        path, size, encoding = static_file.choose(request.headers.get('Accept-Encoding', ''))
+        # Every encoding is a different representation, with its own entity tag
+        etag = quote_etag('%x-%x%s' % (static_file.mtime, size, '-' + encoding if encoding else ''))
+        response = get_conditional_response(request, etag=etag, last_modified=static_file.mtime)
+        if response is None:
+            response = FileResponse(open(path, 'rb'), content_type=static_file.content_type)
+            response['Content-Length'] = size
+            if encoding:
+                response['Content-Encoding'] = encoding
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(static_file.mtime)
+        response['X-Content-Type-Options'] = 'nosniff'
+        if static_file.immutable:
+            response['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        else:
+            response['Cache-Control'] = 'public, max-age=%d' % getattr(settings, 'STATIC_MAX_AGE', 60)
+        if static_file.variants:
+            patch_vary_headers(response, ('Accept-Encoding',))
+        return response
@@ -0,0 +1,234 @@
+"""
+Asynchronous versions of the read-heavy views: MainPage, MoreCards, Search, Detail and load_titles.
+
+They are served instead of the synchronous views when the project runs under an ASGI server
+(settings.ASYNC_VIEWS, set by core/asgi.py), so a request waiting for the database does not hold a worker thread.
+The queries use the asynchronous ORM. The views share the cached data with their synchronous versions
+and render the same templates, so both produce the same pages.
+
+Django runs the queries of the asynchronous ORM one after another on the thread of the request, so they are
+awaited in turn: a single request is not faster than the synchronous one, but while it waits for the database
+the event loop serves other requests.
+"""
+
+import datetime
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache as default_cache
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import InvalidPage, Paginator
+from django.http import Http404, JsonResponse
+from django.shortcuts import render, resolve_url
+from django.template.loader import render_to_string
+from django.urls import reverse_lazy
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.views.generic import View
+
+from . import cache
+from .models import InventorySummary, Product
+from .search import search_products
+from .utils1 import CARDS_PAGE_SIZE, PRODUCT_INDEX_KEY, add_dict, build_product_index, card_cursor, cards_batch, \
+    cards_batch_queryset, cards_batch_url, cards_queryset, detail_cursors, inventory_cards, load_product_stats, \
+    mark_outliers, product_index_rows, shop_breakdown_queryset, unit_totals, units_page, units_page_queryset
+
+
+async def alist(queryset):
+    return [obj async for obj in queryset]
+
+
+async def aproduct_index():
+    """Asynchronous version of crm.utils1.product_index"""
+
+    index = await default_cache.aget(PRODUCT_INDEX_KEY)
+    if index is None:
+        index = build_product_index(await alist(product_index_rows()))
+        await default_cache.aadd(PRODUCT_INDEX_KEY, index, None)
+    return index
+
+
+async def acached_cards_html(user, name, summary, *parts):
+    """Asynchronous version of crm.utils1.cached_cards_html, summary is a coroutine function loading the rows"""
+
+    async def load():
+        return render_to_string('crm/card_list.html', {'cards': inventory_cards(await summary())})
+
+    return await cache.aget_or_set(user, name, load, *parts)
+
+
+async def acached_cards_batch(user, name, summary, *parts):
+    """Asynchronous version of crm.utils1.cached_cards_batch, summary is a coroutine function loading the rows"""
+
+    async def load():
+        return cards_batch(await summary())
+
+    return await cache.aget_or_set(user, name, load, *parts)
+
+
+async def asummary_rows(user, product_ids):
+    """Asynchronous version of crm.utils1.summary_rows"""
+
+    rows = {row.product_id: row async for row in (InventorySummary.objects
+                                                  .filter(account=user, product__in=product_ids)
+                                                  .select_related('product__company'))}
+    return [rows[pk] for pk in product_ids if pk in rows]
+
+
+def requested_page(request):
+    """Function to read the page number like ListView does: a number or 'last'"""
+
+    page = request.GET.get('page') or 1
+    if page == 'last':
+        return page
+    try:
+        number = int(page)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise Http404('Страница не найдена')
+    return number
+
+
+def get_page(object_list, count, number):
+    """Function to paginate a queryset or a list whose length is already known"""
+
+    paginator = Paginator(object_list, CARDS_PAGE_SIZE)
+    paginator.count = count
+    try:
+        page = paginator.page(paginator.num_pages if number == 'last' else number)
+    except InvalidPage:
+        raise Http404('Страница не найдена')
+    return {'paginator': paginator, 'page_obj': page, 'is_paginated': page.has_other_pages()}
+
+
+def page_slice(object_list, number):
+    return object_list[(number - 1) * CARDS_PAGE_SIZE:number * CARDS_PAGE_SIZE]
+
+
+class AsyncLoginRequiredView(View):
+    """Base class of the asynchronous views of logged in users, the counterpart of LoginRequiredMixin"""
+
+    login_url = reverse_lazy('login')
+    raise_exception = False
+
+    async def dispatch(self, request, *args, **kwargs):
+        # The user is loaded from the session synchronously, once; templates then read it from the request
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            if self.raise_exception:
+                raise PermissionDenied
+            return redirect_to_login(request.get_full_path(), resolve_url(self.login_url))
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncMainPage(AsyncLoginRequiredView):
+    """Asynchronous version of MainPage"""
+
+    async def get(self, request):
+        user = request.user
+        summary = cards_queryset(user)
+        number = requested_page(request)
+
+        def load_page():
+            start = (number - 1) * CARDS_PAGE_SIZE
+            return alist(summary[start:start + CARDS_PAGE_SIZE + 1])
+
+        count = await cache.aget_or_set(user, 'cards_count', summary.acount)
+        if number == 'last':
+            number = max(1, -(-count // CARDS_PAGE_SIZE))
+        # The number is checked against the count by get_page
+        batch = await acached_cards_batch(user, 'cards_page', load_page, number)
+
+        context = get_page(summary, count, number)
+        context.update({'add_dict': add_dict, 'cards_html': batch['cards_html'],
+                        'next_url': cards_batch_url(batch['next_cursor'])})
+        return render(request, 'crm/cards.html', context)
+
+
+class AsyncMoreCards(AsyncLoginRequiredView):
+    """Asynchronous version of MoreCards"""
+
+    as_json = False
+
+    async def get(self, request):
+        value, after = card_cursor(request)
+        batch = await acached_cards_batch(request.user, 'cards_batch',
+                                          lambda: alist(cards_batch_queryset(request.user, after)), value)
+        if self.as_json:
+            return JsonResponse({'cards_html': batch['cards_html'], 'next_cursor': batch['next_cursor'],
+                                 'next_url': cards_batch_url(batch['next_cursor'], as_json=True)})
+        return render(request, 'crm/card_batch.html', {'cards_html': batch['cards_html'],
+                                                       'next_url': cards_batch_url(batch['next_cursor'])})
+
+
+class AsyncSearch(AsyncLoginRequiredView):
+    """Asynchronous version of Search"""
+
+    async def get(self, request):
+        user = request.user
+        q = request.GET.get('q', '')
+        query = q.strip()
+        found = []
+        if query:
+            found = await cache.aget_or_set(user, 'search', lambda: sync_to_async(search_products)(user, query),
+                                            query)
+        context = get_page(found, len(found), requested_page(request))
+        number = context['page_obj'].number
+        context.update({
+            'add_dict': add_dict,
+            'q': q,
+            'cards_html': await acached_cards_html(user, 'search_cards',
+                                                   lambda: asummary_rows(user, page_slice(found, number)),
+                                                   query, number),
+        })
+        return render(request, 'crm/search_result.html', context)
+
+
+class AsyncDetail(AsyncLoginRequiredView):
+    """
+    Asynchronous version of Detail; the product is loaded first, the breakdown by shop and the statistics
+    need its reference weight
+    """
+
+    login_url = reverse_lazy('home')
+    raise_exception = True
+
+    async def get(self, request, product_slug):
+        user = request.user
+        after, before = detail_cursors(request)
+        lookup = {'title__slug': product_slug}
+        try:
+            product = await Product.objects.select_related('company').aget(slug=product_slug)
+        except Product.DoesNotExist:
+            raise Http404('Товар не найден')
+        context = units_page(await alist(units_page_queryset(user, lookup, after, before)), after, before)
+        summary = await InventorySummary.objects.filter(account=user, product__slug=product_slug).afirst()
+        shops = await alist(shop_breakdown_queryset(user, lookup, product.ref_weight))
+        stats = await cache.aget_or_set(user, 'product_stats',
+                                        lambda: sync_to_async(load_product_stats)(user, product), product.pk)
+        mark_outliers(context['product_set'], stats)
+        context.update({
+            'object': product, 'product': product, 'totals': unit_totals(summary), 'shops': shops, 'stats': stats,
+        })
+        return render(request, 'crm/detail_page/product_detail.html', context)
+
+
+async def load_titles(request):
+    """Asynchronous version of load_titles with the same conditional response headers"""
+
+    index = await aproduct_index()
+    company = request.GET.get('company')
+    etag = quote_etag('%s-%s' % (index['etag'], company) if company else index['etag'])
+    last_modified = int(index['modified'].astimezone(datetime.timezone.utc).timestamp())
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if company:
+            response = JsonResponse({'titles': index['companies'].get(company, [])})
+        else:
+            response = JsonResponse({'companies': index['companies']})
+    if request.method in ('GET', 'HEAD'):
+        response.headers.setdefault('Last-Modified', http_date(last_modified))
+        response.headers.setdefault('ETag', etag)
+    patch_cache_control(response, no_cache=True)
+    return response
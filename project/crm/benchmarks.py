@@ -0,0 +1,179 @@
+"""
+Benchmarks of the crm views at several sizes of synthetic data.
+
+For every size the data is generated with crm.synthetic inside a transaction that is rolled back afterwards,
+so the database is left as it was. Each scenario requests a view with the test client as the user holding
+the most units: once with a cold cache (the cache versions of the user are bumped and the product index dropped)
+and then several times with a warm one. The number of queries and the latency of both are recorded.
+
+Query counts must not depend on the amount of data; check_query_growth reports the scenarios
+whose queries grow with the size, which points to a query per row somewhere in the view.
+"""
+
+import statistics
+import time
+from contextlib import ExitStack
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import sharding, synthetic
+from .cache import bump_versions
+from .models import InventorySummary, ProdInfo
+from .utils1 import invalidate_product_index
+
+"Default numbers of ProdInfo units of the benchmarked data sizes"
+SIZES = (1000, 10000)
+
+
+def data_options(size):
+    """Function to scale the numbers of the other objects with the number of units"""
+
+    products = max(20, size // 50)
+    return {'users': 5, 'companies': max(2, products // 10), 'shops': max(2, products // 20),
+            'products': products, 'units': size}
+
+
+class Fixture:
+    """Objects of the synthetic data the scenarios refer to"""
+
+    def __init__(self, data):
+        self.user = data.users[0]
+        with sharding.account_scope(self.user):
+            summary = (InventorySummary.objects.filter(account=self.user).select_related('product')
+                       .order_by('-count', 'product_id').first())
+            self.product = summary.product
+            self.unit = ProdInfo.objects.filter(account=self.user, title=self.product).order_by('pk').first()
+        self.shop = data.shops[0]
+        self.query = self.product.title.split()[0]
+
+
+def main_page(client, fixture):
+    return client.get(reverse('home'))
+
+
+def main_page_last(client, fixture):
+    return client.get(reverse('home'), {'page': 'last'})
+
+
+def search_page(client, fixture):
+    return client.get(reverse('search_result'), {'q': fixture.query})
+
+
+def detail_page(client, fixture):
+    return client.get(reverse('detail', kwargs={'product_slug': fixture.product.slug}))
+
+
+def load_titles(client, fixture):
+    return client.get(reverse('ajax_load_objects'), {'company': fixture.product.company_id})
+
+
+def add_unit(client, fixture):
+    return client.post(reverse('add_product'), {
+        'company': fixture.product.company_id, 'title': fixture.product.pk, 'shop': fixture.shop.pk,
+        'cost': 100, 'weight': fixture.product.ref_weight,
+    })
+
+
+def edit_unit(client, fixture):
+    return client.post(reverse('edit_prodinfo', kwargs={'product_slug': fixture.product.slug,
+                                                        'prodinfo_id': fixture.unit.pk}),
+                       {'shop': fixture.shop.pk, 'cost': 150, 'weight': fixture.unit.weight})
+
+
+SCENARIOS = {
+    'main_page': main_page,
+    'main_page_last': main_page_last,
+    'search': search_page,
+    'detail': detail_page,
+    'load_titles': load_titles,
+    'add_unit': add_unit,
+    'edit_unit': edit_unit,
+}
+
+
+def measure(scenario, client, fixture):
+    # The queries are counted on the default database and on the shards, see crm.sharding
+    with ExitStack() as stack:
+        captured = [stack.enter_context(CaptureQueriesContext(connections[using]))
+                    for using in dict.fromkeys([DEFAULT_DB_ALIAS, *sharding.all_databases()])]
+        start = time.perf_counter()
+        response = scenario(client, fixture)
+        latency = (time.perf_counter() - start) * 1000
+    if response.status_code >= 400:
+        raise AssertionError('%s answered with status %d' % (scenario.__name__, response.status_code))
+    return sum(len(queries) for queries in captured), latency
+
+
+def run(sizes=SIZES, repeat=5, scenarios=None, seed=0):
+    """
+    Function to benchmark the scenarios at each data size.
+
+    Parameters
+    ----------
+    sizes: iterable, optional
+        Numbers of ProdInfo units of the generated data
+    repeat: int, optional
+        Number of measurements with a warm cache
+    scenarios: iterable, optional
+        Names of the scenarios to run, by default all of SCENARIOS
+    seed: int, optional
+        Seed of the data generator
+
+    Returns
+    ----------
+    results: list
+        Dicts with the scenario name, the data size, the numbers of queries with a cold and a warm cache
+        and the latencies in milliseconds (the cold one and the median of the warm ones)
+    """
+
+    results = []
+    for size in sizes:
+        with sharding.atomic():
+            data = synthetic.generate(prefix='benchmark%d' % size, seed=seed, **data_options(size))
+            fixture = Fixture(data)
+            client = Client()
+            client.force_login(fixture.user)
+            for name in scenarios or SCENARIOS:
+                scenario = SCENARIOS[name]
+                bump_versions([fixture.user.pk])
+                invalidate_product_index()
+                cold_queries, cold_latency = measure(scenario, client, fixture)
+                warm = [measure(scenario, client, fixture) for _ in range(repeat)]
+                results.append({
+                    'scenario': name,
+                    'size': size,
+                    'queries_cold': cold_queries,
+                    'queries_warm': max(queries for queries, _ in warm) if warm else None,
+                    'latency_cold_ms': round(cold_latency, 3),
+                    'latency_warm_ms': round(statistics.median(latency for _, latency in warm), 3) if warm else None,
+                })
+            for using in dict.fromkeys([DEFAULT_DB_ALIAS, *sharding.all_databases()]):
+                transaction.set_rollback(True, using=using)
+        # The cache is not rolled back; entries of the generated users are never read again,
+        # but the shared product index would list the generated products
+        invalidate_product_index()
+    return results
+
+
+def check_query_growth(results):
+    """
+    Function to find the scenarios whose number of queries grows with the data size.
+
+    Returns
+    ----------
+    errors: list
+        Messages describing each growth, empty if the query counts are the same at all sizes
+    """
+
+    errors = []
+    smallest = {}
+    for result in sorted(results, key=lambda result: result['size']):
+        first = smallest.setdefault(result['scenario'], result)
+        for key in ('queries_cold', 'queries_warm'):
+            if result[key] is not None and first[key] is not None and result[key] > first[key]:
+                errors.append('%s: %s grew from %d at size %d to %d at size %d' % (
+                    result['scenario'], key, first[key], first['size'], result[key], result['size']))
+    return errors
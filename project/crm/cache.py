@@ -0,0 +1,216 @@
+"""
+Per-user versioned caching of the dashboard and search data.
+
+Every cached value of a user is stored with the user's version counter as the cache key version.
+Writes to ProdInfo, Product, Company and Shop bump the counters of the users they affect (see crm.signals),
+so stale entries of these users are never read again and expire on their own, while the entries
+of other users stay valid.
+
+TieredCache is a cache backend keeping recently used entries in process memory in front of the shared
+cache from settings, so repeated requests are answered without reading the shared cache. The version counters
+are read and incremented in the shared cache only, so a change made by one process is seen by the others
+on their next request; the versioned entries themselves may be kept in memory.
+"""
+
+import hashlib
+import pickle
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+"Timeout of the cached dashboard and search data, in seconds"
+CACHE_TIMEOUT = 60 * 60
+
+VERSION_KEY = 'crm:version:%s'
+
+_missing = object()
+
+# Memory tiers of TieredCache, shared by the threads of the process and keyed by the shared cache alias
+_local_caches = {}
+_local_locks = {}
+
+
+class TieredCache(BaseCache):
+    """
+    Two-tier cache backend: a thread-safe LRU dict in process memory in front of a shared cache.
+    LOCATION is the alias of the shared cache. Entries are kept in memory for at most
+    OPTIONS['LOCAL_TIMEOUT'] seconds, which bounds how long a change made by another process stays unseen;
+    changes made by this process update the memory tier immediately.
+    """
+
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._local_timeout = options.get('LOCAL_TIMEOUT', 5)
+        self._local_max_entries = options.get('LOCAL_MAX_ENTRIES', 1000)
+        self._shared_alias = location
+        self._local = _local_caches.setdefault(location, OrderedDict())
+        self._lock = _local_locks.setdefault(location, Lock())
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+        return entry
+
+    def _local_set(self, key, value, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        expires = time.monotonic() + (self._local_timeout if timeout is None else
+                                      min(self._local_timeout, timeout - time.time()))
+        entry = (expires, pickle.dumps(value, self.pickle_protocol))
+        with self._lock:
+            self._local[key] = entry
+            self._local.move_to_end(key)
+            while len(self._local) > self._local_max_entries:
+                self._local.popitem(last=False)
+
+    def _local_delete(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_and_validate_key(key, version=version)
+        added = self.shared.add(key, value, self._shared_timeout(timeout), version=version)
+        if added:
+            self._local_set(local_key, value, timeout)
+        return added
+
+    def get(self, key, default=None, version=None):
+        local_key = self.make_and_validate_key(key, version=version)
+        entry = self._local_get(local_key)
+        if entry is not None:
+            return pickle.loads(entry[1])
+        value = self.shared.get(key, self._missing_key, version=version)
+        if value is self._missing_key:
+            return default
+        self._local_set(local_key, value, DEFAULT_TIMEOUT)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_and_validate_key(key, version=version)
+        self.shared.set(key, value, self._shared_timeout(timeout), version=version)
+        self._local_set(local_key, value, timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, self._shared_timeout(timeout), version=version)
+
+    def delete(self, key, version=None):
+        self._local_delete(self.make_and_validate_key(key, version=version))
+        return self.shared.delete(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        local_key = self.make_and_validate_key(key, version=version)
+        value = self.shared.incr(key, delta, version=version)
+        self._local_set(local_key, value, DEFAULT_TIMEOUT)
+        return value
+
+    def has_key(self, key, version=None):
+        return self.get(key, self._missing_key, version=version) is not self._missing_key
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+        self.shared.clear()
+
+    def _shared_timeout(self, timeout):
+        return self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+
+def counter_cache():
+    """Function to get the cache holding the version counters: the shared tier of TieredCache"""
+
+    backend = caches[DEFAULT_CACHE_ALIAS]
+    return backend.shared if isinstance(backend, TieredCache) else backend
+
+
+def get_version(user_id):
+    """Function to get the current cache version of the user, creating the counter if it is missing"""
+
+    counters = counter_cache()
+    version = counters.get(VERSION_KEY % user_id)
+    if version is None:
+        # A counter lost from the cache restarts from the current time, so it never returns to an old version
+        version = time.time_ns() // 1000
+        if not counters.add(VERSION_KEY % user_id, version, None):
+            version = counters.get(VERSION_KEY % user_id, version)
+    return version
+
+
+def bump_versions(user_ids):
+    """Function to invalidate all the cached data of the given users"""
+
+    counters = counter_cache()
+    for user_id in set(user_ids):
+        try:
+            counters.incr(VERSION_KEY % user_id)
+        except ValueError:
+            get_version(user_id)
+
+
+def make_key(name, *parts):
+    """Function to build a cache key from a name and any values the cached data depends on"""
+
+    if not parts:
+        return 'crm:%s' % name
+    digest = hashlib.md5(':'.join(str(part) for part in parts).encode(), usedforsecurity=False).hexdigest()
+    return 'crm:%s:%s' % (name, digest)
+
+
+def get_or_set(user, name, default, *parts, timeout=CACHE_TIMEOUT):
+    """
+    Function to get a cached value of the user or compute and cache it.
+
+    Parameters
+    ----------
+    user: User
+        Owner of the data; the key is scoped by the user and carries the user's version
+    name: str
+        Name of the cached data
+    default: callable
+        Computes the value on a cache miss
+    parts: optional
+        Values the cached data depends on, e.g. a page number or a search request
+    timeout: int, optional
+        Timeout of the entry in seconds
+    """
+
+    return cache.get_or_set(make_key('%s:%s' % (user.pk, name), *parts), default, timeout,
+                            version=get_version(user.pk))
+
+
+async def aget_version(user_id):
+    """Asynchronous version of get_version"""
+
+    counters = counter_cache()
+    version = await counters.aget(VERSION_KEY % user_id)
+    if version is None:
+        version = time.time_ns() // 1000
+        if not await counters.aadd(VERSION_KEY % user_id, version, None):
+            version = await counters.aget(VERSION_KEY % user_id, version)
+    return version
+
+
+async def aget_or_set(user, name, default, *parts, timeout=CACHE_TIMEOUT):
+    """Asynchronous version of get_or_set, computing a missing value with the coroutine function default"""
+
+    key, version = make_key('%s:%s' % (user.pk, name), *parts), await aget_version(user.pk)
+    # A cached None is a value, like in get_or_set
+    value = await cache.aget(key, _missing, version=version)
+    if value is _missing:
+        value = await default()
+        await cache.aadd(key, value, timeout, version=version)
+    return value
@@ -0,0 +1,146 @@
+"""
+Pool of captcha challenges generated in advance for the login and registration forms.
+
+django-simple-captcha creates a CaptchaStore row when a form is rendered and draws the image with Pillow
+when the browser requests it, so a burst of logins spends its time drawing captchas. The refill_captcha_pool
+command generates challenges and renders their images in the background, keeping settings.CAPTCHA_POOL_SIZE
+of them available. PooledCaptchaTextInput takes an entry from the pool with one UPDATE and image_view serves
+the stored image; when the pool is empty the widget falls back to the usual generation.
+
+Challenges live for settings.CAPTCHA_POOL_LIFETIME minutes and are taken only while at least CAPTCHA_TIMEOUT
+minutes are left, so a user has the usual time to answer. Expired challenges are deleted in batches by cleanup.
+"""
+
+import datetime
+
+from captcha.conf import settings as captcha_settings
+from captcha.fields import CaptchaTextInput
+from captcha.models import CaptchaStore
+from captcha.views import captcha_image
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import CaptchaPoolEntry
+
+"Number of attempts to take an entry that other requests are taking at the same time"
+POP_ATTEMPTS = 3
+
+
+def get_size():
+    return getattr(settings, 'CAPTCHA_POOL_SIZE', 500)
+
+
+def available():
+    """Function to select the entries that are not taken and leave enough time to answer"""
+
+    threshold = timezone.now() + datetime.timedelta(minutes=int(captcha_settings.CAPTCHA_TIMEOUT))
+    return CaptchaPoolEntry.objects.filter(taken=False, expiration__gt=threshold)
+
+
+def pop():
+    """
+    Function to take an entry from the pool, the one expiring first.
+
+    Returns
+    ----------
+    key: str or None
+        Hash key of the CaptchaStore row of the entry, None if the pool is empty
+    """
+
+    for _ in range(POP_ATTEMPTS):
+        entry = available().order_by('expiration').values_list('pk', 'store__hashkey').first()
+        if entry is None:
+            return None
+        # Another request may take the same entry first; the update then changes nothing and the next one is tried
+        if CaptchaPoolEntry.objects.filter(pk=entry[0], taken=False).update(taken=True):
+            return entry[1]
+    return None
+
+
+def render_image(key):
+    """Function to draw the image of a challenge like the captcha-image view does"""
+
+    return captcha_image(None, key).content
+
+
+def refill(size=None, batch_size=100):
+    """
+    Function to generate challenges until the pool has the given number of available entries.
+
+    Parameters
+    ----------
+    size: int, optional
+        Number of available entries to keep, settings.CAPTCHA_POOL_SIZE by default
+    batch_size: int, optional
+        Number of entries written in a transaction
+
+    Returns
+    ----------
+    created: int
+        Number of generated entries
+    """
+
+    missing = (get_size() if size is None else size) - available().count()
+    created = 0
+    while created < missing:
+        expiration = timezone.now() + datetime.timedelta(minutes=getattr(settings, 'CAPTCHA_POOL_LIFETIME', 60))
+        with transaction.atomic():
+            entries = []
+            for _ in range(min(batch_size, missing - created)):
+                challenge, response = captcha_settings.get_challenge()()
+                # save() builds the hash key, so the rows are not created in bulk
+                store = CaptchaStore.objects.create(challenge=challenge, response=response, expiration=expiration)
+                entries.append(CaptchaPoolEntry(store=store, image=render_image(store.hashkey),
+                                                expiration=expiration))
+            CaptchaPoolEntry.objects.bulk_create(entries)
+        created += len(entries)
+    return created
+
+
+def cleanup(batch_size=1000):
+    """
+    Function to delete the expired challenges, generated for the pool or not, a batch at a time.
+
+    Returns
+    ----------
+    deleted: int
+        Number of deleted challenges
+    """
+
+    deleted = 0
+    while True:
+        ids = list(CaptchaStore.objects.filter(expiration__lte=timezone.now())
+                   .values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        CaptchaStore.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+
+
+def image_view(request, key):
+    """Serves the stored image of a challenge, or draws it if the challenge was not taken from the pool"""
+
+    image = CaptchaPoolEntry.objects.filter(store__hashkey=key).values_list('image', flat=True).first()
+    if image is None:
+        return captcha_image(request, key)
+    response = HttpResponse(bytes(image), content_type='image/png')
+    response['Cache-Control'] = 'private, max-age=%d' % (int(captcha_settings.CAPTCHA_TIMEOUT) * 60)
+    return response
+
+
+class PooledCaptchaTextInput(CaptchaTextInput):
+    """Captcha widget taking its challenge from the pool"""
+
+    def fetch_captcha_store(self, name, value, attrs=None, generator=None):
+        key = pop()
+        if key is None:
+            return super().fetch_captcha_store(name, value, attrs, generator)
+        self._value = [key, '']
+        self._key = key
+        self.id_ = self.build_attrs(attrs).get('id', None)
+
+    def image_url(self):
+        return reverse('captcha_pool_image', kwargs={'key': self._key})
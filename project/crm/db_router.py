@@ -0,0 +1,143 @@
+"""
+Routing of the queries between the primary database and its read replicas.
+
+Writes always go to the primary ('default'). Reads go to a replica from settings.DATABASE_REPLICAS only
+while ReplicaRoutingMiddleware serves a GET or HEAD request of one of the read-only views listed
+in settings.DATABASE_REPLICA_VIEWS; all the other reads, e.g. in POST requests, commands and workers,
+go to the primary.
+
+A replica lags behind the primary, so a user who has just written would not see the change on the next page.
+When a request writes, the middleware sets a cookie pinning the reads of that browser to the primary
+for settings.DATABASE_PRIMARY_STICKY_SECONDS. Within a request, the reads after a write and the reads
+inside a transaction go to the primary as well. Writes to a database given explicitly, e.g. the shard
+of an account, are recorded by mark_written.
+"""
+
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+STICKY_COOKIE = 'primary_until'
+
+"Apps whose writes do not pin the reads to the primary: sessions are saved by almost every request"
+UNPINNED_APPS = ('sessions',)
+
+_state = ContextVar('crm_db_routing', default=None)
+
+
+class RoutingState:
+    """Routing of the queries of a request"""
+
+    __slots__ = ('use_replica', 'wrote')
+
+    def __init__(self, use_replica=False):
+        self.use_replica = use_replica
+        self.wrote = False
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+class PrimaryReplicaRouter:
+    """Database router sending the reads of the read-only views to a random replica and the rest to the primary"""
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        replicas = get_replicas()
+        if state is None or not state.use_replica or state.wrote or not replicas:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None and model._meta.app_label not in UNPINNED_APPS:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the primary and get its schema by replication
+        return db not in get_replicas()
+
+
+def mark_written():
+    """
+    Function to record a write of the current request made on a database chosen by the caller, e.g. the shard
+    of an account, which does not go through db_for_write: the reads of the browser are pinned to the primary
+    like after any other write
+    """
+
+    state = _state.get()
+    if state is not None:
+        state.wrote = True
+
+
+def pinned(request):
+    """Function to check whether the reads of the browser are pinned to the primary after a recent write"""
+
+    try:
+        return float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Enables the replica reads for the read-only views and pins the reads of the browser to the primary
+    after a request that wrote. Must be placed before the middleware that may read the database.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Mark the middleware as asynchronous for asynchronous handlers, like MiddlewareMixin does
+        self._is_coroutine = asyncio.coroutines._is_coroutine if asyncio.iscoroutinefunction(get_response) else None
+
+    def __call__(self, request):
+        if self._is_coroutine:
+            return self.__acall__(request)
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(response, state)
+
+    async def __acall__(self, request):
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(response, state)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _state.get()
+        match = request.resolver_match
+        if state is not None and request.method in ('GET', 'HEAD') and not pinned(request) and match and \
+                match.url_name in getattr(settings, 'DATABASE_REPLICA_VIEWS', ()):
+            state.use_replica = True
+
+    @staticmethod
+    def finish(response, state):
+        if state.wrote:
+            seconds = getattr(settings, 'DATABASE_PRIMARY_STICKY_SECONDS', 10)
+            response.set_cookie(STICKY_COOKIE, '%.3f' % (time.time() + seconds), max_age=seconds,
+                                httponly=True, samesite='Lax')
+        return response
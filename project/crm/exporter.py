@@ -0,0 +1,108 @@
+"""
+Streaming export of ProdInfo units to CSV and JSON Lines.
+
+Units are read with QuerySet.iterator(), so only one chunk of rows is held in memory at a time
+(on PostgreSQL through a server-side cursor), and every row is encoded and sent as soon as it is read.
+The names of products, companies and shops are joined in the same query. The column names
+are the ones accepted by crm.importer, so an exported CSV file can be imported again.
+"""
+
+import csv
+import json
+
+from django.db import router
+
+from . import sharding
+from .models import ProdInfo
+
+"Number of rows fetched from the database at once"
+CHUNK_SIZE = 2000
+
+"Exported columns and the ProdInfo lookups they are read from"
+EXPORT_FIELDS = (
+    ('id', 'pk'),
+    ('title', 'title__title'),
+    ('company', 'company__company'),
+    ('shop', 'shop__shop'),
+    ('weight', 'weight'),
+    ('cost', 'cost'),
+    ('time_create', 'time_create'),
+)
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def export_queryset(user, product=None, shop=None, date_from=None, date_to=None):
+    """
+    Function to select the exported units of the user.
+
+    Parameters
+    ----------
+    user: User
+        Owner of the units
+    product: Product, optional
+        Export only the units of this product
+    shop: Shop, optional
+        Export only the units bought in this shop
+    date_from: date, optional
+        Export only the units added on this day or later
+    date_to: date, optional
+        Export only the units added on this day or earlier
+
+    Returns
+    ----------
+    rows: QuerySet
+        Tuples of the values of EXPORT_FIELDS, ordered by id. The database, the shard of the user or a replica,
+        is chosen when the QuerySet is built: the response streams the rows after the routing state
+        of the request is reset
+    """
+
+    using = sharding.db_for_account(user) if sharding.get_shards() else router.db_for_read(ProdInfo)
+    units = ProdInfo.objects.using(using).filter(account=user)
+    if product is not None:
+        units = units.filter(title=product)
+    if shop is not None:
+        units = units.filter(shop=shop)
+    if date_from is not None:
+        units = units.filter(time_create__date__gte=date_from)
+    if date_to is not None:
+        units = units.filter(time_create__date__lte=date_to)
+    return units.order_by('pk').values_list(*(lookup for _, lookup in EXPORT_FIELDS))
+
+
+def isoformat(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+class Echo:
+    """File-like object returning what is written to it, so csv.writer can encode one row at a time"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    """Function to encode the exported rows as CSV lines, starting with the header"""
+
+    writer = csv.writer(Echo())
+    # The BOM makes Excel read the file as UTF-8
+    yield '\ufeff' + writer.writerow([name for name, _ in EXPORT_FIELDS])
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield writer.writerow(['' if value is None else isoformat(value) for value in row])
+
+
+def jsonl_lines(rows):
+    """Function to encode the exported rows as JSON objects, one per line"""
+
+    names = [name for name, _ in EXPORT_FIELDS]
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield json.dumps(dict(zip(names, row)), ensure_ascii=False, default=isoformat) + '\n'
+
+
+ENCODERS = {
+    'csv': csv_lines,
+    'jsonl': jsonl_lines,
+}
@@ -1,9 +1,16 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth.models import User
+from django.db import transaction
 from captcha.fields import CaptchaField
 
+from . import db_router, sharding
+from .captcha_pool import PooledCaptchaTextInput
 from .models import *
+from .signals import bump_versions_on_commit
+
+"Maximum number of units added by a single submission of the multi-unit form"
+MAX_BATCH_UNITS = 1000
 
 
 class CompanyForm(forms.ModelForm):
@@ -191,6 +198,143 @@ class AddProdInfoForm(forms.ModelForm):
         }
 
 
+class UnitBatchForm(forms.Form):
+    """Class for the product and the shop shared by all the units of the multi-unit form"""
+
+    company = forms.ModelChoiceField(queryset=Company.objects.all(), required=False,
+                                     empty_label='Выберите производителя',
+                                     widget=forms.Select(attrs={'class': 'choice_field'}))
+    title = forms.ModelChoiceField(queryset=Product.objects.none(), empty_label='Выберите сначала производителя',
+                                   widget=forms.Select(attrs={'class': 'choice_field'}))
+    shop = forms.ModelChoiceField(queryset=Shop.objects.all(), required=False, empty_label='Выберите магазин',
+                                  widget=forms.Select(attrs={'class': 'choice_field'}))
+
+    def __init__(self, *args, product=None, **kwargs):
+        """
+        Initialization function. Without a product the 'title' field is filled like in ProductInfoForm.
+
+        Parameters
+        ----------
+        product: Product, optional
+            Product of the units when it is already known, e.g. on the Detail page; the product fields are removed
+        """
+
+        super().__init__(*args, **kwargs)
+        self.product = product
+        if product is not None:
+            del self.fields['company'], self.fields['title']
+        elif 'company' in self.data:
+            try:
+                company_id = int(self.data.get('company'))
+                self.fields['title'].queryset = (Product.objects.filter(company_id=company_id)
+                                                 .select_related('company').order_by('title'))
+            except (ValueError, TypeError):
+                pass
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.product is not None:
+            cleaned_data['title'] = self.product
+        return cleaned_data
+
+
+class UnitRowForm(forms.Form):
+    """Class for a row of the multi-unit form: the weight and the cost of a number of identical packs"""
+
+    weight = forms.FloatField(required=False, min_value=0,
+                              widget=forms.TextInput(attrs={'placeholder': 'Вес', 'class': 'form_input'}))
+    cost = forms.FloatField(required=False, min_value=0,
+                            widget=forms.TextInput(attrs={'placeholder': 'Стоимость', 'class': 'form_input'}))
+    quantity = forms.IntegerField(initial=1, min_value=1, max_value=MAX_BATCH_UNITS,
+                                  widget=forms.NumberInput(attrs={'class': 'form_input'}))
+
+
+class BaseUnitRowFormSet(forms.BaseFormSet):
+    """Rows of the multi-unit form, validated together and saved with a single INSERT"""
+
+    def clean(self):
+        if any(self.errors):
+            return
+        rows = [form.cleaned_data for form in self.forms if form.cleaned_data]
+        if not rows:
+            raise forms.ValidationError('Заполните хотя бы одну строку')
+        if sum(row['quantity'] for row in rows) > MAX_BATCH_UNITS:
+            raise forms.ValidationError('Не больше %d единиц за раз' % MAX_BATCH_UNITS)
+
+    def save(self, user, product, shop=None):
+        """
+        Function to create the units of all the rows in one transaction. The InventorySummary and DailyRollup
+        models are updated and the cached data of the user invalidated once for the whole batch.
+
+        Returns
+        ----------
+        units: list
+            Created ProdInfo objects
+        """
+
+        units = [ProdInfo(title=product, account=user, company=product.company, shop=shop,
+                          cost=row['cost'] or 0, weight=product.ref_weight if row['weight'] is None else row['weight'])
+                 for row in (form.cleaned_data for form in self.forms if form.cleaned_data)
+                 for _ in range(row['quantity'])]
+        using = sharding.db_for_account(user)
+        db_router.mark_written()
+        with transaction.atomic(using=using):
+            ProdInfo.objects.using(using).bulk_create(units)
+            InventorySummary.objects.apply_units(added=units, using=using)
+            DailyRollup.objects.apply_units(added=units, using=using)
+            bump_versions_on_commit([user.pk], using)
+        return units
+
+
+UnitRowFormSet = forms.formset_factory(UnitRowForm, formset=BaseUnitRowFormSet, extra=5)
+
+
+class ImportUnitsForm(forms.Form):
+    """Class for uploading a CSV or XLSX file with ProdInfo units"""
+
+    file = forms.FileField(label='Файл',
+                           help_text='CSV или XLSX со столбцами: товар, производитель, магазин, вес, стоимость.',
+                           widget=forms.FileInput(attrs={'accept': '.csv,.xlsx', 'class': 'form_input'}))
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if not file.name.lower().endswith(('.csv', '.xlsx')):
+            raise forms.ValidationError('Поддерживаются файлы CSV и XLSX')
+        return file
+
+
+class ExportUnitsForm(forms.Form):
+    """Class for the filters of the ProdInfo export, passed as GET parameters"""
+
+    product = forms.ModelChoiceField(queryset=Product.objects.all(), to_field_name='slug', required=False)
+    shop = forms.ModelChoiceField(queryset=Shop.objects.all(), to_field_name='slug', required=False)
+    date_from = forms.DateField(required=False)
+    date_to = forms.DateField(required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from, date_to = cleaned_data.get('date_from'), cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise forms.ValidationError('Начальная дата позже конечной')
+        return cleaned_data
+
+
+class HistoryForm(forms.Form):
+    """Class for the filters of the inventory history, passed as GET parameters"""
+
+    product = forms.ModelChoiceField(queryset=Product.objects.all(), to_field_name='slug', required=False,
+                                     label='Товар', empty_label='Все товары')
+    date_from = forms.DateField(required=False, label='С', widget=forms.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(required=False, label='По', widget=forms.DateInput(attrs={'type': 'date'}))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from, date_to = cleaned_data.get('date_from'), cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise forms.ValidationError('Начальная дата позже конечной')
+        return cleaned_data
+
+
 class RegisterUserForm(UserCreationForm):
     """Implements registration on the site, based on the standard Django registration form"""
 
@@ -213,7 +357,7 @@ class RegisterUserForm(UserCreationForm):
                                 widget=forms.PasswordInput(attrs={'class': 'form_input',
                                                                   'placeholder': 'Повтор пароля'}),
                                 help_text='*Обязательное поле.')
-    captcha = CaptchaField()
+    captcha = CaptchaField(widget=PooledCaptchaTextInput)
 
     class Meta:
         model = User
@@ -235,5 +379,5 @@ class LoginUserForm(AuthenticationForm):
                                                                             'placeholder': 'Логин'}))
     password = forms.CharField(label='Пароль', widget=forms.PasswordInput(attrs={'class': 'form_input',
                                                                                  'placeholder': 'Пароль'}))
-    captcha = CaptchaField()
+    captcha = CaptchaField(widget=PooledCaptchaTextInput)
 
@@ -0,0 +1,133 @@
+"""
+Resized and recompressed variants of Product.photo.
+
+For every uploaded photo a WebP and a JPEG file is generated for each width from settings.THUMBNAIL_WIDTHS
+(never wider than the original) and stored next to the original as images/<name>_<width>w.<ext>.
+Generation runs in a thread pool after the upload is committed, so the request does not wait for Pillow.
+The generated widths are saved to Product.photo_widths, which the responsive_photo template tag uses
+to build the srcset; until then the original photo is shown.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from threading import Lock
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections
+from PIL import Image, ImageOps
+
+from . import sharding
+from .cache import bump_versions
+from .models import InventorySummary, Product
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpg': {'format': 'JPEG', 'quality': 80, 'optimize': True, 'progressive': True},
+}
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_widths():
+    return tuple(sorted(getattr(settings, 'THUMBNAIL_WIDTHS', (240, 480, 960))))
+
+
+def variant_name(name, width, extension):
+    """Function to build the storage name of a photo variant"""
+
+    root, _ = os.path.splitext(name)
+    return '%s_%dw.%s' % (root, width, extension)
+
+
+def generate_variants(name, storage=None):
+    """
+    Function to generate the resized variants of a photo.
+
+    Parameters
+    ----------
+    name: str
+        Storage name of the original photo
+    storage: ContentAddressedStorage, optional
+        Storage of the photo, by default the storage of the Product.photo field.
+        Variants are written under names derived from the photo name, not by their own hash
+
+    Returns
+    ----------
+    widths: list
+        Widths of the generated variants. Widths larger than the original are replaced
+        by a single variant of the original width.
+    """
+
+    storage = storage or Product._meta.get_field('photo').storage
+    with storage.open(name) as file:
+        image = Image.open(file)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.mode else 'RGB')
+
+    widths = sorted({min(width, image.width) for width in get_widths()})
+    for width in widths:
+        resized = image if width == image.width else \
+            image.resize((width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS)
+        for extension, options in FORMATS.items():
+            variant = resized
+            if options['format'] == 'JPEG' and variant.mode == 'RGBA':
+                variant = Image.new('RGB', variant.size, 'white')
+                variant.paste(resized, mask=resized.getchannel('A'))
+            buffer = BytesIO()
+            variant.save(buffer, **options)
+            storage.save_exact(variant_name(name, width, extension), ContentFile(buffer.getvalue()))
+    return widths
+
+
+def process_photo(product_id, name):
+    """Function to generate the variants of a product photo and record their widths on the product"""
+
+    try:
+        widths = generate_variants(name)
+    except (OSError, ValueError):
+        logger.exception('Could not generate variants of %s', name)
+        return []
+
+    # The photo may have been replaced while the variants were generated
+    if Product.objects.filter(pk=product_id, photo=name).update(photo_widths=widths):
+        sharding.mirror(Product.objects.filter(pk=product_id))
+        bump_versions(account for using in sharding.all_databases()
+                      for account in (InventorySummary.objects.using(using).filter(product_id=product_id)
+                                      .values_list('account', flat=True)))
+    return widths
+
+
+def _process_photo_in_thread(product_id, name):
+    try:
+        return process_photo(product_id, name)
+    finally:
+        connections.close_all()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS, thread_name_prefix='crm-photo')
+        return _executor
+
+
+def schedule_variants(product_id, name):
+    """
+    Function to generate the variants of a photo in the worker pool.
+    With settings.THUMBNAIL_WORKERS = 0 the variants are generated in the calling thread.
+    """
+
+    if not getattr(settings, 'THUMBNAIL_WORKERS', 0):
+        process_photo(product_id, name)
+        return None
+    return get_executor().submit(_process_photo_in_thread, product_id, name)
@@ -0,0 +1,280 @@
+"""
+Streaming import of ProdInfo units from CSV and XLSX files.
+
+Rows are read one by one and inserted in batches: for every batch the names of products, companies and shops
+are resolved with one query per model (names seen in earlier batches are remembered), the valid rows are written
+with bulk_create, or with COPY on PostgreSQL, and the InventorySummary of the user is updated once.
+
+Every row gets an import key: the value of the 'import_key' column if the file has one, otherwise the hash
+of the file and the row number. Rows whose key was already imported for the user are skipped,
+so running the same import again does not duplicate units.
+"""
+
+import csv
+import hashlib
+import io
+import os
+from dataclasses import dataclass, field
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from . import db_router, sharding
+from .models import Company, DailyRollup, InventorySummary, ProdInfo, Product, Shop
+from .signals import bump_versions_on_commit
+
+"Accepted column headers for each field"
+HEADER_ALIASES = {
+    'title': ('title', 'product', 'товар', 'название'),
+    'company': ('company', 'производитель', 'компания'),
+    'shop': ('shop', 'магазин'),
+    'weight': ('weight', 'вес'),
+    'cost': ('cost', 'стоимость', 'цена'),
+    'import_key': ('import_key', 'key', 'ключ'),
+}
+
+
+class RowError(ValueError):
+    """Error of a single row, reported with its number and not stopping the import"""
+
+
+@dataclass
+class ImportResult:
+    created: int = 0
+    skipped: int = 0
+    errors: list = field(default_factory=list)
+
+    def add_error(self, row_number, message):
+        self.errors.append((row_number, str(message)))
+
+
+def file_digest(file):
+    """Function to hash the content of a file in chunks, leaving the file at its beginning"""
+
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(64 * 1024), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def normalize_header(header):
+    """Function to map the column headers of a file to the field names"""
+
+    columns = {}
+    for index, name in enumerate(header):
+        name = str(name or '').strip().lower()
+        for field_name, aliases in HEADER_ALIASES.items():
+            if name in aliases:
+                columns[field_name] = index
+    missing = {'title', 'weight'} - set(columns)
+    if missing:
+        raise RowError('В файле нет столбцов: %s' % ', '.join(sorted(missing)))
+    return columns
+
+
+def read_rows(file, filename):
+    """
+    Function to read rows of a CSV or XLSX file one at a time.
+
+    Parameters
+    ----------
+    file: file
+        Binary file object
+    filename: str
+        Name of the file; its extension selects the format
+
+    Returns
+    ----------
+    rows: iterator
+        (row number, dict of field values) pairs. Row numbers count the header as row 1.
+    """
+
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.xlsx':
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise RowError('Для импорта XLSX нужен пакет openpyxl')
+        workbook = load_workbook(file, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+    elif extension in ('.csv', '.txt'):
+        stream = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        sample = stream.read(4096)
+        stream.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        rows = csv.reader(stream, dialect)
+    else:
+        raise RowError('Поддерживаются файлы CSV и XLSX')
+
+    header = next(rows, None)
+    if header is None:
+        return
+    columns = normalize_header(header)
+    for row_number, row in enumerate(rows, start=2):
+        if not any(value not in (None, '') for value in row):
+            continue
+        yield row_number, {name: row[index] if index < len(row) else None for name, index in columns.items()}
+
+
+def parse_number(value, name):
+    if value in (None, ''):
+        raise RowError('Не указано поле %s' % name)
+    try:
+        return float(str(value).replace(',', '.').strip())
+    except ValueError:
+        raise RowError('Поле %s должно быть числом: %s' % (name, value))
+
+
+def text(value):
+    return str(value).strip() if value not in (None, '') else ''
+
+
+class NameLookup:
+    """In-memory map of names to objects of a model, filled with one query per batch for the unseen names"""
+
+    def __init__(self, queryset, field_name):
+        self.queryset = queryset
+        self.field_name = field_name
+        self.objects = {}
+
+    def load(self, names):
+        missing = {name for name in names if name and name not in self.objects}
+        if missing:
+            for obj in self.queryset.filter(**{'%s__in' % self.field_name: missing}):
+                self.objects[getattr(obj, self.field_name)] = obj
+            for name in missing:
+                self.objects.setdefault(name, None)
+
+    def get(self, name, label):
+        if not name:
+            return None
+        obj = self.objects.get(name)
+        if obj is None:
+            raise RowError('%s «%s» не найден' % (label, name))
+        return obj
+
+
+class UnitImporter:
+    """Imports ProdInfo units of a user from a file in batches"""
+
+    def __init__(self, user, batch_size=1000, use_copy=True):
+        self.user = user
+        self.using = sharding.db_for_account(user)
+        self.batch_size = batch_size
+        self.use_copy = use_copy and connections[self.using].vendor == 'postgresql'
+        self.products = NameLookup(Product.objects.select_related('company'), 'title')
+        self.companies = NameLookup(Company.objects.all(), 'company')
+        self.shops = NameLookup(Shop.objects.all(), 'shop')
+        self.result = ImportResult()
+
+    def run(self, file, filename):
+        try:
+            source = file_digest(file)[:16]
+            batch = []
+            for row_number, row in read_rows(file, filename):
+                row['import_key'] = text(row.get('import_key')) or '%s:%d' % (source, row_number)
+                batch.append((row_number, row))
+                if len(batch) >= self.batch_size:
+                    self.import_batch(batch)
+                    batch = []
+            if batch:
+                self.import_batch(batch)
+        except RowError as error:
+            self.result.add_error(None, error)
+        return self.result
+
+    def import_batch(self, batch):
+        self.products.load(text(row.get('title')) for _, row in batch)
+        self.companies.load(text(row.get('company')) for _, row in batch)
+        self.shops.load(text(row.get('shop')) for _, row in batch)
+        keys = [row['import_key'] for _, row in batch]
+        imported = set(ProdInfo.objects.using(self.using).filter(account=self.user, import_key__in=keys)
+                       .values_list('import_key', flat=True))
+
+        units = []
+        for row_number, row in batch:
+            if row['import_key'] in imported:
+                self.result.skipped += 1
+                continue
+            try:
+                units.append(self.build_unit(row))
+            except RowError as error:
+                self.result.add_error(row_number, error)
+                continue
+            imported.add(row['import_key'])
+
+        if not units:
+            return
+        db_router.mark_written()
+        with transaction.atomic(using=self.using):
+            if self.use_copy:
+                self.copy(units, connections[self.using])
+            else:
+                ProdInfo.objects.using(self.using).bulk_create(units, batch_size=self.batch_size)
+            InventorySummary.objects.apply_units(added=units, using=self.using)
+            DailyRollup.objects.apply_units(added=units, using=self.using)
+            bump_versions_on_commit([self.user.pk], self.using)
+        self.result.created += len(units)
+
+    def build_unit(self, row):
+        title = self.products.get(text(row.get('title')), 'Товар')
+        if title is None:
+            raise RowError('Не указан товар')
+        company = self.companies.get(text(row.get('company')), 'Производитель') or title.company
+        return ProdInfo(
+            title=title,
+            account=self.user,
+            company=company,
+            shop=self.shops.get(text(row.get('shop')), 'Магазин'),
+            cost=parse_number(row.get('cost') or 0, 'cost'),
+            weight=parse_number(row.get('weight'), 'weight'),
+            import_key=row['import_key'],
+            time_create=timezone.now(),
+        )
+
+    @staticmethod
+    def copy(units, connection):
+        """Writes the units with PostgreSQL COPY, which is faster than INSERT for large batches"""
+
+        fields = [f for f in ProdInfo._meta.concrete_fields if not f.primary_key]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for unit in units:
+            writer.writerow(['' if value is None else value
+                             for value in (f.get_db_prep_save(getattr(unit, f.attname), connection) for f in fields)])
+        buffer.seek(0)
+        columns = ', '.join(connection.ops.quote_name(f.column) for f in fields)
+        with connection.cursor() as cursor:
+            cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)'
+                               % (connection.ops.quote_name(ProdInfo._meta.db_table), columns), buffer)
+
+
+def import_units(user, file, filename, batch_size=1000, use_copy=True):
+    """
+    Function to import ProdInfo units of the user from a CSV or XLSX file.
+
+    Parameters
+    ----------
+    user: User
+        Owner of the imported units
+    file: file
+        Binary file object, e.g. an uploaded file
+    filename: str
+        Name of the file; its extension selects the format
+    batch_size: int, optional
+        Number of rows inserted at once
+    use_copy: bool, optional
+        Use COPY instead of INSERT when running on PostgreSQL
+
+    Returns
+    ----------
+    result: ImportResult
+        Numbers of created and skipped rows and the list of (row number, message) errors
+    """
+
+    return UnitImporter(user, batch_size, use_copy).run(file, filename)
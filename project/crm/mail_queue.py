@@ -0,0 +1,142 @@
+"""
+Queue of outbound emails stored in the OutgoingEmail model.
+
+Views call enqueue, which only inserts a row, so a slow mail server does not delay the response.
+The send_queued_mail command drains the queue: it claims a batch of due messages and sends them
+over a single connection of settings.EMAIL_BACKEND. A message that fails is retried after
+settings.MAIL_QUEUE_RETRY_DELAY seconds, doubled after every attempt, and marked as failed
+after settings.MAIL_QUEUE_MAX_ATTEMPTS attempts.
+
+A claimed batch is leased: the next attempt of its messages is moved LEASE_SECONDS ahead, so several workers
+can drain the queue without sending a message twice, and a worker that dies leaves its batch to the others.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection as db_connection, transaction
+from django.utils import timezone
+
+from .models import OutgoingEmail
+
+"Time a worker has to send a claimed batch before other workers may claim it, in seconds"
+LEASE_SECONDS = 300
+
+"Maximum delay between two attempts, in seconds"
+MAX_RETRY_DELAY = 6 * 60 * 60
+
+
+def enqueue(subject, body, to, from_email=None):
+    """
+    Function to add an email to the queue.
+
+    Parameters
+    ----------
+    subject, body: str
+        Subject and text of the email
+    to: list
+        Addresses of the recipients
+    from_email: str, optional
+        Address of the sender, settings.DEFAULT_FROM_EMAIL by default
+
+    Returns
+    ----------
+    email: OutgoingEmail
+    """
+
+    return OutgoingEmail.objects.create(subject=subject, body=body, to=list(to),
+                                        from_email=from_email or settings.DEFAULT_FROM_EMAIL)
+
+
+def retry_delay(attempts):
+    """Function to compute the delay before the next attempt after the given number of failed ones"""
+
+    delay = getattr(settings, 'MAIL_QUEUE_RETRY_DELAY', 60) * 2 ** (attempts - 1)
+    return datetime.timedelta(seconds=min(delay, MAX_RETRY_DELAY))
+
+
+def claim(batch_size):
+    """Function to lease a batch of the due messages, the ones waiting longest first"""
+
+    now = timezone.now()
+    with transaction.atomic():
+        due = (OutgoingEmail.objects.filter(status=OutgoingEmail.QUEUED, next_attempt__lte=now)
+               .order_by('next_attempt'))
+        if db_connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        emails = list(due[:batch_size])
+        OutgoingEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+            next_attempt=now + datetime.timedelta(seconds=LEASE_SECONDS))
+    return emails
+
+
+def record_failure(email, error):
+    """Function to schedule the next attempt of a message that was not sent, or give up on it"""
+
+    email.last_error = '%s: %s' % (type(error).__name__, error)
+    if email.attempts >= getattr(settings, 'MAIL_QUEUE_MAX_ATTEMPTS', 5):
+        email.status = OutgoingEmail.FAILED
+    else:
+        email.next_attempt = timezone.now() + retry_delay(email.attempts)
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt'])
+
+
+def send_batch(batch_size=None):
+    """
+    Function to send a batch of the due messages over one connection.
+    If the connection cannot be opened, the attempt counts as failed for every message of the batch.
+
+    Returns
+    ----------
+    result: tuple
+        Numbers of the sent and of the failed messages
+    """
+
+    emails = claim(batch_size or getattr(settings, 'MAIL_QUEUE_BATCH_SIZE', 100))
+    if not emails:
+        return 0, 0
+    for email in emails:
+        email.attempts += 1
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as error:
+        for email in emails:
+            record_failure(email, error)
+        return 0, len(emails)
+
+    sent = 0
+    try:
+        for email in emails:
+            try:
+                EmailMessage(email.subject, email.body, email.from_email, email.to, connection=connection).send()
+            except Exception as error:
+                record_failure(email, error)
+                continue
+            sent += 1
+            email.status, email.time_sent = OutgoingEmail.SENT, timezone.now()
+            email.save(update_fields=['attempts', 'status', 'time_sent'])
+    finally:
+        connection.close()
+    return sent, len(emails) - sent
+
+
+def drain(batch_size=None):
+    """
+    Function to send batches until no message is due.
+
+    Returns
+    ----------
+    result: tuple
+        Numbers of the sent and of the failed messages
+    """
+
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = send_batch(batch_size)
+        if not sent and not failed:
+            return total_sent, total_failed
+        total_sent += sent
+        total_failed += failed
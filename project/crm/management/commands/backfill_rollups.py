@@ -0,0 +1,33 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from crm import sharding
+from crm.models import DailyRollup
+
+
+class Command(BaseCommand):
+    """
+    Recreates the DailyRollup model from ProdInfo, e.g. for units created before the rollups existed.
+    Only the additions of the current units are recreated, the removals booked before are dropped
+    """
+
+    help = 'Backfill the daily inventory rollups from ProdInfo units'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames', metavar='USERNAME',
+                            help='Restrict to the given user. Can be repeated.')
+
+    def handle(self, *args, usernames=None, **options):
+        accounts = None
+        if usernames:
+            accounts = list(User.objects.filter(username__in=usernames))
+            if len(accounts) != len(set(usernames)):
+                found = {user.username for user in accounts}
+                raise CommandError('Unknown users: %s' % ', '.join(sorted(set(usernames) - found)))
+
+        DailyRollup.objects.rebuild(accounts)
+        stored = 0
+        for using, account_ids in sharding.accounts_by_database(accounts):
+            rollups = DailyRollup.objects.using(using)
+            stored += (rollups if account_ids is None else rollups.filter(account__in=account_ids)).count()
+        self.stdout.write(self.style.SUCCESS('Backfilled %d daily rollups' % stored))
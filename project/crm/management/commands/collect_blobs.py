@@ -0,0 +1,84 @@
+import os
+import re
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from crm.models import Blob, Product
+
+BLOB_RE = re.compile(r'^[0-9a-f]{64}\.\w+$')
+VARIANT_RE = re.compile(r'^_\d+w\.\w+$')
+
+
+class Command(BaseCommand):
+    """Deletes the photo blobs of ContentAddressedStorage that no product refers to, with their variants"""
+
+    help = 'Garbage-collect unreferenced photo blobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recount', action='store_true',
+                            help='Recount the references from the Product model and register blobs '
+                                 'found in the storage before collecting.')
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help='Only delete blobs older than this number of seconds, so uploads '
+                                 'that are not committed yet are kept.')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the blobs to delete.')
+
+    def handle(self, *args, recount=False, min_age=3600, dry_run=False, **options):
+        field = Product._meta.get_field('photo')
+        storage = field.storage
+        if recount:
+            self.recount(storage, field.upload_to)
+
+        deleted = 0
+        cutoff = timezone.now() - timedelta(seconds=min_age)
+        for blob in Blob.objects.filter(refs=0, time_create__lt=cutoff):
+            path = storage.path(blob.name)
+            if os.path.exists(path) and os.path.getmtime(path) > time.time() - min_age:
+                continue
+            self.stdout.write(blob.name)
+            if dry_run:
+                continue
+            # A blob acquired again since it was selected is kept
+            if not Blob.objects.filter(pk=blob.pk, refs=0).delete()[0]:
+                continue
+            for name in [blob.name] + self.variants(storage, blob.name):
+                storage.delete(name)
+            deleted += 1
+        self.stdout.write(self.style.SUCCESS('Deleted %d blobs' % deleted))
+
+    @staticmethod
+    def recount(storage, upload_to):
+        """Sets the references of every blob to the number of products using it"""
+
+        counts = Counter(Product.objects.exclude(photo='').values_list('photo', flat=True))
+        with transaction.atomic():
+            Blob.objects.exclude(name__in=counts).update(refs=0)
+            for name, refs in counts.items():
+                Blob.objects.update_or_create(name=name, defaults={'refs': refs})
+
+            known = set(Blob.objects.values_list('name', flat=True))
+            root = storage.path(upload_to)
+            for directory, _, files in os.walk(root):
+                for file in files:
+                    if BLOB_RE.match(file):
+                        name = os.path.relpath(os.path.join(directory, file), storage.location).replace('\\', '/')
+                        if name not in known:
+                            Blob.objects.create(name=name, refs=0)
+
+    @staticmethod
+    def variants(storage, name):
+        """Returns the names of the resized variants generated for the blob"""
+
+        directory, basename = os.path.split(name)
+        root = os.path.splitext(basename)[0]
+        try:
+            _, files = storage.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, file).replace('\\', '/') for file in files
+                if file.startswith(root) and VARIANT_RE.match(file[len(root):])]
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from crm import synthetic
+
+
+class Command(BaseCommand):
+    """Creates synthetic users, companies, shops, products and ProdInfo units with a skewed distribution"""
+
+    help = 'Generate synthetic inventory data for benchmarks and local development'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5, help='Number of users.')
+        parser.add_argument('--companies', type=int, default=10, help='Number of companies.')
+        parser.add_argument('--shops', type=int, default=5, help='Number of shops.')
+        parser.add_argument('--products', type=int, default=50, help='Number of products.')
+        parser.add_argument('--units', type=int, default=1000, help='Number of ProdInfo units.')
+        parser.add_argument('--prefix', default='synthetic',
+                            help='Prefix of the names of the created objects; must differ between runs.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator.')
+
+    def handle(self, *args, users, companies, shops, products, units, prefix, seed, **options):
+        data = synthetic.generate(users=users, companies=companies, shops=shops, products=products, units=units,
+                                  prefix=prefix, seed=seed)
+        self.stdout.write(self.style.SUCCESS(
+            'Created %d users, %d companies, %d shops, %d products and %d units' % (
+                len(data.users), len(data.companies), len(data.shops), len(data.products), data.units)))
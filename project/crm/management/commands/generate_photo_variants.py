@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from crm import images
+from crm.models import Product
+
+
+class Command(BaseCommand):
+    """Generates the resized variants of product photos uploaded before they were introduced"""
+
+    help = 'Generate resized WebP/JPEG variants of product photos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate the variants of all photos, not only of the photos without them.')
+
+    def handle(self, *args, force=False, **options):
+        products = Product.objects.exclude(photo='')
+        if not force:
+            products = products.filter(photo_widths=[])
+
+        futures = [images.schedule_variants(pk, name) for pk, name in products.values_list('pk', 'photo')]
+        for future in filter(None, futures):
+            future.result()
+        self.stdout.write(self.style.SUCCESS('Generated variants of %d photos' % len(futures)))
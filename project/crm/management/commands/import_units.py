@@ -0,0 +1,34 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.importer import import_units
+
+
+class Command(BaseCommand):
+    """Imports ProdInfo units of a user from a CSV or XLSX file"""
+
+    help = 'Import product units of a user from a CSV or XLSX file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='Owner of the imported units.')
+        parser.add_argument('path', help='CSV or XLSX file with the columns title, company, shop, weight, cost.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of rows inserted at once.')
+        parser.add_argument('--no-copy', action='store_false', dest='use_copy',
+                            help='Use INSERT instead of COPY on PostgreSQL.')
+
+    def handle(self, *args, username, path, batch_size=1000, use_copy=True, **options):
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError('Unknown user: %s' % username)
+
+        try:
+            with open(path, 'rb') as file:
+                result = import_units(user, file, path, batch_size=batch_size, use_copy=use_copy)
+        except OSError as error:
+            raise CommandError(error)
+
+        for row, message in result.errors:
+            self.stderr.write('row %s: %s' % (row, message) if row else message)
+        self.stdout.write(self.style.SUCCESS('Imported %d rows, skipped %d already imported, %d errors'
+                                             % (result.created, result.skipped, len(result.errors))))
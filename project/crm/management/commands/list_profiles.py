@@ -0,0 +1,47 @@
+import io
+import os
+import pstats
+
+from django.core.management.base import BaseCommand, CommandError
+
+from crm import profiling
+
+
+class Command(BaseCommand):
+    """Lists the request profiles captured by ProfilingMiddleware or summarises one of them"""
+
+    help = 'List captured request profiles, or show the slowest functions and queries of one profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', nargs='?', help='Show the summary of this profile.')
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Number of profiles listed, or of functions and queries shown.')
+        parser.add_argument('--sort', default='cumulative', choices=('cumulative', 'tottime', 'ncalls'),
+                            help='Order of the functions of a profile.')
+
+    def handle(self, *args, name=None, limit=20, sort='cumulative', **options):
+        profiles = profiling.load()
+        if name is None:
+            if not profiles:
+                self.stdout.write('No profiles in %s' % profiling.get_directory())
+            for profile in profiles[:limit]:
+                self.stdout.write('%s  %8.1f ms  %3d queries %8.1f ms  %s %s %s  [%s, %s]' % (
+                    profile['name'], profile['duration_ms'], profile['sql_count'], profile['sql_time_ms'],
+                    profile['status'], profile['method'], profile['path'], profile['trigger'], profile['user']))
+            return
+
+        profile = next((profile for profile in profiles if profile['name'] == name), None)
+        if profile is None:
+            raise CommandError('Unknown profile %s' % name)
+        self.stdout.write('%s %s by %s: %s, %.1f ms, %d queries in %.1f ms' % (
+            profile['method'], profile['path'], profile['user'], profile['status'], profile['duration_ms'],
+            profile['sql_count'], profile['sql_time_ms']))
+
+        output = io.StringIO()
+        stats = pstats.Stats(os.path.join(profiling.get_directory(), name + '.prof'), stream=output)
+        stats.sort_stats(sort).print_stats(limit)
+        self.stdout.write(output.getvalue())
+
+        self.stdout.write('Slowest queries:')
+        for query in sorted(profile['queries'], key=lambda query: -query['time_ms'])[:limit]:
+            self.stdout.write('%8.3f ms  %s' % (query['time_ms'], query['sql']))
@@ -0,0 +1,48 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from crm import sharding
+
+
+class Command(BaseCommand):
+    """Moves the ProdInfo units of a user and their totals to another shard, see crm.sharding"""
+
+    help = 'Move the inventory of a user to another database shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', nargs='?', help='User to move.')
+        parser.add_argument('database', nargs='?', help='Alias of the shard from PRODINFO_SHARDS.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of units copied at once.')
+        parser.add_argument('--pin-all', action='store_true',
+                            help='Record the current shard of every user, before the list of shards is changed.')
+        parser.add_argument('--sync-catalogue', action='store_true',
+                            help='Copy the users, companies, shops and products to the shards, e.g. to a new one.')
+
+    def handle(self, *args, username=None, database=None, batch_size=1000, pin_all=False, sync_catalogue=False,
+               **options):
+        if not sharding.get_shards():
+            raise CommandError('Sharding is disabled: PRODINFO_SHARDS is empty')
+
+        if pin_all:
+            self.stdout.write(self.style.SUCCESS('Pinned %d users to their shards' % sharding.pin_accounts()))
+        if sync_catalogue:
+            self.stdout.write(self.style.SUCCESS('Copied %d catalogue objects' % sharding.sync_catalogue(batch_size)))
+        if pin_all or sync_catalogue:
+            return
+
+        if not username or not database:
+            raise CommandError('Specify a user and a shard')
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError('Unknown user: %s' % username)
+        if database not in sharding.get_shards():
+            raise CommandError('Unknown shard: %s' % database)
+
+        source = sharding.db_for_account(user)
+        if source == database:
+            self.stdout.write('%s is already on %s' % (username, database))
+            return
+        moved = sharding.move_account(user, database, batch_size)
+        self.stdout.write(self.style.SUCCESS('Moved %d units of %s from %s to %s'
+                                             % (moved, username, source, database)))
@@ -0,0 +1,76 @@
+import math
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from crm import sharding
+from crm.cache import bump_versions
+from crm.models import InventorySummary
+
+
+class Command(BaseCommand):
+    """Rebuilds the InventorySummary model from ProdInfo or, with --check, reports rows that drifted from it"""
+
+    help = 'Rebuild the per-user inventory summary from ProdInfo units'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames', metavar='USERNAME',
+                            help='Restrict to the given user. Can be repeated.')
+        parser.add_argument('--check', action='store_true',
+                            help='Only compare the stored summary with ProdInfo and report the differences.')
+
+    def handle(self, *args, usernames=None, check=False, **options):
+        accounts = None
+        if usernames:
+            accounts = list(User.objects.filter(username__in=usernames))
+            if len(accounts) != len(set(usernames)):
+                found = {user.username for user in accounts}
+                raise CommandError('Unknown users: %s' % ', '.join(sorted(set(usernames) - found)))
+
+        if check:
+            drift = self.find_drift(accounts)
+            for line in drift:
+                self.stdout.write(line)
+            if drift:
+                raise CommandError('%d summary rows differ from ProdInfo' % len(drift))
+            self.stdout.write(self.style.SUCCESS('Inventory summary is consistent'))
+            return
+
+        InventorySummary.objects.rebuild(accounts)
+        bump_versions([user.pk for user in accounts] if accounts else User.objects.values_list('pk', flat=True))
+        stored = sum(len(self.stored_rows(using, account_ids))
+                     for using, account_ids in sharding.accounts_by_database(accounts))
+        self.stdout.write(self.style.SUCCESS('Rebuilt %d summary rows' % stored))
+
+    @staticmethod
+    def stored_rows(using, account_ids=None):
+        """Function to load the stored summary rows of the accounts of a database, keyed by account and product"""
+
+        stored = InventorySummary.objects.using(using)
+        if account_ids is not None:
+            stored = stored.filter(account__in=account_ids)
+        return {(row['account'], row['product']): row
+                for row in stored.values('account', 'product', 'count', 'weight', 'not_full', 'cost')}
+
+    @staticmethod
+    def find_drift(accounts=None):
+        """Function to compare stored summary rows with the aggregate computed from ProdInfo, on every shard"""
+
+        fields = ('count', 'weight', 'not_full', 'cost')
+        drift = []
+        for using, account_ids in sharding.accounts_by_database(accounts):
+            stored = Command.stored_rows(using, account_ids)
+            for row in InventorySummary.objects.computed(account_ids, using):
+                key = (row['account'], row['product'])
+                current = stored.pop(key, None)
+                if current is None:
+                    drift.append('missing: account=%s product=%s' % key)
+                    continue
+                changed = [field for field in fields
+                           if not math.isclose(current[field], row[field], rel_tol=1e-9, abs_tol=1e-6)]
+                if changed:
+                    drift.append('differs: account=%s product=%s ' % key + ', '.join(
+                        '%s %s != %s' % (field, current[field], row[field]) for field in changed))
+            for key in stored:
+                drift.append('extra: account=%s product=%s' % key)
+        return drift
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from crm import search
+
+
+class Command(BaseCommand):
+    """Recreates the search index from the Product, Company and Shop models"""
+
+    help = 'Rebuild the full-text search index of products and shops'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of objects indexed at once.')
+
+    def handle(self, *args, batch_size=1000, **options):
+        search.rebuild(batch_size)
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from crm import captcha_pool
+
+
+class Command(BaseCommand):
+    """Deletes the expired captcha challenges and refills the pool, once or periodically as a background worker"""
+
+    help = 'Refill the pool of pre-rendered captcha challenges'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=None,
+                            help='Number of available challenges to keep. Defaults to CAPTCHA_POOL_SIZE.')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running and refill the pool every given number of seconds.')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of challenges written in a transaction.')
+
+    def handle(self, *args, size=None, interval=None, batch_size=100, **options):
+        while True:
+            deleted = captcha_pool.cleanup()
+            created = captcha_pool.refill(size, batch_size)
+            self.stdout.write('Deleted %d expired challenges, generated %d' % (deleted, created))
+            if interval is None:
+                return
+            time.sleep(interval)
@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from crm import benchmarks
+
+
+class Command(BaseCommand):
+    """
+    Measures latency and query counts of the crm views at several sizes of synthetic data
+    and fails if the query counts grow with the size. The data is rolled back after each size.
+    """
+
+    help = 'Benchmark the crm views on synthetic data and write the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=list(benchmarks.SIZES),
+                            help='Numbers of ProdInfo units of the benchmarked data.')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of measurements with a warm cache.')
+        parser.add_argument('--scenario', action='append', dest='scenarios', choices=list(benchmarks.SCENARIOS),
+                            help='Run only the given scenario. Can be repeated.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the data generator.')
+        parser.add_argument('--output', help='Write the results to this file instead of the standard output.')
+
+    def handle(self, *args, sizes, repeat, scenarios=None, seed=0, output=None, **options):
+        # The test environment allows the 'testserver' host of the test client and turns off DEBUG,
+        # so the debug toolbar does not take part in the measurements
+        setup_test_environment(debug=False)
+        try:
+            results = benchmarks.run(sizes, repeat, scenarios, seed)
+        finally:
+            teardown_test_environment()
+
+        errors = benchmarks.check_query_growth(results)
+        report = json.dumps({'results': results, 'errors': errors}, indent=2)
+        if output:
+            with open(output, 'w') as file:
+                file.write(report)
+        else:
+            self.stdout.write(report)
+        if errors:
+            raise CommandError('Query counts grow with the data size:\n' + '\n'.join(errors))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from crm import mail_queue
+
+
+class Command(BaseCommand):
+    """Sends the queued emails, once or periodically as a background worker"""
+
+    help = 'Send the emails of the outbound mail queue in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Number of emails sent over one connection. Defaults to MAIL_QUEUE_BATCH_SIZE.')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running and check the queue every given number of seconds.')
+
+    def handle(self, *args, batch_size=None, interval=None, **options):
+        while True:
+            sent, failed = mail_queue.drain(batch_size)
+            if sent or failed or interval is None:
+                self.stdout.write('Sent %d emails, %d failed' % (sent, failed))
+            if interval is None:
+                return
+            time.sleep(interval)
@@ -0,0 +1,218 @@
+"""
+Lightweight request instrumentation that can stay enabled in production.
+
+MetricsMiddleware measures every request: the number and the total time of the SQL queries (through
+an execute wrapper installed on every database connection when it is opened), the time spent rendering templates
+(through the TimedDjangoTemplates backend) and the total latency. The values are sent to the browser
+in the Server-Timing header and aggregated into histograms labelled by the URL name of the view,
+which the /metrics endpoint serves in the Prometheus text format.
+
+The histograms live in the memory of the process; with several worker processes each one reports
+its own aggregates, so the endpoint should be scraped per process or the series summed by the scraper.
+"""
+
+import asyncio
+import bisect
+import time
+from contextvars import ContextVar
+from threading import Lock
+
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+"Upper bounds of the histogram buckets of durations, in seconds"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+"Upper bounds of the histogram buckets of query counts"
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+_current = ContextVar('crm_request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Measurements of a single request"""
+
+    __slots__ = ('sql_count', 'sql_time', 'template_time', 'template_depth')
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+
+
+class Histogram:
+    """Thread-safe cumulative histogram with a set of label values per series"""
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self._lock = Lock()
+
+    def observe(self, label, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(label)
+            if series is None:
+                series = self.series[label] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self.series.clear()
+
+    def expose(self, label_name):
+        """Returns the lines of the histogram in the Prometheus text format"""
+
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = sorted((label, (list(counts), total, count)) for label, (counts, total, count)
+                            in self.series.items())
+        for label, (counts, total, count) in series:
+            label = escape_label(label)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket{%s="%s",le="%s"} %d' % (self.name, label_name, label, bound, cumulative))
+            lines.append('%s_sum{%s="%s"} %s' % (self.name, label_name, label, repr(float(total))))
+            lines.append('%s_count{%s="%s"} %d' % (self.name, label_name, label, count))
+        return lines
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_DURATION = Histogram('crm_request_duration_seconds', 'Total time of handling a request.',
+                             DURATION_BUCKETS)
+SQL_QUERIES = Histogram('crm_request_sql_queries', 'Number of SQL queries made by a request.', QUERY_BUCKETS)
+SQL_DURATION = Histogram('crm_request_sql_duration_seconds', 'Time of the SQL queries of a request.',
+                         DURATION_BUCKETS)
+TEMPLATE_DURATION = Histogram('crm_request_template_duration_seconds', 'Time of rendering templates for a request.',
+                              DURATION_BUCKETS)
+
+HISTOGRAMS = (REQUEST_DURATION, SQL_QUERIES, SQL_DURATION, TEMPLATE_DURATION)
+
+
+def clear():
+    """Function to reset all the aggregated metrics"""
+
+    for histogram in HISTOGRAMS:
+        histogram.clear()
+
+
+def expose():
+    """Function to render all the aggregated metrics in the Prometheus text format"""
+
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.expose('view'))
+    return '\n'.join(lines) + '\n'
+
+
+def install_sql_wrapper(sender, connection, **kwargs):
+    """
+    Adds sql_wrapper to a database connection when it is opened. The wrapper stays installed for good,
+    so queries made in the threads of the asynchronous ORM are counted as well:
+    the measurements of the request are found through a context variable, which these threads inherit.
+    """
+
+    if sql_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(sql_wrapper)
+
+
+def sql_wrapper(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.sql_time += time.perf_counter() - start
+        metrics.sql_count += 1
+
+
+class TimedTemplate(Template):
+    """Template of the Django backend measuring its rendering time for the current request"""
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return super().render(context, request)
+        # Templates rendered while rendering another one are already included in its time
+        metrics.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_depth -= 1
+            if not metrics.template_depth:
+                metrics.template_time += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend returning templates that report their rendering time to MetricsMiddleware"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class MetricsMiddleware:
+    """Measures every request, adds the Server-Timing header and aggregates the measurements by URL name"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Mark the middleware as asynchronous for asynchronous handlers, like MiddlewareMixin does
+        self._is_coroutine = asyncio.coroutines._is_coroutine if asyncio.iscoroutinefunction(get_response) else None
+
+    def __call__(self, request):
+        if self._is_coroutine:
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.record(request, response, metrics, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.record(request, response, metrics, time.perf_counter() - start)
+
+    @staticmethod
+    def record(request, response, metrics, duration):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name if match else None) or 'unmatched'
+        REQUEST_DURATION.observe(view, duration)
+        SQL_QUERIES.observe(view, metrics.sql_count)
+        SQL_DURATION.observe(view, metrics.sql_time)
+        TEMPLATE_DURATION.observe(view, metrics.template_time)
+
+        response['Server-Timing'] = ', '.join((
+            'db;dur=%.1f;desc="%d queries"' % (metrics.sql_time * 1000, metrics.sql_count),
+            'tpl;dur=%.1f' % (metrics.template_time * 1000),
+            'total;dur=%.1f' % (duration * 1000),
+        ))
+        return response
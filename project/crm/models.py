@@ -1,8 +1,108 @@
-from django.db import models
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, TruncDate
 from django.urls import reverse
+from django.utils import timezone
 from pytils.translit import slugify
 
-from .utils2 import OverwriteStorage
+from . import db_router, sharding
+from .utils2 import ContentAddressedStorage
+
+
+def weight_tolerances():
+    """Function to read the absolute and the relative deviation from ref_weight a full unit may have"""
+
+    return (float(getattr(settings, 'NOT_FULL_ABS_TOLERANCE', 0)),
+            float(getattr(settings, 'NOT_FULL_REL_TOLERANCE', 0)))
+
+
+def is_not_full(weight, ref_weight):
+    """
+    Function to check whether a unit deviates from the reference weight by more than the tolerance,
+    the larger of NOT_FULL_ABS_TOLERANCE and NOT_FULL_REL_TOLERANCE * ref_weight.
+    The bounds are computed like in not_full_condition, so Python and the database agree on the boundary
+    """
+
+    abs_tolerance, rel_tolerance = weight_tolerances()
+    tolerance = max(abs_tolerance, rel_tolerance * ref_weight)
+    return weight > ref_weight + tolerance or weight < ref_weight - tolerance
+
+
+def not_full_condition(weight, ref_weight):
+    """
+    Function to build the filter of the units that are not full, see is_not_full.
+
+    Parameters
+    ----------
+    weight: str
+        Lookup of the weight of a unit
+    ref_weight: float or F
+        Reference weight, a number or an expression like F('title__ref_weight')
+    """
+
+    abs_tolerance, rel_tolerance = weight_tolerances()
+    if isinstance(ref_weight, (int, float)):
+        tolerance = max(abs_tolerance, rel_tolerance * ref_weight)
+    elif rel_tolerance:
+        tolerance = Greatest(Value(abs_tolerance), ref_weight * Value(rel_tolerance))
+    else:
+        tolerance = Value(abs_tolerance)
+    return Q(**{weight + '__gt': ref_weight + tolerance}) | Q(**{weight + '__lt': ref_weight - tolerance})
+
+
+def increment(manager, lookups, delta):
+    """
+    Function to add the delta to the counters of the row selected by the lookups, creating the row if it is missing.
+    When a concurrent transaction creates the same row first, the insert fails on the unique constraint
+    inside a savepoint and the row is updated instead.
+
+    Parameters
+    ----------
+    manager: Manager
+        Manager of the model, bound to the database of the row
+    lookups: dict
+        Values of the unique fields of the row
+    delta: dict
+        Values to add to the counters
+
+    Returns
+    ----------
+    rows: QuerySet
+        The selected row
+    """
+
+    rows = manager.filter(**lookups)
+    changes = {field: F(field) + value for field, value in delta.items()}
+    if not rows.update(**changes):
+        try:
+            with transaction.atomic(using=manager.db):
+                manager.create(**lookups, **delta)
+        except IntegrityError:
+            rows.update(**changes)
+    return rows
+
+
+class ProdInfoQuerySet(models.QuerySet):
+    """QuerySet of ProdInfo units keeping the InventorySummary and DailyRollup models up to date on bulk deletion"""
+
+    def delete(self):
+        """
+        Function to delete the selected units and subtract them from the InventorySummary and DailyRollup models
+        atomically, like ProdInfo.delete() does for a single unit, e.g. for the bulk deletion of the admin.
+        The units are deleted by a cascade of Product or User deletion without it, together with their totals.
+        """
+
+        with transaction.atomic(using=self.db):
+            units = list(self.select_related('title').select_for_update(of=('self',)))
+            InventorySummary.objects.apply_units(removed=units, using=self.db)
+            DailyRollup.objects.apply_units(removed=units, using=self.db)
+            db_router.mark_written()
+            return ProdInfo._base_manager.using(self.db).filter(pk__in=[unit.pk for unit in units]).delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
 
 class ProdInfo(models.Model):
     """Model contains information about each product unit from the Product model."""
@@ -14,10 +114,59 @@ class ProdInfo(models.Model):
     cost = models.FloatField(default=0)
     weight = models.FloatField()
     time_create = models.DateTimeField(auto_now_add=True)
+    import_key = models.CharField(max_length=80, null=True, blank=True, editable=False)
+
+    objects = ProdInfoQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'import_key'], name='unique_prodinfo_import_key'),
+        ]
+        indexes = [
+            # Keyset pagination of the units of a product on the Detail page
+            models.Index(fields=['account', 'title', 'time_create', 'id'], name='prodinfo_detail_keyset'),
+        ]
 
     def get_absolute_url(self):
         return reverse('edit_prodinfo', kwargs={'prodinfo_id': self.pk})
 
+    def database(self, using=None):
+        """
+        Function to find the database of the unit: the shard of its account, see crm.sharding.
+        The unit and its totals are always written there, so another database given by the caller is an error.
+        """
+
+        database = sharding.db_for_account(self.account_id)
+        if using is not None and using != database:
+            raise ValueError('The units of account %s are stored on %s, not on %s' % (self.account_id, database, using))
+        return database
+
+    def save(self, *args, **kwargs):
+        """Function to save the unit and apply the change to the InventorySummary and DailyRollup models atomically"""
+
+        using = kwargs['using'] = self.database(kwargs.get('using'))
+        db_router.mark_written()
+        with transaction.atomic(using=using):
+            previous = None
+            if self.pk:
+                previous = (ProdInfo.objects.using(using).select_for_update(of=('self',)).select_related('title')
+                            .filter(pk=self.pk).first())
+            super(ProdInfo, self).save(*args, **kwargs)
+            InventorySummary.objects.apply_units(added=(self,), removed=(previous,) if previous else (), using=using)
+            # An edit is booked on the current day, a new unit on the day it was created on
+            DailyRollup.objects.apply_units(added=(self,), removed=(previous,) if previous else (),
+                                            day=timezone.localdate() if previous else None, using=using)
+
+    def delete(self, *args, **kwargs):
+        """Function to delete the unit and subtract it from the InventorySummary and DailyRollup models atomically"""
+
+        using = kwargs['using'] = self.database(kwargs.get('using'))
+        db_router.mark_written()
+        with transaction.atomic(using=using):
+            InventorySummary.objects.apply_units(removed=(self,), using=using)
+            DailyRollup.objects.apply_units(removed=(self,), using=using)
+            return super(ProdInfo, self).delete(*args, **kwargs)
+
 
 class Company(models.Model):
     """Model containing unique manufacturing companies"""
@@ -61,7 +210,8 @@ class Product(models.Model):
     slug = models.SlugField(max_length=150, unique=True, db_index=True, verbose_name='URL')
     company = models.ForeignKey('Company', null=True, on_delete=models.SET_NULL)
     ref_weight = models.FloatField()
-    photo = models.ImageField(storage=OverwriteStorage(), upload_to="images/", blank=True)
+    photo = models.ImageField(storage=ContentAddressedStorage(), upload_to="images/", blank=True)
+    photo_widths = models.JSONField(default=list, blank=True, editable=False)
     time_create = models.DateTimeField(auto_now_add=True)
     time_update = models.DateTimeField(auto_now=True)
 
@@ -69,10 +219,19 @@ class Product(models.Model):
         return self.title
 
     def save(self, *args, **kwargs):
-        """Function to create a slug from the name, which is used to build the route url"""
+        """
+        Function to create a slug from the name, which is used to build the route url.
+        If ref_weight has changed, the not_full counters of this product are recomputed.
+        """
 
         self.slug = slugify(self.title)
-        super(Product, self).save(*args, **kwargs)
+        with transaction.atomic():
+            old_ref_weight = None
+            if self.pk:
+                old_ref_weight = Product.objects.filter(pk=self.pk).values_list('ref_weight', flat=True).first()
+            super(Product, self).save(*args, **kwargs)
+            if old_ref_weight is not None and old_ref_weight != self.ref_weight:
+                InventorySummary.objects.recompute_not_full(self)
 
     def get_absolute_url(self):
         return reverse('detail', kwargs={'product_slug': self.slug})
@@ -80,3 +239,326 @@ class Product(models.Model):
     class Meta:
         ordering = ['title']
 
+
+class InventorySummaryManager(models.Manager):
+    """Manager maintaining the InventorySummary rows incrementally and rebuilding them from ProdInfo"""
+
+    def apply_units(self, added=(), removed=(), using=None):
+        """
+        Function to add the given ProdInfo units to the summary and subtract the removed ones.
+        Changes are grouped by account and product, so each affected summary row is updated once.
+
+        Parameters
+        ----------
+        added: iterable
+            ProdInfo objects that were created or are the new state of edited objects
+        removed: iterable
+            ProdInfo objects that were deleted or are the previous state of edited objects
+        using: str, optional
+            Database of the units, the shard of each account by default
+        """
+
+        deltas = {}
+        for units, sign in ((added, 1), (removed, -1)):
+            for unit in units:
+                delta = deltas.setdefault((unit.account_id, unit.title_id),
+                                          {'count': 0, 'weight': 0, 'not_full': 0, 'cost': 0})
+                delta['count'] += sign
+                delta['weight'] += sign * unit.weight
+                delta['not_full'] += sign * is_not_full(unit.weight, unit.title.ref_weight)
+                delta['cost'] += sign * unit.cost
+
+        for (account_id, product_id), delta in deltas.items():
+            if not any(delta.values()):
+                continue
+            rows = increment(self.db_manager(using or sharding.db_for_account(account_id)),
+                             {'account_id': account_id, 'product_id': product_id}, delta)
+            if delta['count'] < 0:
+                rows.filter(count__lte=0).delete()
+
+    def recompute_not_full(self, product):
+        """Function to recount the units not matching ref_weight for a single product, for all accounts"""
+
+        not_full = (ProdInfo.objects.filter(not_full_condition('weight', product.ref_weight),
+                                            account=OuterRef('account'), title=product)
+                    .values('title')
+                    .annotate(not_full=Count('pk'))
+                    .values('not_full'))
+        for using in sharding.all_databases():
+            self.using(using).filter(product=product).update(not_full=Coalesce(Subquery(not_full), 0))
+
+    def computed(self, accounts=None, using=None):
+        """
+        Function to aggregate the summary rows directly from the ProdInfo model.
+
+        Parameters
+        ----------
+        accounts: iterable, optional
+            Users or user ids to restrict the aggregate to
+        using: str, optional
+            Database to aggregate the units of, see crm.sharding
+
+        Returns
+        ----------
+        rows: QuerySet
+            Dicts with the keys 'account', 'product', 'count', 'weight', 'not_full' and 'cost'
+        """
+
+        units = ProdInfo.objects.using(using)
+        if accounts is not None:
+            units = units.filter(account__in=accounts)
+        # 'not_full' goes before 'weight' so that its filter refers to the field, not to the Sum alias
+        return (units.values('account', product=F('title'))
+                .annotate(count=Count('pk'),
+                          not_full=Count('pk', filter=not_full_condition('weight', F('title__ref_weight'))),
+                          weight=Sum('weight'),
+                          cost=Sum('cost'))
+                .order_by())
+
+    def rebuild(self, accounts=None, using=None):
+        """
+        Function to replace the summary rows with ones aggregated from the ProdInfo model, on every shard.
+
+        Parameters
+        ----------
+        accounts: iterable, optional
+            Users or user ids to rebuild the rows of, all of them by default
+        using: str, optional
+            Database to rebuild the rows on instead of the one of each account, see crm.sharding.move_account
+        """
+
+        groups = sharding.accounts_by_database(accounts)
+        if using is not None:
+            groups = [(using, None if accounts is None else [getattr(account, 'pk', account) for account in accounts])]
+        for using, account_ids in groups:
+            with transaction.atomic(using=using):
+                rows = self.using(using)
+                rows = rows.all() if account_ids is None else rows.filter(account__in=account_ids)
+                rows.delete()
+                self.db_manager(using).bulk_create(
+                    (InventorySummary(account_id=row.pop('account'), product_id=row.pop('product'), **row)
+                     for row in self.computed(account_ids, using)), batch_size=1000)
+
+
+class InventorySummary(models.Model):
+    """
+    Model containing the totals of ProdInfo units for each user and product. Rows are updated by ProdInfo.save(),
+    ProdInfo.delete() and the delete() of its QuerySet; the rebuild_inventory_summary command recreates them
+    from scratch. QuerySet.update() of the units bypasses them, so the summary has to be rebuilt after it.
+    """
+
+    account = models.ForeignKey('auth.User', on_delete=models.CASCADE)
+    product = models.ForeignKey('Product', on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+    weight = models.FloatField(default=0)
+    not_full = models.IntegerField(default=0)
+    cost = models.FloatField(default=0)
+
+    objects = InventorySummaryManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'product'], name='unique_inventory_summary'),
+        ]
+
+
+"Counters of DailyRollup: the units added on the day and the units removed on it"
+ROLLUP_FIELDS = ('count', 'weight', 'cost', 'removed_count', 'removed_weight', 'removed_cost')
+
+
+class DailyRollupManager(models.Manager):
+    """Manager maintaining the DailyRollup rows incrementally and rebuilding them from ProdInfo"""
+
+    def apply_units(self, added=(), removed=(), day=None, using=None):
+        """
+        Function to book the given ProdInfo units in the rollups: the added units on the day they were created,
+        the removed ones on the current day, so the rollups of the past days do not change.
+
+        Parameters
+        ----------
+        added: iterable
+            ProdInfo objects that were created or are the new state of edited objects
+        removed: iterable
+            ProdInfo objects that were deleted or are the previous state of edited objects
+        day: date, optional
+            Day to book all the units on instead, e.g. the current day for an edit
+        using: str, optional
+            Database of the units, the shard of each account by default
+        """
+
+        removal_day = day or timezone.localdate()
+        deltas = {}
+        for units, prefix in ((added, ''), (removed, 'removed_')):
+            for unit in units:
+                unit_day = removal_day if prefix else day or timezone.localdate(unit.time_create)
+                delta = deltas.setdefault((unit.account_id, unit.title_id, unit_day), dict.fromkeys(ROLLUP_FIELDS, 0))
+                delta[prefix + 'count'] += 1
+                delta[prefix + 'weight'] += unit.weight
+                delta[prefix + 'cost'] += unit.cost
+
+        for (account_id, product_id, day), delta in deltas.items():
+            increment(self.db_manager(using or sharding.db_for_account(account_id)),
+                      {'account_id': account_id, 'product_id': product_id, 'day': day}, delta)
+
+    def computed(self, accounts=None, using=None):
+        """
+        Function to aggregate the rollups directly from the ProdInfo model, by the local day of time_create.
+        The units removed before are not known any more, so the rollups hold the additions of the current units only.
+        The parameters are the ones of InventorySummaryManager.computed.
+
+        Returns
+        ----------
+        rows: QuerySet
+            Dicts with the keys 'account', 'product', 'day', 'count', 'weight' and 'cost'
+        """
+
+        units = ProdInfo.objects.using(using)
+        if accounts is not None:
+            units = units.filter(account__in=accounts)
+        return (units.values('account', product=F('title'), day=TruncDate('time_create'))
+                .annotate(count=Count('pk'), weight=Sum('weight'), cost=Sum('cost'))
+                .order_by())
+
+    def rebuild(self, accounts=None, using=None):
+        """
+        Function to replace the rollups with ones aggregated from the ProdInfo model, on every shard.
+        The removals booked before are dropped with the rows, see computed.
+
+        Parameters
+        ----------
+        accounts: iterable, optional
+            Users or user ids to rebuild the rows of, all of them by default
+        using: str, optional
+            Database to rebuild the rows on instead of the one of each account, see crm.sharding.move_account
+        """
+
+        groups = sharding.accounts_by_database(accounts)
+        if using is not None:
+            groups = [(using, None if accounts is None else [getattr(account, 'pk', account) for account in accounts])]
+        for using, account_ids in groups:
+            with transaction.atomic(using=using):
+                rows = self.using(using)
+                rows = rows.all() if account_ids is None else rows.filter(account__in=account_ids)
+                rows.delete()
+                self.db_manager(using).bulk_create(
+                    (DailyRollup(account_id=row.pop('account'), product_id=row.pop('product'), **row)
+                     for row in self.computed(account_ids, using)), batch_size=1000)
+
+
+class DailyRollup(models.Model):
+    """
+    Model containing the totals of the ProdInfo units of each user and product added and removed on each day.
+    A unit is added on the day it was created on; a deleted unit is removed on the day of the deletion,
+    and an edited one is removed and added again in its new state on the day of the edit. The running total
+    of the added minus the removed units is the stock of the user at the end of each day.
+    Rows are updated by ProdInfo.save(), ProdInfo.delete() and the delete() of its QuerySet; the backfill_rollups
+    command recreates them from the current units.
+    """
+
+    account = models.ForeignKey('auth.User', on_delete=models.CASCADE)
+    product = models.ForeignKey('Product', on_delete=models.CASCADE)
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+    weight = models.FloatField(default=0)
+    cost = models.FloatField(default=0)
+    removed_count = models.IntegerField(default=0)
+    removed_weight = models.FloatField(default=0)
+    removed_cost = models.FloatField(default=0)
+
+    objects = DailyRollupManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'product', 'day'], name='unique_daily_rollup'),
+        ]
+        indexes = [
+            models.Index(fields=['account', 'day'], name='daily_rollup_account_day'),
+        ]
+
+
+class AccountShard(models.Model):
+    """
+    Model containing the database of the accounts moved away from the shard chosen by their hash,
+    see crm.sharding. Rows are written by the move_account_shard command and stay on the default database.
+    """
+
+    account = models.OneToOneField('auth.User', on_delete=models.CASCADE, related_name='shard')
+    database = models.CharField(max_length=100)
+    time_update = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s: %s' % (self.account_id, self.database)
+
+
+class BlobManager(models.Manager):
+    """Manager counting references to the files of ContentAddressedStorage"""
+
+    def acquire(self, name):
+        """Function to add a reference to the blob, registering it if it is new"""
+
+        if name and not self.filter(name=name).update(refs=F('refs') + 1):
+            self.create(name=name, refs=1)
+
+    def release(self, name):
+        """Function to remove a reference to the blob; blobs without references are deleted by collect_blobs"""
+
+        if name:
+            self.filter(name=name, refs__gt=0).update(refs=F('refs') - 1)
+
+
+class Blob(models.Model):
+    """Model containing the number of objects referring to each file of ContentAddressedStorage"""
+
+    name = models.CharField(max_length=255, unique=True)
+    refs = models.PositiveIntegerField(default=0)
+    time_create = models.DateTimeField(auto_now_add=True)
+
+    objects = BlobManager()
+
+    def __str__(self):
+        return self.name
+
+
+class CaptchaPoolEntry(models.Model):
+    """
+    Model containing a captcha challenge generated in advance with its rendered image, see crm.captcha_pool.
+    An entry is taken by a single form; it is deleted with its CaptchaStore row once solved or expired.
+    """
+
+    store = models.OneToOneField('captcha.CaptchaStore', on_delete=models.CASCADE, related_name='pool_entry')
+    image = models.BinaryField()
+    expiration = models.DateTimeField()
+    taken = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['taken', 'expiration'], name='captcha_pool_available'),
+        ]
+
+
+class OutgoingEmail(models.Model):
+    """
+    Model containing the queue of outbound emails. Views only add messages to the queue,
+    the send_queued_mail command sends them, see crm.mail_queue.
+    """
+
+    QUEUED = 'queued'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = ((QUEUED, 'В очереди'), (SENT, 'Отправлено'), (FAILED, 'Не отправлено'))
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    to = models.JSONField(default=list)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    time_create = models.DateTimeField(auto_now_add=True)
+    time_sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='outgoing_email_due'),
+        ]
@@ -0,0 +1,211 @@
+"""
+Opt-in profiling of single requests with cProfile.
+
+A request is profiled when a staff user asks for it with the X-Profile header or the _profile query parameter,
+or when it is picked by the sampling of settings.PROFILING_SAMPLE_RATE; a sampled request is kept only if it
+took longer than settings.PROFILING_SLOW_THRESHOLD seconds. Every kept profile is written to
+settings.PROFILING_DIR as a pstats file (readable by pstats, snakeviz or flameprof) and a JSON file with
+the request details and the SQL queries it made. Only the settings.PROFILING_MAX_FILES newest profiles are kept.
+
+The list_profiles command lists and summarises the captured profiles.
+"""
+
+import asyncio
+import cProfile
+import json
+import os
+import random
+import time
+from contextvars import ContextVar
+from threading import Lock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_PARAMETER = '_profile'
+
+"Maximum length of a captured SQL statement"
+SQL_MAX_LENGTH = 2000
+
+_rotate_lock = Lock()
+_current_log = ContextVar('crm_profiling_queries', default=None)
+
+
+def get_directory():
+    return getattr(settings, 'PROFILING_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+class QueryLog:
+    """SQL statements of a profiled request with their durations"""
+
+    def __init__(self):
+        self.queries = []
+
+
+def install_sql_wrapper(sender, connection, **kwargs):
+    """Adds sql_wrapper to a database connection when it is opened, see crm.metrics.install_sql_wrapper"""
+
+    if sql_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(sql_wrapper)
+
+
+def sql_wrapper(execute, sql, params, many, context):
+    query_log = _current_log.get()
+    if query_log is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        query_log.queries.append({
+            'sql': sql[:SQL_MAX_LENGTH],
+            'many': many,
+            'time_ms': round((time.perf_counter() - start) * 1000, 3),
+            'alias': context['connection'].alias,
+        })
+
+
+def requested(request):
+    """Function to check whether a staff user asked to profile the request"""
+
+    # The user is loaded lazily, so it is only looked up for the requests asking for a profile
+    if not (request.META.get(PROFILE_HEADER) or request.GET.get(PROFILE_PARAMETER)):
+        return False
+    user = getattr(request, 'user', None)
+    return bool(user and user.is_staff)
+
+
+def sampled():
+    rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+def save(profiler, query_log, request, response, duration, trigger):
+    """
+    Function to write a captured profile to the profiles directory and remove the oldest profiles beyond the limit.
+
+    Returns
+    ----------
+    name: str
+        Name of the profile, shared by its .prof and .json files
+    """
+
+    directory = get_directory()
+    os.makedirs(directory, exist_ok=True)
+    match = getattr(request, 'resolver_match', None)
+    view = (match.view_name if match else None) or 'unmatched'
+    name = '%s-%s-%s' % (timezone.now().strftime('%Y%m%d-%H%M%S-%f'), view.replace(':', '-'),
+                         get_random_string(6).lower())
+
+    profiler.dump_stats(os.path.join(directory, name + '.prof'))
+    user = getattr(request, 'user', None)
+    details = {
+        'name': name,
+        'time': timezone.now().isoformat(),
+        'trigger': trigger,
+        'method': request.method,
+        'path': request.get_full_path(),
+        'view': view,
+        'user': user.get_username() if user and user.is_authenticated else None,
+        'status': response.status_code,
+        'duration_ms': round(duration * 1000, 3),
+        'sql_count': len(query_log.queries),
+        'sql_time_ms': round(sum(query['time_ms'] for query in query_log.queries), 3),
+        'queries': query_log.queries,
+    }
+    with open(os.path.join(directory, name + '.json'), 'w') as file:
+        json.dump(details, file, ensure_ascii=False, indent=1)
+    rotate(directory)
+    return name
+
+
+def rotate(directory):
+    """Function to remove the oldest profiles, keeping settings.PROFILING_MAX_FILES of them"""
+
+    with _rotate_lock:
+        names = sorted(entry[:-len('.json')] for entry in os.listdir(directory) if entry.endswith('.json'))
+        for name in names[:-getattr(settings, 'PROFILING_MAX_FILES', 100) or None]:
+            for extension in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(directory, name + extension))
+                except FileNotFoundError:
+                    pass
+
+
+def load(directory=None):
+    """Function to read the details of the captured profiles, newest first"""
+
+    directory = directory or get_directory()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for entry in sorted(os.listdir(directory), reverse=True):
+        if entry.endswith('.json'):
+            with open(os.path.join(directory, entry)) as file:
+                profiles.append(json.load(file))
+    return profiles
+
+
+class ProfilingMiddleware:
+    """
+    Runs the requests asked for by staff users and a sampled fraction of the others under cProfile.
+    Must be placed after AuthenticationMiddleware.
+
+    With an asynchronous handler the profiler only sees the event loop thread, including the other requests
+    served by the loop meanwhile, and not the threads running the ORM queries; the SQL log is complete.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Mark the middleware as asynchronous for asynchronous handlers, like MiddlewareMixin does
+        self._is_coroutine = asyncio.coroutines._is_coroutine if asyncio.iscoroutinefunction(get_response) else None
+
+    def __call__(self, request):
+        if self._is_coroutine:
+            return self.__acall__(request)
+        trigger = 'requested' if requested(request) else 'sampled' if sampled() else None
+        if trigger is None:
+            return self.get_response(request)
+
+        query_log, profiler = QueryLog(), cProfile.Profile()
+        token = _current_log.set(query_log)
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+            _current_log.reset(token)
+        return self.finish(profiler, query_log, request, response, time.perf_counter() - start, trigger)
+
+    async def __acall__(self, request):
+        # The session behind request.user is loaded synchronously, so only for the requests asking for a profile
+        asked = request.META.get(PROFILE_HEADER) or request.GET.get(PROFILE_PARAMETER)
+        trigger = 'requested' if asked and await sync_to_async(requested)(request) else \
+            'sampled' if sampled() else None
+        if trigger is None:
+            return await self.get_response(request)
+
+        query_log, profiler = QueryLog(), cProfile.Profile()
+        token = _current_log.set(query_log)
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profiler.disable()
+            _current_log.reset(token)
+        duration = time.perf_counter() - start
+        return await sync_to_async(self.finish)(profiler, query_log, request, response, duration, trigger)
+
+    @staticmethod
+    def finish(profiler, query_log, request, response, duration, trigger):
+        if trigger == 'requested' or duration >= getattr(settings, 'PROFILING_SLOW_THRESHOLD', 1.0):
+            response['X-Profile'] = save(profiler, query_log, request, response, duration, trigger)
+        return response
@@ -0,0 +1,337 @@
+"""
+Full-text search index over the names of products, companies and shops.
+
+Documents are stored as (kind, object_id, text) rows in a table owned by the search backend.
+On PostgreSQL the table has a generated tsvector column with the 'russian' configuration and GIN indexes
+on the vector and on the text with trigram operators, so results are ranked, words match in any form
+and typos are tolerated. On SQLite two FTS5 tables are used instead: one with words matched by stem prefix
+and one with the trigram tokenizer, whose candidates are filtered by trigram similarity.
+
+The index is kept in sync by the signal handlers from crm.signals and can be recreated
+with the rebuild_search_index command.
+"""
+
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+
+from .models import InventorySummary, ProdInfo, Product, Shop
+
+SEARCH_TABLE = 'crm_search_document'
+TRIGRAM_TABLE = 'crm_search_trigram'
+
+"Maximum number of products found by a single query"
+SEARCH_LIMIT = 200
+
+"Factor by which the number of documents taken from the index grows while too few of them are held by the user"
+WINDOW_GROWTH = 4
+
+"Minimum share of the query trigrams a word must contain to be considered a typo of it"
+TRIGRAM_THRESHOLD = 0.5
+
+WORD_RE = re.compile(r'\w+')
+
+"Common inflection endings of Russian words, longest first"
+RUSSIAN_ENDINGS = sorted((
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ой', 'ей', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее',
+    'ые', 'ие', 'ую', 'юю', 'ов', 'ев', 'ах', 'ях', 'ам', 'ям', 'ом', 'ем', 'а', 'я', 'о', 'е', 'ы', 'и', 'у',
+    'ю', 'ь', 'й',
+), key=len, reverse=True)
+
+
+def words(text):
+    """Function to split a text into lowercase words"""
+
+    return WORD_RE.findall(text.lower())
+
+
+def stem(word):
+    """Function to cut the inflection ending of a word, keeping at least two letters of the stem"""
+
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 2:
+            return word[:-len(ending)]
+    return word
+
+
+def trigrams(word):
+    """Function to split a word into the set of its three-letter substrings"""
+
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+class SearchBackend:
+    """Base class of the search backends. Subclasses implement storage of the documents and ranked lookup."""
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def install(self):
+        """Creates the tables and indexes of the backend if they do not exist"""
+
+        raise NotImplementedError
+
+    def index(self, kind, documents):
+        """Adds or replaces documents, given as (object_id, text) pairs, of the given kind"""
+
+        raise NotImplementedError
+
+    def remove(self, kind, object_ids):
+        """Removes the documents of the given kind"""
+
+        raise NotImplementedError
+
+    def clear(self):
+        """Removes all the documents"""
+
+        raise NotImplementedError
+
+    def search(self, kind, query, limit=SEARCH_LIMIT):
+        """Returns a list of (object_id, rank) pairs of the given kind, best matches first"""
+
+        raise NotImplementedError
+
+    def count(self, kind):
+        """Returns the number of documents of the given kind"""
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {SEARCH_TABLE} WHERE kind = %s', [kind])
+            return cursor.fetchone()[0]
+
+
+class PostgresSearchBackend(SearchBackend):
+    """Search backend based on a tsvector column and the pg_trgm extension"""
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ('
+                f'kind varchar(16) NOT NULL, '
+                f'object_id bigint NOT NULL, '
+                f'text text NOT NULL, '
+                f"vector tsvector GENERATED ALWAYS AS (to_tsvector('russian', text)) STORED, "
+                f'PRIMARY KEY (kind, object_id))'
+            )
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_vector ON {SEARCH_TABLE} USING gin (vector)')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_trgm '
+                           f'ON {SEARCH_TABLE} USING gin (text gin_trgm_ops)')
+
+    def index(self, kind, documents):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {SEARCH_TABLE} (kind, object_id, text) VALUES (%s, %s, %s) '
+                f'ON CONFLICT (kind, object_id) DO UPDATE SET text = EXCLUDED.text',
+                [(kind, object_id, text) for object_id, text in documents]
+            )
+
+    def remove(self, kind, object_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE kind = %s AND object_id = ANY(%s)',
+                           [kind, list(object_ids)])
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {SEARCH_TABLE}')
+
+    def search(self, kind, query, limit=SEARCH_LIMIT):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT object_id, ts_rank(vector, query) + word_similarity(%s, text) AS rank '
+                f"FROM {SEARCH_TABLE}, websearch_to_tsquery('russian', %s) query "
+                f'WHERE kind = %s AND (vector @@ query OR %s <%% text) '
+                f'ORDER BY rank DESC, object_id LIMIT %s',
+                [query, query, kind, query, limit]
+            )
+            return cursor.fetchall()
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """Search backend based on SQLite FTS5 tables, used for local development and tests"""
+
+    tables = (SEARCH_TABLE, TRIGRAM_TABLE)
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5('
+                           f"kind UNINDEXED, object_id UNINDEXED, text, tokenize = 'unicode61 remove_diacritics 2')")
+            cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {TRIGRAM_TABLE} USING fts5('
+                           f"kind UNINDEXED, object_id UNINDEXED, text, tokenize = 'trigram')")
+
+    def index(self, kind, documents):
+        documents = list(documents)
+        self.remove(kind, [object_id for object_id, text in documents])
+        with self.connection.cursor() as cursor:
+            for table in self.tables:
+                cursor.executemany(f'INSERT INTO {table} (kind, object_id, text) VALUES (%s, %s, %s)',
+                                   [(kind, object_id, text) for object_id, text in documents])
+
+    def remove(self, kind, object_ids):
+        object_ids = list(object_ids)
+        if not object_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(object_ids))
+        with self.connection.cursor() as cursor:
+            for table in self.tables:
+                cursor.execute(f'DELETE FROM {table} WHERE kind = %s AND object_id IN ({placeholders})',
+                               [kind, *object_ids])
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            for table in self.tables:
+                cursor.execute(f'DELETE FROM {table}')
+
+    def search(self, kind, query, limit=SEARCH_LIMIT):
+        query_words = words(query)
+        if not query_words:
+            return []
+
+        ranks = {}
+        with self.connection.cursor() as cursor:
+            # Words of any form: every query word is matched as a prefix of its stem
+            cursor.execute(
+                f'SELECT object_id, bm25({SEARCH_TABLE}) FROM {SEARCH_TABLE} '
+                f'WHERE {SEARCH_TABLE} MATCH %s AND kind = %s ORDER BY bm25({SEARCH_TABLE}) LIMIT %s',
+                [' OR '.join('"%s"*' % stem(word) for word in query_words), kind, limit]
+            )
+            for object_id, bm25 in cursor.fetchall():
+                ranks[object_id] = 1 - bm25
+
+            # Typos: documents sharing trigrams with the query, filtered by the share of matching trigrams;
+            # the limit keeps the documents sharing the most of them, the rowid makes the ties stable
+            query_trigrams = {word: trigrams(word) for word in query_words if len(word) >= 3}
+            if query_trigrams:
+                cursor.execute(
+                    f'SELECT object_id, text FROM {TRIGRAM_TABLE} '
+                    f'WHERE {TRIGRAM_TABLE} MATCH %s AND kind = %s ORDER BY bm25({TRIGRAM_TABLE}), rowid LIMIT %s',
+                    [' OR '.join('"%s"' % t for t in set().union(*query_trigrams.values())), kind, limit]
+                )
+                for object_id, text in cursor.fetchall():
+                    text_trigrams = [trigrams(word) for word in words(text)]
+                    similarity = sum(
+                        max((len(q & t) / len(q) for t in text_trigrams), default=0)
+                        for q in query_trigrams.values()
+                    ) / len(query_trigrams)
+                    if similarity >= TRIGRAM_THRESHOLD:
+                        ranks[object_id] = ranks.get(object_id, 0) + similarity
+
+        return sorted(ranks.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+BACKENDS = {
+    'postgresql': PostgresSearchBackend,
+    'sqlite': SQLiteSearchBackend,
+}
+
+
+def get_backend(using='default'):
+    """Function to select the search backend for the database vendor of the given alias"""
+
+    vendor = connections[using].vendor
+    if vendor not in BACKENDS:
+        raise ImproperlyConfigured('Search is not supported on the %s database backend' % vendor)
+    return BACKENDS[vendor](using)
+
+
+def index_products(products):
+    """Function to index products by their title and the name of their company"""
+
+    get_backend().index('product', [
+        (product.pk, ' '.join(filter(None, (product.title, product.company.company if product.company else ''))))
+        for product in products
+    ])
+
+
+def index_shops(shops):
+    """Function to index shops by their name"""
+
+    get_backend().index('shop', [(shop.pk, shop.shop) for shop in shops])
+
+
+def remove(kind, object_ids):
+    """Function to remove documents from the index"""
+
+    get_backend().remove(kind, object_ids)
+
+
+def rebuild(batch_size=1000):
+    """Function to recreate the whole index from the Product and Shop models"""
+
+    backend = get_backend()
+    backend.install()
+    backend.clear()
+    products = Product.objects.select_related('company').order_by('pk')
+    for start in range(0, products.count(), batch_size):
+        index_products(products[start:start + batch_size])
+    shops = Shop.objects.order_by('pk')
+    for start in range(0, shops.count(), batch_size):
+        index_shops(shops[start:start + batch_size])
+
+
+def search_products(user, query, limit=SEARCH_LIMIT):
+    """
+    Function to find the products of the user's inventory matching the query.
+    Products match by their title and company, and also when the user has units of them bought in a matching shop.
+
+    The index is shared by all users and may hold more matches than the limit, most of them held by other users,
+    so the number of documents taken from it grows by WINDOW_GROWTH until the user holds limit of them
+    or the whole index is taken. The products of the user may be on a shard, see crm.sharding,
+    so they are not joined with the index in one query.
+
+    Parameters
+    ----------
+    user: str
+        Username to filter data from InventorySummary model
+    query: str
+        Text of the search request
+    limit: int, optional
+        Maximum number of products found
+
+    Returns
+    ----------
+    product_ids: list
+        Ids of the matching products held by the user, best matches first
+    """
+
+    backend = get_backend()
+    window, size = limit, None
+    while True:
+        ranks = held_matches(backend, user, query, window)
+        if len(ranks) >= limit:
+            break
+        if size is None:
+            size = max(backend.count('product'), backend.count('shop'))
+        if window >= size:
+            break
+        window *= WINDOW_GROWTH
+    return sorted(ranks, key=lambda product_id: (-ranks[product_id], product_id))[:limit]
+
+
+def held_matches(backend, user, query, window):
+    """
+    Function to rank the products of the user among the best matches of the query in the index.
+
+    Returns
+    ----------
+    ranks: dict
+        Ranks of the matching products held by the user by id
+    """
+
+    ranks = dict(backend.search('product', query, window))
+
+    shop_ranks = dict(backend.search('shop', query, window))
+    if shop_ranks:
+        held = (ProdInfo.objects.filter(account=user, shop__in=shop_ranks)
+                .values_list('title', 'shop').distinct().order_by())
+        for product_id, shop_id in held:
+            ranks[product_id] = max(ranks.get(product_id, 0), shop_ranks[shop_id])
+
+    if not ranks:
+        return {}
+    owned = InventorySummary.objects.filter(account=user, product__in=ranks).values_list('product', flat=True)
+    return {product_id: ranks[product_id] for product_id in owned}
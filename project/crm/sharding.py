@@ -0,0 +1,355 @@
+"""
+Placement of the per-user data on several databases (shards).
+
+When settings.PRODINFO_SHARDS lists database aliases, the rows of the models in SHARDED_MODELS (the ProdInfo
+units and their InventorySummary and DailyRollup totals) of each user are stored on one of them, chosen by
+a stable hash of the user id, unless an AccountShard row of the default database places the user elsewhere;
+the move_account_shard command moves a user and records such a row. With an empty list, the default,
+all the data stays on the default database. Adding a shard changes the hashed placement of most accounts,
+so before that their current placement is recorded with move_account_shard --pin-all, and the catalogue
+is copied to the new shard with move_account_shard --sync-catalogue.
+
+Every crm view filters these models by the user of the request, so ShardRoutingMiddleware makes that user
+the current account and ShardRouter sends the queries to the shard of the account. Saved and deleted objects
+are routed by their own account. Code running outside of requests, e.g. commands, selects the account with
+account_scope or passes the database explicitly (db_for_account); queries over all users, e.g. the ones of
+the signals finding whose cache to invalidate, run on every shard (all_databases). Queries without
+an account go to the default database.
+
+The catalogue (users, companies, shops and products) stays on the default database, and every shard keeps
+a copy of it, so the units keep their foreign keys and are joined with the catalogue in one query.
+The copies are updated by mirror, which the signals call when a catalogue object is saved or deleted;
+bulk_create() and QuerySet.update() send no signals, so the code using them calls mirror itself.
+All the databases have the whole schema.
+"""
+
+import asyncio
+import copy
+import zlib
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from . import db_router
+
+"Models whose rows are placed on the shard of their account, as (app label, model name)"
+SHARDED_MODELS = {('crm', 'prodinfo'), ('crm', 'inventorysummary'), ('crm', 'dailyrollup')}
+
+"Models copied to every shard, in the order of their foreign keys"
+CATALOGUE_MODELS = ('auth.User', 'crm.Company', 'crm.Shop', 'crm.Product')
+
+"Timeout of the cached placement of an account, in seconds"
+PLACEMENT_TIMEOUT = 60 * 60
+
+PLACEMENT_KEY = 'crm:shard:%s'
+
+_account = ContextVar('crm_shard_account', default=None)
+
+
+def get_shards():
+    return list(getattr(settings, 'PRODINFO_SHARDS', ()))
+
+
+def all_databases():
+    """Function to list the databases holding the per-user data"""
+
+    return get_shards() or [DEFAULT_DB_ALIAS]
+
+
+def is_sharded(model):
+    return (model._meta.app_label, model._meta.model_name) in SHARDED_MODELS
+
+
+def hashed_shard(account_id, shards=None):
+    """Function to choose the shard of an account by a stable hash of its id"""
+
+    shards = shards or get_shards()
+    return shards[zlib.crc32(str(account_id).encode()) % len(shards)]
+
+
+def db_for_account(account):
+    """
+    Function to find the database holding the data of an account.
+
+    Parameters
+    ----------
+    account: User or int
+        User or user id
+
+    Returns
+    ----------
+    alias: str
+    """
+
+    shards = get_shards()
+    if not shards:
+        return DEFAULT_DB_ALIAS
+    account_id = getattr(account, 'pk', account)
+    alias = cache.get(PLACEMENT_KEY % account_id)
+    if alias is None:
+        from .models import AccountShard
+
+        alias = AccountShard.objects.filter(account_id=account_id).values_list('database', flat=True).first() or ''
+        cache.set(PLACEMENT_KEY % account_id, alias, PLACEMENT_TIMEOUT)
+    return alias if alias in shards else hashed_shard(account_id, shards)
+
+
+def accounts_by_database(accounts=None):
+    """
+    Function to group accounts by the database holding their data.
+
+    Parameters
+    ----------
+    accounts: iterable, optional
+        Users or user ids; all the accounts by default
+
+    Returns
+    ----------
+    groups: list
+        Pairs of a database alias and a list of user ids, or None for all the accounts of the database
+    """
+
+    if accounts is None:
+        return [(alias, None) for alias in all_databases()]
+    groups = {}
+    for account in accounts:
+        account_id = getattr(account, 'pk', account)
+        groups.setdefault(db_for_account(account_id), []).append(account_id)
+    return list(groups.items())
+
+
+@contextmanager
+def account_scope(account):
+    """Context manager routing the queries of the sharded models to the database of the account"""
+
+    token = _account.set(account)
+    try:
+        yield
+    finally:
+        _account.reset(token)
+
+
+def current_account_id():
+    account = _account.get()
+    if callable(account):
+        account = account()
+    return getattr(account, 'pk', account)
+
+
+@contextmanager
+def atomic(databases=None):
+    """Context manager opening a transaction on each of the databases, the default one and the shards by default"""
+
+    with ExitStack() as stack:
+        for alias in databases or dict.fromkeys([DEFAULT_DB_ALIAS, *all_databases()]):
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+def mirror(objects, delete=False, created=False):
+    """
+    Function to copy catalogue objects saved on the default database to the other shards.
+
+    Parameters
+    ----------
+    objects: iterable
+        Objects of one model
+    delete: bool, optional
+        Delete the copies instead, with the units referring to them
+    created: bool, optional
+        The objects are new, so the copies are inserted in bulk
+    """
+
+    aliases = [alias for alias in get_shards() if alias != DEFAULT_DB_ALIAS]
+    objects = list(objects) if aliases else []
+    if not objects:
+        return
+    manager = type(objects[0])._base_manager
+    for alias in aliases:
+        if delete:
+            manager.using(alias).filter(pk__in=[obj.pk for obj in objects]).delete()
+        elif created:
+            manager.using(alias).bulk_create([copy.copy(obj) for obj in objects], batch_size=1000)
+        else:
+            for obj in objects:
+                # A raw save inserts or updates the row as it is, without the save() of the model;
+                # the copy keeps the database of the object itself
+                copy.copy(obj).save_base(using=alias, raw=True)
+
+
+def sync_catalogue(batch_size=1000):
+    """
+    Function to copy the whole catalogue to the shards, e.g. to a new one.
+
+    Returns
+    ----------
+    copied: int
+        Number of copied objects
+    """
+
+    copied = 0
+    for label in CATALOGUE_MODELS:
+        objects = apps.get_model(label)._base_manager.using(DEFAULT_DB_ALIAS).order_by('pk')
+        last = None
+        while True:
+            batch = list((objects if last is None else objects.filter(pk__gt=last))[:batch_size])
+            if not batch:
+                break
+            mirror(batch)
+            copied += len(batch)
+            last = batch[-1].pk
+    return copied
+
+
+def pin_accounts():
+    """
+    Function to record the current shard of every account that has no AccountShard row,
+    so that the accounts stay on their shards when the list of shards changes.
+
+    Returns
+    ----------
+    pinned: int
+        Number of recorded accounts
+    """
+
+    from .models import AccountShard
+
+    shards = get_shards()
+    placements = [AccountShard(account_id=account_id, database=hashed_shard(account_id, shards))
+                  for account_id in (apps.get_model(settings.AUTH_USER_MODEL).objects
+                                     .filter(shard__isnull=True).values_list('pk', flat=True))]
+    AccountShard.objects.bulk_create(placements, batch_size=1000, ignore_conflicts=True)
+    return len(placements)
+
+
+def move_account(account, database, batch_size=1000):
+    """
+    Function to move the data of an account to another shard and record its new placement.
+
+    The units and the rollups are copied to the new shard with new ids and the summary is rebuilt there; the placement
+    is recorded once the copies are committed, and the rows on the old shard are deleted afterwards.
+    Other processes may keep the cached placement for the LOCAL_TIMEOUT of the cache, so the account
+    should not be used while it is moved.
+
+    Parameters
+    ----------
+    account: User or int
+        User or user id
+    database: str
+        Alias of the shard to move the account to
+    batch_size: int, optional
+        Number of units copied at once
+
+    Returns
+    ----------
+    moved: int
+        Number of moved units
+    """
+
+    from .cache import bump_versions
+    from .models import AccountShard, DailyRollup, InventorySummary, ProdInfo
+
+    if database not in get_shards():
+        raise ValueError('%s is not one of settings.PRODINFO_SHARDS' % database)
+    account_id = getattr(account, 'pk', account)
+    source = db_for_account(account_id)
+    if source == database:
+        return 0
+
+    units = ProdInfo.objects.using(source).filter(account_id=account_id).order_by('pk')
+    moved = last = 0
+    # Transactions are committed from the innermost one: the copies, the placement, then the deletion
+    with transaction.atomic(using=source), transaction.atomic(using=DEFAULT_DB_ALIAS), \
+            transaction.atomic(using=database):
+        while True:
+            batch = list(units.filter(pk__gt=last)[:batch_size])
+            if not batch:
+                break
+            last = batch[-1].pk
+            created = [unit.time_create for unit in batch]
+            for unit in batch:
+                unit.pk = None
+            # bulk_create() sets time_create to the current time, the original one is restored after it
+            ProdInfo.objects.using(database).bulk_create(batch)
+            for unit, time_create in zip(batch, created):
+                unit.time_create = time_create
+            ProdInfo.objects.using(database).bulk_update(batch, ['time_create'])
+            moved += len(batch)
+        InventorySummary.objects.rebuild([account_id], using=database)
+        # The rollups hold the removals as well, which the units do not tell, so they are copied
+        DailyRollup.objects.using(database).filter(account_id=account_id).delete()
+        rollups = list(DailyRollup.objects.using(source).filter(account_id=account_id))
+        for rollup in rollups:
+            rollup.pk = None
+        DailyRollup.objects.using(database).bulk_create(rollups, batch_size=batch_size)
+        AccountShard.objects.update_or_create(account_id=account_id, defaults={'database': database})
+
+        # The base manager deletes the units without subtracting them from the totals deleted before them
+        for model in (DailyRollup, InventorySummary, ProdInfo):
+            model._base_manager.using(source).filter(account_id=account_id).delete()
+    cache.set(PLACEMENT_KEY % account_id, database, PLACEMENT_TIMEOUT)
+    bump_versions([account_id])
+    return moved
+
+
+class ShardRouter:
+    """Database router sending the queries of the sharded models to the database of their account"""
+
+    def db_for_read(self, model, **hints):
+        if not is_sharded(model) or not get_shards():
+            return None
+        instance = hints.get('instance')
+        account_id = None
+        if instance is not None and is_sharded(type(instance)):
+            account_id = instance.account_id
+        elif instance is not None and instance._meta.label == settings.AUTH_USER_MODEL:
+            account_id = instance.pk
+        if account_id is None:
+            account_id = current_account_id()
+        return db_for_account(account_id) if account_id is not None else None
+
+    def db_for_write(self, model, **hints):
+        alias = self.db_for_read(model, **hints)
+        if alias is not None:
+            # The replica router that records the writes of the request is not consulted
+            db_router.mark_written()
+        return alias
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every database but the replicas holds the catalogue, including a new shard that is migrated
+        # before it is added to settings.PRODINFO_SHARDS: migrate creates its permissions with this check
+        databases = set(settings.DATABASES) - set(getattr(settings, 'DATABASE_REPLICAS', ()))
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ShardRoutingMiddleware:
+    """Makes the user of the request the current account; the user is loaded only when a query needs it"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Mark the middleware as asynchronous for asynchronous handlers, like MiddlewareMixin does
+        self._is_coroutine = asyncio.coroutines._is_coroutine if asyncio.iscoroutinefunction(get_response) else None
+
+    def __call__(self, request):
+        if self._is_coroutine:
+            return self.__acall__(request)
+        with account_scope(lambda: request_account(request)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with account_scope(lambda: request_account(request)):
+            return await self.get_response(request)
+
+
+def request_account(request):
+    user = getattr(request, 'user', None)
+    return user.pk if user is not None and user.is_authenticated else None
@@ -0,0 +1,164 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import cache, images, search, sharding
+from .utils1 import invalidate_product_index
+from .models import Blob, Company, InventorySummary, ProdInfo, Product, Shop
+
+
+def install_search_index(sender, using, **kwargs):
+    """Creates the tables of the search index after the migrations of the crm app"""
+
+    search.get_backend(using).install()
+
+
+def bump_versions_on_commit(user_ids, using=None):
+    """Invalidates the cached data of the users once the current transaction of the database is committed"""
+
+    user_ids = set(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: cache.bump_versions(user_ids), using=using)
+
+
+def product_holders(**filters):
+    """Returns ids of the users holding units of the products matching the filters, on every shard"""
+
+    filters = {'product__%s' % k: v for k, v in filters.items()}
+    return [account for using in sharding.all_databases()
+            for account in (InventorySummary.objects.using(using).filter(**filters)
+                            .values_list('account', flat=True).distinct())]
+
+
+def shop_customers(shop):
+    """Returns ids of the users holding units bought in the shop, on every shard"""
+
+    return [account for using in sharding.all_databases()
+            for account in (ProdInfo.objects.using(using).filter(shop=shop)
+                            .values_list('account', flat=True).distinct().order_by())]
+
+
+@receiver(post_save, sender=ProdInfo)
+@receiver(post_delete, sender=ProdInfo)
+def invalidate_unit_owner(sender, instance, using=None, **kwargs):
+    bump_versions_on_commit([instance.account_id], using)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_save, sender=Company)
+@receiver(post_save, sender=Shop)
+@receiver(post_save, sender=Product)
+def mirror_catalogue(sender, instance, using=None, **kwargs):
+    """The shards keep copies of the catalogue for the foreign keys and joins of the units"""
+
+    if using == DEFAULT_DB_ALIAS:
+        sharding.mirror([instance])
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=Company)
+@receiver(post_delete, sender=Shop)
+@receiver(post_delete, sender=Product)
+def unmirror_catalogue(sender, instance, using=None, **kwargs):
+    if using == DEFAULT_DB_ALIAS:
+        sharding.mirror([instance], delete=True)
+
+
+@receiver(pre_save, sender=Product)
+def detect_photo_upload(sender, instance, raw=False, **kwargs):
+    """A new upload is not committed to the storage yet; variants of the previous photo no longer apply"""
+
+    instance._photo_uploaded = not raw and bool(instance.photo) and not instance.photo._committed
+    if instance._photo_uploaded:
+        instance.photo_widths = []
+    instance._previous_photo = ''
+    if instance.pk and not raw:
+        instance._previous_photo = Product.objects.filter(pk=instance.pk).values_list('photo', flat=True).first() or ''
+
+
+@receiver(post_save, sender=Product)
+def schedule_photo_variants(sender, instance, **kwargs):
+    if getattr(instance, '_photo_uploaded', False):
+        product_id, name = instance.pk, instance.photo.name
+        transaction.on_commit(lambda: images.schedule_variants(product_id, name))
+
+
+@receiver(post_save, sender=Product)
+def count_photo_references(sender, instance, raw=False, **kwargs):
+    previous, current = getattr(instance, '_previous_photo', ''), instance.photo.name or ''
+    if not raw and previous != current:
+        Blob.objects.acquire(current)
+        Blob.objects.release(previous)
+
+
+@receiver(post_delete, sender=Product)
+def release_photo(sender, instance, **kwargs):
+    Blob.objects.release(instance.photo.name)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, created=False, raw=False, **kwargs):
+    if not raw:
+        search.index_products([instance])
+        if not created:
+            bump_versions_on_commit(product_holders(pk=instance.pk))
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    """Holders are invalidated by the deletion of their units"""
+
+    search.remove('product', [instance.pk])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Company)
+def invalidate_product_dropdown(sender, raw=False, **kwargs):
+    """Products of a deleted company are left without a company and disappear from the dropdown index"""
+
+    if not raw:
+        transaction.on_commit(invalidate_product_index)
+
+
+@receiver(post_save, sender=Company)
+def index_company_products(sender, instance, created=False, raw=False, **kwargs):
+    """The company name is a part of the documents and cards of its products"""
+
+    if not raw and not created:
+        search.index_products(instance.product_set.select_related('company'))
+        bump_versions_on_commit(product_holders(company=instance))
+
+
+@receiver(pre_delete, sender=Company)
+def remember_company_products(sender, instance, **kwargs):
+    instance._product_ids = list(instance.product_set.values_list('pk', flat=True))
+    instance._holders = product_holders(company=instance)
+
+
+@receiver(post_delete, sender=Company)
+def reindex_company_products(sender, instance, **kwargs):
+    """Products of a deleted company lose its name in their documents and cards"""
+
+    search.index_products(Product.objects.filter(pk__in=instance._product_ids).select_related('company'))
+    bump_versions_on_commit(instance._holders)
+
+
+@receiver(post_save, sender=Shop)
+def index_shop(sender, instance, created=False, raw=False, **kwargs):
+    if not raw:
+        search.index_shops([instance])
+        if not created:
+            bump_versions_on_commit(shop_customers(instance))
+
+
+@receiver(pre_delete, sender=Shop)
+def remember_shop_customers(sender, instance, **kwargs):
+    instance._customers = shop_customers(instance)
+
+
+@receiver(post_delete, sender=Shop)
+def unindex_shop(sender, instance, **kwargs):
+    search.remove('shop', [instance.pk])
+    bump_versions_on_commit(instance._customers)
@@ -0,0 +1,122 @@
+"""
+Generation of synthetic inventory data for benchmarks and local development.
+
+Popularity follows a Zipf distribution: a few users hold most of the units and a few products
+make up most of every inventory, as in real accounts. Most units have the reference weight of their product,
+the rest are partially used packs. Objects are written with bulk_create, after which the InventorySummary
+and DailyRollup rows of the new users are rebuilt and the new products and shops are added to the search index.
+With sharding, the new catalogue objects are copied to the shards and every unit is written to the shard
+of its user, see crm.sharding.
+"""
+
+import random
+from dataclasses import dataclass, field
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from pytils.translit import slugify
+
+from . import search, sharding
+from .models import Company, DailyRollup, InventorySummary, ProdInfo, Product, Shop
+from .utils1 import invalidate_product_index
+
+PRODUCT_NAMES = ('Чай', 'Кофе', 'Сахар', 'Мука', 'Рис', 'Гречка', 'Соль', 'Макароны', 'Масло', 'Какао',
+                 'Овсянка', 'Перец', 'Корица', 'Мёд', 'Орехи')
+
+"Share of the units having the reference weight of their product"
+FULL_SHARE = 0.8
+
+"Exponent of the Zipf distribution of users and products"
+ZIPF_EXPONENT = 1.1
+
+
+@dataclass
+class SyntheticData:
+    users: list = field(default_factory=list)
+    companies: list = field(default_factory=list)
+    shops: list = field(default_factory=list)
+    products: list = field(default_factory=list)
+    units: int = 0
+
+
+def zipf_weights(count, exponent=ZIPF_EXPONENT):
+    """Function to build cumulative weights of a Zipf distribution over count items"""
+
+    weights, total = [], 0
+    for rank in range(1, count + 1):
+        total += 1 / rank ** exponent
+        weights.append(total)
+    return weights
+
+
+def generate(users=5, companies=10, shops=5, products=50, units=1000, prefix='synthetic', seed=0,
+             batch_size=1000):
+    """
+    Function to create synthetic users, companies, shops, products and ProdInfo units.
+
+    Parameters
+    ----------
+    users, companies, shops, products, units: int, optional
+        Number of objects of each kind to create
+    prefix: str, optional
+        Prefix of the names of the created objects, which must not be used by existing ones
+    seed: int, optional
+        Seed of the random generator, the same seed produces the same data
+    batch_size: int, optional
+        Number of objects inserted at once
+
+    Returns
+    ----------
+    data: SyntheticData
+        Created objects, users and products ordered from the most to the least popular
+    """
+
+    rng = random.Random(seed)
+    data = SyntheticData()
+    with sharding.atomic():
+        data.users = User.objects.bulk_create(
+            [User(username='%s_user_%d' % (prefix, i), password='!') for i in range(users)])
+        data.companies = Company.objects.bulk_create(
+            [Company(company='%s Компания %d' % (prefix, i), slug=slugify('%s-company-%d' % (prefix, i)))
+             for i in range(companies)])
+        data.shops = Shop.objects.bulk_create(
+            [Shop(shop='%s Магазин %d' % (prefix, i), slug=slugify('%s-shop-%d' % (prefix, i)))
+             for i in range(shops)])
+        data.products = Product.objects.bulk_create([
+            Product(title='%s %s %d' % (PRODUCT_NAMES[i % len(PRODUCT_NAMES)], prefix, i),
+                    slug=slugify('%s-product-%d' % (prefix, i)),
+                    company=data.companies[i % companies] if companies else None,
+                    ref_weight=rng.choice((100, 250, 500, 1000)))
+            for i in range(products)
+        ], batch_size=batch_size)
+        for objects in (data.users, data.companies, data.shops, data.products):
+            sharding.mirror(objects, created=True)
+
+        user_weights, product_weights = zipf_weights(users), zipf_weights(products)
+        for start in range(0, units, batch_size):
+            batch = []
+            for _ in range(min(batch_size, units - start)):
+                product = rng.choices(data.products, cum_weights=product_weights)[0]
+                batch.append(ProdInfo(
+                    title=product,
+                    account=rng.choices(data.users, cum_weights=user_weights)[0],
+                    company=product.company,
+                    shop=rng.choice(data.shops) if data.shops and rng.random() < 0.9 else None,
+                    cost=round(rng.uniform(50, 1000), 2),
+                    weight=product.ref_weight if rng.random() < FULL_SHARE else
+                    round(rng.uniform(0, product.ref_weight), 1),
+                ))
+            shards = {}
+            for unit in batch:
+                shards.setdefault(sharding.db_for_account(unit.account_id), []).append(unit)
+            for using, units in shards.items():
+                ProdInfo.objects.using(using).bulk_create(units)
+            data.units += len(batch)
+
+        InventorySummary.objects.rebuild(data.users)
+        DailyRollup.objects.rebuild(data.users)
+        for start in range(0, products, batch_size):
+            search.index_products(data.products[start:start + batch_size])
+        search.index_shops(data.shops)
+        transaction.on_commit(invalidate_product_index)
+    return data
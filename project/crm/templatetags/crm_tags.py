@@ -1,4 +1,29 @@
 from django import template
 from crm.models import *
+from crm.images import variant_name
 
 register = template.Library()
+
+
+@register.inclusion_tag('crm/photo.html')
+def responsive_photo(product, sizes='100vw'):
+    """
+    Renders the photo of a product with WebP and JPEG srcsets of its resized variants,
+    or the original photo while the variants are not generated yet
+    """
+
+    if not product.photo:
+        return {'photo': None}
+
+    storage = product.photo.storage
+    srcsets = {}
+    for extension in ('webp', 'jpg'):
+        candidates = ('%s %dw' % (storage.url(variant_name(product.photo.name, width, extension)), width)
+                      for width in product.photo_widths)
+        srcsets[extension] = ', '.join(candidates)
+    return {
+        'photo': product.photo,
+        'webp_srcset': srcsets['webp'],
+        'jpg_srcset': srcsets['jpg'],
+        'sizes': sizes,
+    }
@@ -1,3 +1,1704 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+from collections import OrderedDict
+from html import unescape
+from io import BytesIO, StringIO
+from threading import Lock
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser, User
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connections, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.query import QuerySet
+from django.template import Context, Template
+from asgiref.sync import async_to_sync
+from captcha.models import CaptchaStore
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.http import Http404, HttpResponse
+from django.urls import resolve, reverse
+from django.utils import timezone
+from django.utils.html import escape
+import numpy as np
+from PIL import Image
+
+from . import (analytics, api, assets, async_views, benchmarks, captcha_pool, db_router, mail_queue, cache as crm_cache,
+               images, metrics, profiling, search, sharding, synthetic, views)
+from .forms import MAX_BATCH_UNITS
+from .importer import import_units
+from .models import *
+from .search import search_products
+from .utils1 import CARDS_PAGE_SIZE, DETAIL_PAGE_SIZE, add_dict, decode_card_cursor, decode_cursor, encode_cursor, \
+    inventory_cards, inventory_history, inventory_summary, invalidate_product_index, product_index, query_context, \
+    shop_breakdown_queryset
+
+
+def legacy_count_sum(user):
+    """Reference implementation of the count_sum list as it was computed with Python loops"""
+
+    counting = list(ProdInfo.objects.filter(account=user).values('title', 'weight'))
+    count_sum = list(ProdInfo.objects.filter(account=user).values('title', 'company')
+                     .annotate(count=Count('title'), weight=Sum('weight'))
+                     .order_by('title'))
+    products = list(Product.objects.values('id', 'ref_weight'))
+    for p in counting:
+        ref = [obj['ref_weight'] for obj in products if p['title'] == obj['id']][0]
+        for c_s in count_sum:
+            if p['title'] == c_s['title']:
+                not_full = c_s
+        not_full['not_full'] = len([c for c in counting if c['title'] == p['title'] and c['weight'] != ref])
+    return count_sum
+
+
+class InventoryDataMixin:
+    """Creates two users with an inventory of several products"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('storekeeper', password='pass')
+        cls.other = User.objects.create_user('other', password='pass')
+        cls.company_a = Company.objects.create(company='Альфа')
+        cls.company_b = Company.objects.create(company='Бета')
+        cls.shop = Shop.objects.create(shop='Склад')
+        cls.tea = Product.objects.create(title='Чай', company=cls.company_a, ref_weight=100)
+        cls.coffee = Product.objects.create(title='Кофе', company=cls.company_b, ref_weight=250.5)
+        cls.sugar = Product.objects.create(title='Сахар', company=cls.company_a, ref_weight=1000)
+
+        for product, weights in ((cls.tea, (100, 100, 80.5, 0)), (cls.coffee, (250.5, 250.5, 250.5))):
+            for weight in weights:
+                ProdInfo.objects.create(title=product, account=cls.user, company=product.company,
+                                        shop=cls.shop, cost=10, weight=weight)
+        ProdInfo.objects.create(title=cls.sugar, account=cls.other, company=cls.company_a,
+                                shop=cls.shop, cost=5, weight=900)
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+class InventorySummaryTest(InventoryDataMixin, TestCase):
+
+    def test_matches_legacy_count_sum(self):
+        self.assertEqual(inventory_summary(self.user), legacy_count_sum(self.user))
+        self.assertEqual(inventory_summary(self.other), legacy_count_sum(self.other))
+
+    def test_aggregates(self):
+        rows = {row['title']: row for row in inventory_summary(self.user)}
+        self.assertEqual(set(rows), {self.tea.pk, self.coffee.pk})
+        self.assertEqual((rows[self.tea.pk]['count'], rows[self.tea.pk]['weight'], rows[self.tea.pk]['not_full']),
+                         (4, 280.5, 2))
+        self.assertEqual(rows[self.coffee.pk]['not_full'], 0)
+
+    def test_restricted_to_products(self):
+        rows = inventory_summary(self.user, products=[self.coffee])
+        self.assertEqual([row['title'] for row in rows], [self.coffee.pk])
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            inventory_summary(self.user)
+
+    def test_query_context(self):
+        context = query_context(self.user, {'key': 'value'})
+        self.assertEqual(context['count_sum'], legacy_count_sum(self.user))
+        self.assertEqual(context['add_dict'], add_dict)
+        self.assertEqual(context['key'], 'value')
+
+        context = query_context(self.user, get_request='Коф')
+        self.assertEqual(list(context['products']), [self.coffee])
+
+    def test_query_context_empty_inventory(self):
+        user = User.objects.create_user('newcomer', password='pass')
+        self.assertEqual(query_context(user, {'key': 'value'}), {'add_dict': add_dict})
+
+
+class InventorySummaryModelTest(InventoryDataMixin, TestCase):
+
+    def summary(self, product):
+        return InventorySummary.objects.values('count', 'weight', 'not_full', 'cost').get(account=self.user,
+                                                                                          product=product)
+
+    def test_created_units(self):
+        self.assertEqual(self.summary(self.tea), {'count': 4, 'weight': 280.5, 'not_full': 2, 'cost': 40})
+        self.assertEqual(list(InventorySummary.objects.computed([self.user]).order_by('product')),
+                         list(InventorySummary.objects.filter(account=self.user).order_by('product_id')
+                              .values('account', 'product', 'count', 'not_full', 'weight', 'cost')))
+
+    def test_edited_unit(self):
+        unit = ProdInfo.objects.filter(title=self.tea, weight=80.5).get()
+        unit.weight = 100
+        unit.cost = 20
+        unit.save()
+        self.assertEqual(self.summary(self.tea), {'count': 4, 'weight': 300, 'not_full': 1, 'cost': 50})
+
+    def test_deleted_units(self):
+        ProdInfo.objects.filter(title=self.tea, weight=0).get().delete()
+        self.assertEqual(self.summary(self.tea), {'count': 3, 'weight': 280.5, 'not_full': 1, 'cost': 30})
+        for unit in ProdInfo.objects.filter(title=self.coffee):
+            unit.delete()
+        self.assertFalse(InventorySummary.objects.filter(product=self.coffee).exists())
+
+    def test_bulk_deleted_units(self):
+        self.assertEqual(ProdInfo.objects.filter(title=self.tea, weight__lt=100).delete()[0], 2)
+        self.assertEqual(self.summary(self.tea), {'count': 2, 'weight': 200, 'not_full': 0, 'cost': 20})
+        self.assertEqual(DailyRollup.objects.get(account=self.user, product=self.tea).removed_count, 2)
+
+        # The delete action of the admin deletes the queryset of the selected units
+        admin = User.objects.create_superuser('admin', password='pass')
+        self.client.force_login(admin)
+        units = ProdInfo.objects.filter(title=self.coffee).values_list('pk', flat=True)
+        self.client.post(reverse('admin:crm_prodinfo_changelist'),
+                         {'action': 'delete_selected', '_selected_action': list(units), 'post': 'yes'})
+        self.assertFalse(ProdInfo.objects.filter(title=self.coffee).exists())
+        self.assertFalse(InventorySummary.objects.filter(product=self.coffee).exists())
+        self.assertEqual(list(InventorySummary.objects.computed([self.user]).order_by('product')),
+                         list(InventorySummary.objects.filter(account=self.user).order_by('product_id')
+                              .values('account', 'product', 'count', 'not_full', 'weight', 'cost')))
+
+    def test_concurrent_first_insert(self):
+        salt = Product.objects.create(title='Соль', company=self.company_a, ref_weight=10)
+        update = QuerySet.update
+
+        def race(queryset, **kwargs):
+            # Another transaction creates the summary row between the update and the insert of this one
+            race.calls += 1
+            if race.calls == 1:
+                InventorySummary.objects.bulk_create([InventorySummary(account=self.user, product=salt, count=1,
+                                                                       weight=5)])
+                return 0
+            return update(queryset, **kwargs)
+
+        race.calls = 0
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=race):
+            ProdInfo.objects.create(title=salt, account=self.user, company=self.company_a, weight=10, cost=3)
+        self.assertEqual(self.summary(salt), {'count': 2, 'weight': 15, 'not_full': 0, 'cost': 3})
+
+    def test_ref_weight_change(self):
+        self.tea.ref_weight = 80.5
+        self.tea.save()
+        self.assertEqual(self.summary(self.tea)['not_full'], 3)
+        self.assertEqual(self.summary(self.coffee)['not_full'], 0)
+
+    def test_rebuild_and_check(self):
+        InventorySummary.objects.filter(product=self.tea).update(count=100)
+        InventorySummary.objects.filter(product=self.coffee).delete()
+        with self.assertRaises(CommandError):
+            call_command('rebuild_inventory_summary', check=True, stdout=StringIO())
+
+        call_command('rebuild_inventory_summary', stdout=StringIO())
+        self.assertEqual(self.summary(self.tea)['count'], 4)
+        self.assertEqual(self.summary(self.coffee)['count'], 3)
+        call_command('rebuild_inventory_summary', check=True, stdout=StringIO())
+
+    def test_views_update_summary(self):
+        self.client.force_login(self.user)
+        unit = ProdInfo.objects.filter(title=self.coffee).first()
+        self.client.post(reverse('edit_prodinfo', kwargs={'product_slug': self.coffee.slug, 'prodinfo_id': unit.pk}),
+                         {'shop': self.shop.pk, 'cost': 10, 'weight': 200})
+        self.assertEqual(self.summary(self.coffee)['not_full'], 1)
+
+        self.client.post(reverse('add_prodinfo_detail', kwargs={'product_slug': self.coffee.slug}),
+                         {'title': self.coffee.pk, 'company': self.company_b.pk, 'shop': self.shop.pk,
+                          'cost': 15, 'weight': 250.5})
+        self.assertEqual(self.summary(self.coffee)['count'], 4)
+
+        self.client.post(reverse('delete_prodinfo', kwargs={'product_slug': self.coffee.slug, 'prodinfo_id': unit.pk}))
+        self.assertEqual(self.summary(self.coffee), {'count': 3, 'weight': 751.5, 'not_full': 0, 'cost': 35})
+
+
+class MainPageTest(InventoryDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def test_cards_only_for_owned_products(self):
+        response = self.client.get(reverse('home'))
+        self.assertEqual([row.product for row in response.context['summary']], [self.coffee, self.tea])
+        content = response.content.decode()
+        self.assertLess(content.index(self.coffee.get_absolute_url()), content.index(self.tea.get_absolute_url()))
+        self.assertContains(response, 'Неполных пачек: 2')
+        self.assertNotContains(response, self.sugar.title)
+
+    def test_query_count_does_not_depend_on_catalogue_size(self):
+        with self.assertNumQueries(4):
+            # session, user, paginator count and the page of summary rows with products and companies
+            self.client.get(reverse('home'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(30):
+                product = Product.objects.create(title='Товар %d' % i, company=self.company_a, ref_weight=10)
+                ProdInfo.objects.create(title=product, account=self.user, company=self.company_a, weight=10)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('home'))
+        self.assertEqual(response.content.decode().count('class="card"'), 10)
+        self.assertTrue(response.context['page_obj'].has_next())
+
+    def test_cached_until_inventory_changes(self):
+        self.client.get(reverse('home'))
+        with self.assertNumQueries(2):
+            # only session and user
+            self.client.get(reverse('home'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProdInfo.objects.create(title=self.tea, account=self.user, company=self.company_a, weight=100)
+        self.assertContains(self.client.get(reverse('home')), 'Кол-во пачек: 5')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.company_a.company = 'Альфа-М'
+            self.company_a.save()
+        self.assertContains(self.client.get(reverse('home')), 'Альфа-М')
+
+    def test_other_users_stay_cached(self):
+        self.client.get(reverse('home'))
+        with self.captureOnCommitCallbacks(execute=True):
+            ProdInfo.objects.create(title=self.sugar, account=self.other, company=self.company_a, weight=1)
+        with self.assertNumQueries(2):
+            self.client.get(reverse('home'))
+
+    def test_empty_inventory(self):
+        self.client.force_login(User.objects.create_user('newcomer', password='pass'))
+        response = self.client.get(reverse('home'))
+        self.assertNotContains(response, 'class="card"')
+        self.assertContains(response, reverse('add_company'))
+
+
+class MoreCardsTest(InventoryDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(CARDS_PAGE_SIZE + 3):
+                product = Product.objects.create(title='Товар | %02d' % i, company=self.company_a, ref_weight=10)
+                ProdInfo.objects.create(title=product, account=self.user, company=self.company_a, weight=10)
+
+    def titles(self, content):
+        return re.findall(r'class="card_title">([^<]*)<', content)
+
+    def test_scrolls_through_all_cards(self):
+        response = self.client.get(reverse('home'))
+        titles = self.titles(response.content.decode())
+        next_url = response.context['next_url']
+        # The link opens the next page without JavaScript, the scroll loads the batch after the cursor
+        self.assertContains(response, 'href="?page=2" data-next="%s" class="next"' % escape(next_url))
+        while next_url:
+            response = self.client.get(next_url)
+            self.assertNotContains(response, 'search_form')
+            titles += self.titles(response.content.decode())
+            next_url = response.context['next_url']
+        expected = list(InventorySummary.objects.filter(account=self.user)
+                        .order_by('product__title', 'product_id').values_list('product__title', flat=True))
+        self.assertEqual([unescape(title) for title in titles], expected)
+        self.assertNotContains(response, 'class="next"')
+
+    def test_only_the_batch_is_loaded(self):
+        next_url = self.client.get(reverse('home')).context['next_url']
+        with self.assertNumQueries(3):
+            # session, user and the rows of the batch
+            response = self.client.get(next_url)
+        self.assertEqual(response.content.decode().count('class="card"'), 5)
+        with self.assertNumQueries(2):
+            self.client.get(next_url)
+
+    def test_json(self):
+        response = self.client.get(reverse('more_cards_json'))
+        data = response.json()
+        self.assertEqual(data['cards_html'].count('class="card"'), CARDS_PAGE_SIZE)
+        self.assertEqual(decode_card_cursor(data['next_cursor']), ('Товар | 08', self.product_id('Товар | 08')))
+        data = self.client.get(data['next_url']).json()
+        self.assertEqual(data['cards_html'].count('class="card"'), 5)
+        self.assertIsNone(data['next_cursor'])
+        self.assertIsNone(data['next_url'])
+
+    def test_invalid_cursor(self):
+        for cursor in ('!!!', encode_cursor({'time_create': timezone.now(), 'pk': 1})):
+            self.assertEqual(self.client.get(reverse('more_cards'), {'after': cursor}).status_code, 404)
+
+    def test_login_required(self):
+        self.client.logout()
+        self.assertRedirects(self.client.get(reverse('more_cards')), '%s?next=%s' % (reverse('login'),
+                                                                                     reverse('more_cards')))
+
+    def product_id(self, title):
+        return Product.objects.get(title=title).pk
+
+
+class TieredCacheTest(TestCase):
+
+    def test_memory_tier_in_front_of_shared_cache(self):
+        cache.set('key', [1, 2])
+        caches['shared'].delete('key')
+        self.assertEqual(cache.get('key'), [1, 2])
+        cache.delete('key')
+        self.assertIsNone(cache.get('key'))
+
+    def test_version_bump(self):
+        version = crm_cache.get_version(42)
+        crm_cache.bump_versions([42])
+        self.assertGreater(crm_cache.get_version(42), version)
+
+    def process_cache(self, **options):
+        """TieredCache with a memory tier of its own, like the cache of another process"""
+
+        other = crm_cache.TieredCache('shared', {'OPTIONS': options})
+        other._local, other._lock = OrderedDict(), Lock()
+        return other
+
+    def test_lru_eviction(self):
+        tiered = self.process_cache(LOCAL_MAX_ENTRIES=2)
+        for key in ('a', 'b'):
+            tiered.set(key, key)
+        tiered.get('a')
+        tiered.set('c', 'c')
+        caches['shared'].delete_many(['a', 'b', 'c'])
+        # 'b' was the least recently used entry and was evicted from memory
+        self.assertEqual((tiered.get('a'), tiered.get('b'), tiered.get('c')), ('a', None, 'c'))
+
+    def test_invalidation_across_processes(self):
+        other = self.process_cache()
+        user = User(pk=42)
+        self.assertEqual(crm_cache.get_or_set(user, 'cards', lambda: 'old'), 'old')
+        other.incr(crm_cache.VERSION_KEY % 42)
+        # The version read from the memory tier would keep the old entry for LOCAL_TIMEOUT seconds
+        self.assertEqual(crm_cache.get_or_set(user, 'cards', lambda: 'new'), 'new')
+
+    def test_async_cached_none(self):
+        calls = []
+
+        async def compute():
+            calls.append(1)
+
+        for _ in range(2):
+            self.assertIsNone(async_to_sync(crm_cache.aget_or_set)(User(pk=42), 'none', compute))
+        self.assertEqual(len(calls), 1)
+
+
+class SearchTest(InventoryDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def test_ranked_by_title_and_company(self):
+        self.assertEqual(search_products(self.user, 'Чай'), [self.tea.pk])
+        self.assertEqual(search_products(self.user, 'бета'), [self.coffee.pk])
+        self.assertEqual(search_products(self.user, 'альфа'), [self.tea.pk])
+
+    def test_word_forms_and_typos(self):
+        self.assertEqual(search_products(self.user, 'чая'), [self.tea.pk])
+        self.assertEqual(search_products(self.user, 'кофн'), [self.coffee.pk])
+        self.assertEqual(search_products(self.user, 'ничего'), [])
+
+    def test_only_products_of_the_user(self):
+        self.assertEqual(search_products(self.user, 'сахар'), [])
+        self.assertEqual(search_products(self.other, 'сахар'), [self.sugar.pk])
+
+    def test_more_matches_than_the_limit(self):
+        products = Product.objects.bulk_create([Product(title='Чай %03d' % i, slug='chaj-%03d' % i,
+                                                        company=self.company_a, ref_weight=10)
+                                                for i in range(search.SEARCH_LIMIT + 60)])
+        search.index_products(products)
+        ProdInfo.objects.create(title=products[-1], account=self.other, company=self.company_a, weight=10)
+        self.assertEqual(search_products(self.other, 'Чай'), [products[-1].pk])
+        self.assertEqual(len(search_products(self.user, 'Чай', limit=1)), 1)
+
+    def test_typo_candidates_ranked_before_the_limit(self):
+        backend = search.get_backend()
+        # Documents sharing one trigram with the query are indexed first, the typo shares three of four
+        backend.index('probe', [(number, 'соло %d' % number) for number in range(1, 21)])
+        backend.index('probe', [(99, 'моллоко')])
+        self.assertEqual(backend.search('probe', 'молоко', limit=5), [(99, 0.75)])
+
+    def test_index_follows_renames(self):
+        self.company_b.company = 'Гамма'
+        self.company_b.save()
+        self.assertEqual(search_products(self.user, 'гамма'), [self.coffee.pk])
+        self.assertEqual(search_products(self.user, 'бета'), [])
+
+        self.shop.shop = 'Лавка'
+        self.shop.save()
+        self.assertEqual(sorted(search_products(self.user, 'лавка')), sorted([self.tea.pk, self.coffee.pk]))
+
+        self.tea.delete()
+        self.assertEqual(search_products(self.user, 'чай'), [])
+
+    def test_rebuild(self):
+        search.get_backend().clear()
+        self.assertEqual(search_products(self.user, 'чай'), [])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(search_products(self.user, 'чай'), [self.tea.pk])
+
+    def test_view_is_paginated(self):
+        for i in range(12):
+            product = Product.objects.create(title='Чай %d' % i, company=self.company_a, ref_weight=10)
+            ProdInfo.objects.create(title=product, account=self.user, company=self.company_a, weight=10)
+        response = self.client.get(reverse('search_result'), {'q': 'чай'})
+        self.assertEqual(response.content.decode().count('class="card"'), 10)
+        self.assertContains(response, '?page=2&q=%D1%87%D0%B0%D0%B9')
+        response = self.client.get(reverse('search_result'), {'q': 'чай', 'page': 2})
+        self.assertEqual(response.content.decode().count('class="card"'), 3)
+
+
+class MediaRootMixin:
+    """Stores uploaded files in a temporary MEDIA_ROOT"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def upload(self, name='photo.png', size=(40, 20), color='red'):
+        buffer = BytesIO()
+        Image.new('RGBA', size, color).save(buffer, 'PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class StaticAssetsTest(TestCase):
+    """Collects the static files into a temporary STATIC_ROOT"""
+
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_root)
+        static_settings = override_settings(STATIC_ROOT=self.static_root)
+        static_settings.enable()
+        self.addCleanup(static_settings.disable)
+
+    def collect(self):
+        call_command('collectstatic', interactive=False, verbosity=0)
+        return assets.StaticFilesMiddleware(lambda request: HttpResponse('view'))
+
+    def get(self, middleware, path, **headers):
+        response = middleware(RequestFactory().get(path, **headers))
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        if hasattr(response, 'close'):
+            response.close()
+        return response, content
+
+    def test_original_names_before_collectstatic(self):
+        self.assertEqual(Template('{% load static %}{% static "crm/css/styles.css" %}').render(Context()),
+                         '/static/crm/css/styles.css')
+        middleware = assets.StaticFilesMiddleware(lambda request: HttpResponse('view'))
+        self.assertEqual(self.get(middleware, '/static/crm/css/styles.css')[1], b'view')
+
+    def test_hashed_compressed_files(self):
+        middleware = self.collect()
+        url = Template('{% load static %}{% static "crm/css/styles.css" %}').render(Context())
+        self.assertRegex(url, r'^/static/crm/css/styles\.[0-9a-f]{12}\.css$')
+        with open(os.path.join(self.static_root, 'crm', 'css', 'styles.css'), 'rb') as file:
+            original = file.read()
+
+        response, content = self.get(middleware, url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(content), original)
+        self.assertEqual(int(response['Content-Length']), len(content))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        response, content = self.get(middleware, url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(content, original)
+        self.assertEqual(self.get(middleware, url, HTTP_IF_NONE_MATCH=response['ETag'])[0].status_code, 304)
+
+    def test_unhashed_and_unknown_paths(self):
+        middleware = self.collect()
+        response, _ = self.get(middleware, '/static/crm/img/add_product.png', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        for path in ('/static/crm/missing.css', '/static/../manage.py', '/'):
+            self.assertEqual(self.get(middleware, path)[1], b'view')
+
+
+@override_settings(THUMBNAIL_WORKERS=0, THUMBNAIL_WIDTHS=(16, 32, 64))
+class PhotoVariantsTest(MediaRootMixin, TestCase):
+
+    def test_variants_generated_after_upload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(title='Чай', ref_weight=100, photo=self.upload())
+        product.refresh_from_db()
+        self.assertEqual(product.photo_widths, [16, 32, 40])
+        for width in product.photo_widths:
+            for extension in ('webp', 'jpg'):
+                path = os.path.join(self.media_root, images.variant_name(product.photo.name, width, extension))
+                with Image.open(path) as variant:
+                    self.assertEqual(variant.width, width)
+
+        html = Template('{% load crm_tags %}{% responsive_photo product %}').render(Context({'product': product}))
+        self.assertIn('%s 16w' % images.variant_name(product.photo.url, 16, 'webp'), html)
+        self.assertIn('%s 40w' % images.variant_name(product.photo.url, 40, 'jpg'), html)
+
+    def test_new_upload_resets_variants(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(title='Чай', ref_weight=100, photo=self.upload())
+        product.refresh_from_db()
+        product.photo = self.upload('other.png', color='blue')
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.photo_widths, [])
+        self.assertEqual(len([c for c in callbacks if c is not invalidate_product_index]), 1)
+
+    def test_backfill_command(self):
+        product = Product.objects.create(title='Чай', ref_weight=100, photo=self.upload())
+        Product.objects.filter(pk=product.pk).update(photo_widths=[])
+        call_command('generate_photo_variants', stdout=StringIO())
+        product.refresh_from_db()
+        self.assertEqual(product.photo_widths, [16, 32, 40])
+
+
+@override_settings(THUMBNAIL_WORKERS=0, THUMBNAIL_WIDTHS=(16,))
+class ContentAddressedStorageTest(MediaRootMixin, TestCase):
+
+    def refs(self, name):
+        return Blob.objects.get(name=name).refs
+
+    def test_identical_photos_stored_once(self):
+        tea = Product.objects.create(title='Чай', ref_weight=100, photo=self.upload('tea.png'))
+        coffee = Product.objects.create(title='Кофе', ref_weight=100, photo=self.upload('coffee.png'))
+        self.assertEqual(tea.photo.name, coffee.photo.name)
+        self.assertRegex(tea.photo.name, r'^images/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+        self.assertEqual(self.refs(tea.photo.name), 2)
+
+        storage = Product._meta.get_field('photo').storage
+        mtime = os.path.getmtime(storage.path(tea.photo.name))
+        os.utime(storage.path(tea.photo.name), (mtime - 100, mtime - 100))
+        Product.objects.create(title='Сахар', ref_weight=100, photo=self.upload('sugar.png'))
+        self.assertEqual(os.path.getmtime(storage.path(tea.photo.name)), mtime - 100)
+        self.assertEqual(os.listdir(os.path.dirname(storage.path(tea.photo.name))), [os.path.basename(tea.photo.name)])
+
+    def test_orphans_collected(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            tea = Product.objects.create(title='Чай', ref_weight=100, photo=self.upload())
+        coffee = Product.objects.create(title='Кофе', ref_weight=100, photo=self.upload())
+        name = tea.photo.name
+        storage = Product._meta.get_field('photo').storage
+
+        tea.delete()
+        coffee.photo = self.upload(color='blue')
+        coffee.save()
+        self.assertEqual(self.refs(name), 0)
+        self.assertEqual(self.refs(coffee.photo.name), 1)
+        self.assertTrue(storage.exists(images.variant_name(name, 16, 'webp')))
+
+        call_command('collect_blobs', min_age=0, stdout=StringIO())
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(storage.exists(images.variant_name(name, 16, 'webp')))
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+        self.assertTrue(storage.exists(coffee.photo.name))
+
+    def test_recount(self):
+        product = Product.objects.create(title='Чай', ref_weight=100, photo=self.upload())
+        Blob.objects.all().delete()
+        storage = Product._meta.get_field('photo').storage
+        orphan = storage.save('images/orphan.png', self.upload(color='green'))
+
+        call_command('collect_blobs', recount=True, min_age=0, stdout=StringIO())
+        self.assertEqual(self.refs(product.photo.name), 1)
+        self.assertFalse(storage.exists(orphan))
+
+
+class ImportUnitsTest(InventoryDataMixin, TestCase):
+
+    csv_data = ('товар;производитель;магазин;вес;стоимость\n'
+                'Чай;Альфа;Склад;100;10,5\n'
+                'Кофе;;;250.5;\n'
+                'Неизвестный;;;1;1\n'
+                'Чай;;Нет такого;1;1\n'
+                'Чай;;;abc;1\n'
+                'Чай;;;50;2\n')
+
+    def run_import(self, data=None, name='delivery.csv', **kwargs):
+        file = BytesIO((data or self.csv_data).encode())
+        return import_units(self.user, file, name, **kwargs)
+
+    def test_csv_import(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            result = self.run_import(batch_size=2)
+        self.assertEqual((result.created, result.skipped), (3, 0))
+        self.assertEqual([row for row, _ in result.errors], [4, 5, 6])
+        self.assertEqual(ProdInfo.objects.filter(account=self.user, title=self.tea).count(), 6)
+        unit = ProdInfo.objects.get(account=self.user, title=self.coffee, import_key__isnull=False)
+        self.assertEqual((unit.company, unit.shop, unit.cost), (self.company_b, None, 0))
+        call_command('rebuild_inventory_summary', check=True, stdout=StringIO())
+
+    def test_reimport_is_idempotent(self):
+        self.run_import()
+        result = self.run_import(batch_size=4)
+        self.assertEqual((result.created, result.skipped), (0, 3))
+        self.assertEqual(ProdInfo.objects.filter(account=self.user).count(), 10)
+
+    def test_queries_per_batch(self):
+        rows = ''.join('Чай;;Склад;%d;1\n' % i for i in range(30))
+        with self.assertNumQueries(5 * 6 + 2):
+            # per batch: the check of imported keys, a savepoint, the insert, the summary and the rollup updates
+            # and the release;
+            # products and shops are looked up once
+            self.run_import('товар;производитель;магазин;вес;стоимость\n' + rows, batch_size=6)
+
+    def test_xlsx_import(self):
+        from openpyxl import Workbook
+
+        workbook = Workbook()
+        workbook.active.append(['Product', 'Shop', 'Weight', 'Cost'])
+        workbook.active.append(['Кофе', 'Склад', 250.5, 30])
+        file = BytesIO()
+        workbook.save(file)
+        file.seek(0)
+        result = import_units(self.user, file, 'delivery.xlsx')
+        self.assertEqual((result.created, result.errors), (1, []))
+        self.assertEqual(InventorySummary.objects.get(account=self.user, product=self.coffee).count, 4)
+
+    def test_upload_view(self):
+        self.client.force_login(self.user)
+        upload = SimpleUploadedFile('delivery.csv', self.csv_data.encode(), content_type='text/csv')
+        response = self.client.post(reverse('import_units'), {'file': upload})
+        self.assertContains(response, 'Добавлено: 3')
+        self.assertContains(response, 'Строка 4')
+
+    def test_missing_columns(self):
+        result = self.run_import('товар;магазин\nЧай;Склад\n')
+        self.assertEqual(result.created, 0)
+        self.assertEqual(result.errors[0][0], None)
+
+
+class ApiTest(InventoryDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def get(self, resource, **params):
+        return self.client.get(reverse('api_v1', kwargs={'resource': resource}), params)
+
+    def test_cards(self):
+        response = self.get('cards', fields='id,title,count,not_full')
+        self.assertEqual(response.json(), {'results': [
+            {'id': self.tea.pk, 'title': 'Чай', 'count': 4, 'not_full': 2},
+            {'id': self.coffee.pk, 'title': 'Кофе', 'count': 3, 'not_full': 0},
+        ], 'next': None})
+
+    def test_units_are_per_user(self):
+        units = self.get('units', fields='weight').json()['results']
+        self.assertEqual(sorted(unit['weight'] for unit in units), [0, 80.5, 100, 100, 250.5, 250.5, 250.5])
+        self.assertEqual(self.get('units', ids=ProdInfo.objects.get(title=self.sugar).pk).json()['results'], [])
+
+    def test_batch_fetch(self):
+        response = self.get('products', ids='%d,%d,0' % (self.sugar.pk, self.tea.pk),
+                            fields='slug,company_name,photo')
+        self.assertEqual(response.json()['results'], [
+            {'slug': self.tea.slug, 'company_name': 'Альфа', 'photo': None},
+            {'slug': self.sugar.slug, 'company_name': 'Альфа', 'photo': None},
+        ])
+
+    def test_cursor_pagination(self):
+        for number in range(5):
+            Shop.objects.create(shop='Магазин %d' % number)
+        shops, after = [], None
+        while True:
+            with self.assertNumQueries(3):
+                data = self.get('shops', limit=2, **({'after': after} if after else {})).json()
+            shops.extend(shop['shop'] for shop in data['results'])
+            after = data['next']
+            if after is None:
+                break
+        self.assertEqual(shops, list(Shop.objects.order_by('pk').values_list('shop', flat=True)))
+
+    def test_queries_do_not_depend_on_page_size(self):
+        ProdInfo.objects.bulk_create([ProdInfo(title=self.tea, account=self.user, shop=self.shop, weight=1)
+                                      for _ in range(api.MAX_PAGE_SIZE)])
+        for limit in (1, api.MAX_PAGE_SIZE):
+            with self.assertNumQueries(3):
+                self.assertEqual(len(self.get('units', limit=limit).json()['results']), limit)
+
+    def test_etag(self):
+        response = self.get('companies')
+        url = reverse('api_v1', kwargs={'resource': 'companies'})
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        Company.objects.create(company='Гамма')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_errors(self):
+        self.assertEqual(self.get('cards', fields='title,secret').status_code, 400)
+        self.assertEqual(self.get('units', ids='1,a').status_code, 400)
+        self.assertEqual(self.get('units', limit=api.MAX_PAGE_SIZE + 1).status_code, 400)
+        self.assertEqual(self.get('users').status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.get('cards').status_code, 401)
+
+
+class AddUnitsTest(InventoryDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def rows(self, *rows, extra=2):
+        data = {'form-TOTAL_FORMS': len(rows) + extra, 'form-INITIAL_FORMS': 0}
+        for number, row in enumerate(rows + ({'quantity': 1},) * extra):
+            data.update({'form-%d-%s' % (number, name): value for name, value in row.items()})
+        return data
+
+    def test_detail_batch(self):
+        data = self.rows({'weight': 50, 'cost': 5, 'quantity': 2}, {'quantity': 40})
+        data['shop'] = self.shop.pk
+        url = reverse('add_units_detail', kwargs={'product_slug': self.tea.slug})
+        # session, user, product, shop, savepoint, insert, summary, rollup, release
+        with self.assertNumQueries(9):
+            response = self.client.post(url, data)
+        self.assertRedirects(response, reverse('detail', kwargs={'product_slug': self.tea.slug}),
+                             fetch_redirect_response=False)
+        units = ProdInfo.objects.filter(account=self.user, title=self.tea, shop=self.shop)
+        self.assertEqual(units.count(), 46)
+        self.assertEqual(units.filter(weight=100, cost=0).count(), 40)
+        summary = InventorySummary.objects.get(account=self.user, product=self.tea)
+        self.assertEqual((summary.count, summary.not_full), (46, 4))
+        self.assertEqual(DailyRollup.objects.get(account=self.user, product=self.tea).count, 46)
+        call_command('rebuild_inventory_summary', check=True, stdout=StringIO())
+
+    def test_add_units(self):
+        response = self.client.get(reverse('add_units'))
+        self.assertContains(response, 'product-index')
+        data = self.rows({'weight': 250.5, 'cost': 30, 'quantity': 3})
+        data.update({'company': self.company_b.pk, 'title': self.coffee.pk})
+        self.assertRedirects(self.client.post(reverse('add_units'), data), reverse('home'),
+                             fetch_redirect_response=False)
+        self.assertEqual(InventorySummary.objects.get(account=self.user, product=self.coffee).count, 6)
+
+    def test_validation(self):
+        url = reverse('add_units_detail', kwargs={'product_slug': self.tea.slug})
+        response = self.client.post(url, self.rows())
+        self.assertContains(response, 'Заполните хотя бы одну строку')
+        response = self.client.post(url, self.rows({'weight': -1}, {'quantity': MAX_BATCH_UNITS}))
+        self.assertContains(response, 'form-error')
+        response = self.client.post(url, self.rows({'quantity': MAX_BATCH_UNITS}, {'quantity': 2}))
+        self.assertContains(response, 'Не больше')
+        self.assertEqual(ProdInfo.objects.filter(account=self.user).count(), 7)
+        self.assertEqual(self.client.get(reverse('add_units_detail', kwargs={'product_slug': 'x'})).status_code, 404)
+
+
+class CaptchaPoolTest(InventoryDataMixin, TestCase):
+
+    def test_refill(self):
+        self.assertEqual(captcha_pool.refill(size=3), 3)
+        self.assertEqual(captcha_pool.refill(size=3), 0)
+        entry = CaptchaPoolEntry.objects.select_related('store').first()
+        self.assertTrue(bytes(entry.image).startswith(b'\x89PNG'))
+        response = self.client.get(reverse('captcha_pool_image', kwargs={'key': entry.store.hashkey}))
+        self.assertEqual(response.content, bytes(entry.image))
+
+    def test_login_takes_from_pool(self):
+        captcha_pool.refill(size=2)
+        response = self.client.get(reverse('login'))
+        key = CaptchaPoolEntry.objects.get(taken=True).store.hashkey
+        self.assertContains(response, reverse('captcha_pool_image', kwargs={'key': key}))
+        self.assertEqual(captcha_pool.available().count(), 1)
+
+        answer = CaptchaStore.objects.get(hashkey=key).response
+        response = self.client.post(reverse('login'), {'username': 'storekeeper', 'password': 'pass',
+                                                       'captcha_0': key, 'captcha_1': answer})
+        self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+        self.assertFalse(CaptchaPoolEntry.objects.filter(store__hashkey=key).exists())
+
+    def test_empty_pool_falls_back(self):
+        response = self.client.get(reverse('reguser'))
+        self.assertEqual(response.status_code, 200)
+        key = CaptchaStore.objects.get().hashkey
+        response = self.client.get(reverse('captcha_pool_image', kwargs={'key': key}))
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+    def test_cleanup(self):
+        captcha_pool.refill(size=3)
+        CaptchaStore.objects.filter(pk__in=CaptchaStore.objects.values('pk')[:2]).update(
+            expiration=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertEqual(captcha_pool.cleanup(batch_size=1), 2)
+        self.assertEqual(CaptchaPoolEntry.objects.count(), 1)
+        call_command('refill_captcha_pool', size=3, stdout=StringIO())
+        self.assertEqual(captcha_pool.available().count(), 3)
+
+
+class FlakyEmailBackend(EmailBackend):
+    """Local email backend refusing the messages to the addresses in 'refused' and counting opened connections"""
+
+    refused = set()
+    connections = 0
+
+    def open(self):
+        FlakyEmailBackend.connections += 1
+        return True
+
+    def send_messages(self, messages):
+        for message in messages:
+            if self.refused.intersection(message.to):
+                raise OSError('refused')
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='crm.tests.FlakyEmailBackend', MAIL_QUEUE_RETRY_DELAY=60, MAIL_QUEUE_MAX_ATTEMPTS=2)
+class MailQueueTest(InventoryDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        FlakyEmailBackend.refused, FlakyEmailBackend.connections = set(), 0
+
+    def test_password_reset_only_enqueues(self):
+        User.objects.filter(pk__in=[self.user.pk, self.other.pk]).update(email='shared@example.com')
+        response = self.client.post(reverse('password_reset'), {'email': 'shared@example.com'})
+        self.assertRedirects(response, '/password_reset/done/', fetch_redirect_response=False)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutgoingEmail.objects.filter(status=OutgoingEmail.QUEUED).count(), 2)
+
+        output = StringIO()
+        call_command('send_queued_mail', stdout=output)
+        self.assertIn('Sent 2 emails, 0 failed', output.getvalue())
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn('password_reset', mail.outbox[0].body)
+        self.assertEqual(FlakyEmailBackend.connections, 1)
+
+    def test_batches_share_a_connection(self):
+        for number in range(5):
+            mail_queue.enqueue('Тема', 'Текст', ['user%d@example.com' % number])
+        self.assertEqual(mail_queue.drain(batch_size=2), (5, 0))
+        self.assertEqual(FlakyEmailBackend.connections, 3)
+        self.assertEqual(OutgoingEmail.objects.filter(status=OutgoingEmail.SENT).count(), 5)
+
+    def test_retries_with_backoff(self):
+        FlakyEmailBackend.refused = {'bad@example.com'}
+        mail_queue.enqueue('Тема', 'Текст', ['bad@example.com'])
+        mail_queue.enqueue('Тема', 'Текст', ['good@example.com'])
+        start = timezone.now()
+        self.assertEqual(mail_queue.drain(), (1, 1))
+        email = OutgoingEmail.objects.get(status=OutgoingEmail.QUEUED)
+        self.assertEqual(email.attempts, 1)
+        self.assertIn('refused', email.last_error)
+        self.assertGreaterEqual(email.next_attempt, start + datetime.timedelta(seconds=60))
+        self.assertEqual(mail_queue.drain(), (0, 0))
+
+        OutgoingEmail.objects.filter(pk=email.pk).update(next_attempt=timezone.now())
+        self.assertEqual(mail_queue.drain(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutgoingEmail.FAILED, 2))
+        self.assertEqual(mail_queue.retry_delay(3), datetime.timedelta(seconds=240))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], DATABASE_REPLICA_VIEWS=['home', 'detail'])
+class DatabaseRouterTest(TransactionTestCase):
+    """
+    The router only names the aliases, so the replica does not need to exist.
+    Reads inside a transaction go to the primary, so the tests are not wrapped in one
+    """
+
+    router = db_router.PrimaryReplicaRouter()
+
+    def route(self, path, method='get', write=None, **extra):
+        """Returns the alias of a read made by the view of the path after an optional write, and the response"""
+
+        def view(request):
+            if write is not None:
+                self.router.db_for_write(write)
+            return HttpResponse(self.router.db_for_read(Product))
+
+        def handler(request):
+            request.resolver_match = resolve(request.path_info)
+            middleware.process_view(request, view, (), {})
+            return view(request)
+
+        middleware = db_router.ReplicaRoutingMiddleware(handler)
+        response = middleware(getattr(RequestFactory(), method)(path, **extra))
+        return response.content.decode(), response
+
+    def test_read_only_views(self):
+        self.assertEqual(self.route('/')[0], 'replica')
+        self.assertEqual(self.route('/detail/chaj/')[0], 'replica')
+        self.assertEqual(self.route('/', method='post')[0], 'default')
+        self.assertEqual(self.route('/add_product/')[0], 'default')
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.route('/')[0], 'default')
+
+    def test_write_pins_reads(self):
+        with mock.patch.object(db_router, 'time') as clock:
+            clock.time.return_value = 1000.0
+            alias, response = self.route('/', write=ProdInfo)
+            self.assertEqual(alias, 'default')
+            cookie = response.cookies[db_router.STICKY_COOKIE]
+            self.assertEqual((cookie.value, cookie['max-age']), ('1010.000', 10))
+
+            header = '%s=%s' % (cookie.key, cookie.value)
+            clock.time.return_value = 1009.999
+            self.assertEqual(self.route('/', HTTP_COOKIE=header)[0], 'default')
+            clock.time.return_value = 1010.0
+            self.assertEqual(self.route('/', HTTP_COOKIE=header)[0], 'replica')
+            self.assertEqual(self.route('/', HTTP_COOKIE='%s=x' % cookie.key)[0], 'replica')
+
+    def test_session_write_does_not_pin(self):
+        from django.contrib.sessions.models import Session
+
+        alias, response = self.route('/', write=Session)
+        self.assertEqual(alias, 'replica')
+        self.assertNotIn(db_router.STICKY_COOKIE, response.cookies)
+
+    def test_transactions_and_migrations(self):
+        def view(request):
+            with transaction.atomic():
+                return HttpResponse(self.router.db_for_read(Product))
+
+        def handler(request):
+            request.resolver_match = resolve('/')
+            middleware.process_view(request, view, (), {})
+            return view(request)
+
+        middleware = db_router.ReplicaRoutingMiddleware(handler)
+        self.assertEqual(middleware(RequestFactory().get('/')).content, b'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'crm'))
+        self.assertTrue(self.router.allow_migrate('default', 'crm'))
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'])
+class ReplicaReadsTest(InventoryDataMixin, TransactionTestCase):
+    """Routes the queries of the read-only views to replica1, a test mirror of the default database"""
+
+    databases = {'default', 'replica1'}
+
+    def setUp(self):
+        # The data is committed, so that the connection of the replica sees it
+        self.setUpTestData()
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def test_export_streams_from_replica(self):
+        with CaptureQueriesContext(connections['replica1']) as replica:
+            response = self.client.get(reverse('export_units', kwargs={'export_format': 'jsonl'}))
+            rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(rows), 7)
+        self.assertTrue(any('crm_prodinfo' in query['sql'] for query in replica.captured_queries))
+
+    def test_main_page_reads_replica(self):
+        with CaptureQueriesContext(connections['replica1']) as replica:
+            self.assertContains(self.client.get(reverse('home')), 'Кол-во пачек: 4')
+        self.assertTrue(any('crm_inventorysummary' in query['sql'] for query in replica.captured_queries))
+        for name in ('more_cards', 'more_cards_json'):
+            cache.clear()
+            with CaptureQueriesContext(connections['replica1']) as replica:
+                self.assertEqual(self.client.get(reverse(name)).status_code, 200)
+            self.assertTrue(any('crm_inventorysummary' in query['sql'] for query in replica.captured_queries))
+        with CaptureQueriesContext(connections['replica1']) as replica:
+            self.client.get(reverse('add_product'))
+        self.assertEqual(replica.captured_queries, [])
+
+    def test_writes_pin_reads(self):
+        unit = ProdInfo.objects.filter(account=self.user, title=self.tea).first()
+        response = self.client.post(reverse('delete_prodinfo', kwargs={'product_slug': self.tea.slug,
+                                                                       'prodinfo_id': unit.pk}))
+        self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+        self.assertIn(db_router.STICKY_COOKIE, response.cookies)
+        # The next page reads the new summary from the primary
+        with CaptureQueriesContext(connections['replica1']) as replica:
+            self.assertContains(self.client.get(reverse('home')), 'Кол-во пачек: 3')
+        self.assertEqual(replica.captured_queries, [])
+
+        self.client.cookies.pop(db_router.STICKY_COOKIE)
+        data = {'form-TOTAL_FORMS': 1, 'form-INITIAL_FORMS': 0, 'form-0-quantity': 2}
+        response = self.client.post(reverse('add_units_detail', kwargs={'product_slug': self.tea.slug}), data)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(db_router.STICKY_COOKIE, response.cookies)
+        self.assertEqual(InventorySummary.objects.get(account=self.user, product=self.tea).count, 5)
+
+
+class ShardRouterTest(InventoryDataMixin, TestCase):
+    """
+    The router only names the aliases, so the shard does not need to exist. The inventory is created
+    before the shards are configured, so the settings are overridden by each test
+    """
+
+    router = sharding.ShardRouter()
+    shards = override_settings(PRODINFO_SHARDS=['default', 'shard'])
+
+    @shards
+    def test_hashed_placement(self):
+        placements = [sharding.hashed_shard(account_id) for account_id in range(1000)]
+        self.assertEqual(placements, [sharding.hashed_shard(account_id) for account_id in range(1000)])
+        self.assertAlmostEqual(placements.count('shard') / 1000, 0.5, delta=0.05)
+        self.assertEqual(sharding.db_for_account(self.user), sharding.hashed_shard(self.user.pk))
+        with override_settings(PRODINFO_SHARDS=[]):
+            self.assertEqual(sharding.db_for_account(self.user), 'default')
+            self.assertEqual(sharding.accounts_by_database(), [('default', None)])
+
+    @shards
+    def test_recorded_placement(self):
+        moved = 'default' if sharding.hashed_shard(self.user.pk) == 'shard' else 'shard'
+        AccountShard.objects.create(account=self.user, database=moved)
+        self.assertEqual(sharding.db_for_account(self.user.pk), moved)
+        with self.assertNumQueries(0):
+            self.assertEqual(sharding.db_for_account(self.user.pk), moved)
+        self.assertEqual(sharding.accounts_by_database([self.user]), [(moved, [self.user.pk])])
+
+    @shards
+    def test_routing(self):
+        shard = sharding.db_for_account(self.user)
+        unit = ProdInfo(account=self.user, title=self.tea, weight=1)
+        self.assertEqual(self.router.db_for_write(ProdInfo, instance=unit), shard)
+        self.assertEqual(self.router.db_for_read(InventorySummary, instance=self.user), shard)
+        self.assertIsNone(self.router.db_for_read(ProdInfo))
+        self.assertIsNone(self.router.db_for_read(Product, instance=unit))
+        with sharding.account_scope(self.user):
+            self.assertEqual(self.router.db_for_read(DailyRollup), shard)
+            self.assertEqual(self.router.db_for_read(ProdInfo, instance=self.tea), shard)
+        with override_settings(PRODINFO_SHARDS=[]):
+            self.assertIsNone(self.router.db_for_write(ProdInfo, instance=unit))
+
+    @shards
+    def test_middleware(self):
+        def view(request):
+            return HttpResponse(self.router.db_for_read(ProdInfo) or '')
+
+        middleware = sharding.ShardRoutingMiddleware(view)
+        request = RequestFactory().get('/')
+        request.user = self.user
+        self.assertEqual(middleware(request).content.decode(), sharding.db_for_account(self.user))
+        request.user = AnonymousUser()
+        self.assertEqual(middleware(request).content, b'')
+        self.assertIsNone(sharding.current_account_id())
+
+    def test_pin_all(self):
+        with self.assertRaises(CommandError):
+            call_command('move_account_shard', pin_all=True, stdout=StringIO())
+        with self.shards:
+            call_command('move_account_shard', pin_all=True, stdout=StringIO())
+            placements = {user.pk: sharding.hashed_shard(user.pk) for user in User.objects.all()}
+        self.assertEqual(dict(AccountShard.objects.values_list('account', 'database')), placements)
+
+        # Accounts stay on their shards when one is added
+        with override_settings(PRODINFO_SHARDS=['default', 'shard', 'shard2']):
+            self.assertEqual({pk: sharding.db_for_account(pk) for pk in placements}, placements)
+
+
+class ShardingTest(InventoryDataMixin, TestCase):
+    """
+    The inventory is created on the default database before the shards are configured; each test copies
+    the catalogue to shard1 and moves the other user there
+    """
+
+    databases = {'default', 'shard1'}
+    shards = override_settings(PRODINFO_SHARDS=['default', 'shard1'])
+
+    def move_other(self):
+        # The inventory was created on the default database, whichever shard the accounts hash to
+        AccountShard.objects.bulk_create([AccountShard(account=user, database='default')
+                                          for user in (self.user, self.other)])
+        sharding.sync_catalogue()
+        return sharding.move_account(self.other, 'shard1')
+
+    @shards
+    def test_sync_catalogue(self):
+        self.assertEqual(sharding.sync_catalogue(), User.objects.count() + 6)
+        for model in (User, Company, Shop, Product):
+            self.assertEqual(list(model.objects.using('shard1').order_by('pk').values()),
+                             list(model.objects.order_by('pk').values()))
+
+    @shards
+    def test_mirror(self):
+        sharding.sync_catalogue()
+        milk = Product.objects.create(title='Молоко', company=self.company_a, ref_weight=900)
+        self.assertEqual(Product.objects.using('shard1').get(pk=milk.pk).ref_weight, 900)
+        milk.ref_weight = 1000
+        milk.save()
+        self.assertEqual(Product.objects.using('shard1').get(pk=milk.pk).ref_weight, 1000)
+        milk.delete()
+        self.assertFalse(Product.objects.using('shard1').filter(pk=milk.pk).exists())
+
+    @shards
+    def test_move_account(self):
+        created = ProdInfo.objects.get(account=self.other).time_create
+        self.assertEqual(self.move_other(), 1)
+        self.assertEqual(sharding.db_for_account(self.other), 'shard1')
+        self.assertEqual(AccountShard.objects.get(account=self.other).database, 'shard1')
+        self.assertEqual(ProdInfo.objects.using('shard1').get(account=self.other).time_create, created)
+        self.assertEqual(InventorySummary.objects.using('shard1').get(account=self.other).count, 1)
+        self.assertEqual(DailyRollup.objects.using('shard1').get(account=self.other).weight, 900)
+        for model in (ProdInfo, InventorySummary, DailyRollup):
+            self.assertFalse(model.objects.using('default').filter(account=self.other).exists())
+
+    @shards
+    def test_units_saved_on_account_shard(self):
+        self.move_other()
+        # Outside of an account scope, e.g. in a management command
+        unit = ProdInfo(title=self.sugar, account=self.other, company=self.company_a, shop=self.shop,
+                        cost=5, weight=600)
+        unit.save()
+        self.assertEqual(unit._state.db, 'shard1')
+        self.assertEqual(ProdInfo.objects.using('shard1').filter(account=self.other).count(), 2)
+        summary = InventorySummary.objects.using('shard1').get(account=self.other)
+        self.assertEqual((summary.count, summary.weight), (2, 1500))
+        self.assertEqual(DailyRollup.objects.using('shard1').get(account=self.other).count, 2)
+
+        unit.weight = 500
+        unit.save()
+        self.assertEqual(InventorySummary.objects.using('shard1').get(account=self.other).weight, 1400)
+        unit.delete()
+        self.assertEqual(InventorySummary.objects.using('shard1').get(account=self.other).count, 1)
+        # The edit is booked as the removal of the previous unit as well
+        self.assertEqual(DailyRollup.objects.using('shard1').get(account=self.other).removed_count, 2)
+        for model in (ProdInfo, InventorySummary, DailyRollup):
+            self.assertFalse(model.objects.using('default').filter(account=self.other).exists())
+
+    @shards
+    def test_other_database_rejected(self):
+        self.move_other()
+        unit = ProdInfo.objects.using('shard1').get(account=self.other)
+        unit.weight = 100
+        with self.assertRaises(ValueError):
+            unit.save(using='default')
+        with self.assertRaises(ValueError):
+            unit.delete(using='default')
+        self.assertEqual(ProdInfo.objects.using('shard1').get(pk=unit.pk).weight, 900)
+        self.assertEqual(InventorySummary.objects.using('shard1').get(account=self.other).count, 1)
+
+    @shards
+    def test_export_reads_shard(self):
+        self.move_other()
+        self.client.force_login(self.other)
+        response = self.client.get(reverse('export_units', kwargs={'export_format': 'jsonl'}))
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8-sig').splitlines()]
+        self.assertEqual([row['id'] for row in rows],
+                         list(ProdInfo.objects.using('shard1').filter(account=self.other).values_list('pk', flat=True)))
+        self.assertEqual(rows[0]['title'], 'Сахар')
+
+
+class ExportUnitsTest(InventoryDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def export(self, export_format, **params):
+        response = self.client.get(reverse('export_units', kwargs={'export_format': export_format}), params)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf-8-sig')
+
+    def test_csv(self):
+        rows = list(csv.DictReader(StringIO(self.export('csv'))))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual({row['title'] for row in rows}, {'Чай', 'Кофе'})
+        self.assertEqual((rows[0]['company'], rows[0]['shop'], rows[0]['weight']), ('Альфа', 'Склад', '100.0'))
+
+    def test_jsonl(self):
+        rows = [json.loads(line) for line in self.export('jsonl').splitlines()]
+        self.assertEqual([row['id'] for row in rows],
+                         list(ProdInfo.objects.filter(account=self.user).order_by('pk').values_list('pk', flat=True)))
+        self.assertEqual(rows[-1]['title'], 'Кофе')
+
+    def test_filters(self):
+        rows = self.export('jsonl', product=self.coffee.slug, shop=self.shop.slug).splitlines()
+        self.assertEqual(len(rows), 3)
+        today = timezone.localdate()
+        self.assertEqual(len(self.export('jsonl', date_from=today, date_to=today).splitlines()), 7)
+        self.assertEqual(self.export('jsonl', date_to=today - timezone.timedelta(days=1)), '')
+
+    def test_exported_csv_can_be_imported(self):
+        result = import_units(self.other, BytesIO(self.export('csv').encode()), 'inventory.csv')
+        self.assertEqual((result.created, result.errors), (7, []))
+
+    def test_invalid_requests(self):
+        url = reverse('export_units', kwargs={'export_format': 'csv'})
+        self.assertEqual(self.client.get(url, {'product': 'unknown'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'date_from': '2022-02-01', 'date_to': '2022-01-01'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('export_units', kwargs={'export_format': 'xml'})).status_code, 404)
+
+
+class ProductIndexTest(InventoryDataMixin, TestCase):
+
+    def test_index(self):
+        companies = product_index()['companies']
+        self.assertEqual(companies, {str(self.company_a.pk): [[self.sugar.pk, 'Сахар'], [self.tea.pk, 'Чай']],
+                                     str(self.company_b.pk): [[self.coffee.pk, 'Кофе']]})
+        with self.assertNumQueries(0):
+            product_index()
+
+    def test_company_titles(self):
+        response = self.client.get(reverse('ajax_load_objects'), {'company': self.company_b.pk})
+        self.assertEqual(response.json(), {'titles': [[self.coffee.pk, 'Кофе']]})
+        self.assertEqual(self.client.get(reverse('ajax_load_objects'), {'company': 0}).json(), {'titles': []})
+
+    def test_revalidation(self):
+        response = self.client.get(reverse('ajax_load_objects'))
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(self.client.get(reverse('ajax_load_objects'), HTTP_IF_NONE_MATCH=response['ETag'],
+                                         ).status_code, 304)
+        self.assertEqual(self.client.get(reverse('ajax_load_objects'),
+                                         HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(title='Какао', company=self.company_b, ref_weight=200)
+        response = self.client.get(reverse('ajax_load_objects'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['companies'][str(self.company_b.pk)]), 2)
+
+    def test_deleted_company(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.company_b.delete()
+        self.assertNotIn(str(self.company_b.pk), product_index()['companies'])
+
+    def test_embedded_in_add_page(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('add_product'))
+        self.assertContains(response, '<script id="product-index" type="application/json">')
+        self.assertContains(response, '"%s": [[%s, ' % (self.company_b.pk, self.coffee.pk))
+
+
+class AnalyticsTest(InventoryDataMixin, TestCase):
+
+    def test_product_stats(self):
+        stats = analytics.product_stats(self.user, [self.tea, self.coffee, self.sugar])
+        self.assertEqual(set(stats), {self.tea.pk, self.coffee.pk})
+        tea = stats[self.tea.pk]
+        self.assertEqual((tea['count'], tea['weight'], tea['cost'], tea['not_full']), (4, 280.5, 40, 2))
+        self.assertAlmostEqual(tea['fill_ratio'], 280.5 / 400)
+        self.assertAlmostEqual(tea['cost_per_gram'], 40 / 280.5)
+        for q, value in zip(analytics.PERCENTILES, np.percentile([100, 100, 80.5, 0], analytics.PERCENTILES)):
+            self.assertAlmostEqual(tea['percentiles'][q], value)
+        # Three priced units are too few to look for outliers
+        self.assertEqual((tea['outliers'], tea['outlier_ids']), (0, []))
+        self.assertEqual(stats[self.coffee.pk]['not_full'], 0)
+
+    def test_grouped_statistics_match_numpy(self):
+        rng = np.random.default_rng(0)
+        units = np.zeros(5000, dtype=analytics.UNIT_DTYPE)
+        units['pk'] = np.arange(len(units))
+        units['product'] = rng.integers(1, 30, len(units))
+        units['weight'] = np.round(rng.uniform(0, 100, len(units)), 1)
+        units['cost'] = rng.uniform(1, 50, len(units))
+        stats = analytics.compute_stats(units, {pk: 100 for pk in range(1, 30)})
+
+        for pk, product in stats.items():
+            group = units[units['product'] == pk]
+            self.assertEqual(product['count'], len(group))
+            self.assertEqual(product['not_full'], np.count_nonzero(group['weight'] != 100))
+            for q, value in product['percentiles'].items():
+                self.assertAlmostEqual(value, np.percentile(group['weight'], q))
+            priced = group[(group['weight'] > 0) & (group['cost'] > 0)]
+            price = priced['cost'] / priced['weight']
+            q1, q3 = np.percentile(price, [25, 75])
+            outlier = (price < q1 - 1.5 * (q3 - q1)) | (price > q3 + 1.5 * (q3 - q1))
+            self.assertEqual(product['outlier_ids'], sorted(priced['pk'][outlier].tolist()))
+
+    def test_tolerance_is_shared(self):
+        weights = (100, 100.05, 99.95, 100.06, 99.94, 80.5)
+        ProdInfo.objects.filter(title=self.tea).delete()
+        for weight in weights:
+            ProdInfo.objects.create(title=self.tea, account=self.user, weight=weight)
+
+        for abs_tolerance, rel_tolerance, expected in ((0, 0, 5), (0.05, 0, 3), (0.05, 0.25, 0), (20, 0, 0)):
+            with self.subTest(abs_tolerance=abs_tolerance, rel_tolerance=rel_tolerance), \
+                    override_settings(NOT_FULL_ABS_TOLERANCE=abs_tolerance, NOT_FULL_REL_TOLERANCE=rel_tolerance):
+                self.assertEqual(sum(is_not_full(weight, 100) for weight in weights), expected)
+                self.assertEqual(analytics.product_stats(self.user, [self.tea])[self.tea.pk]['not_full'], expected)
+                computed = InventorySummary.objects.computed([self.user]).get(product=self.tea.pk)
+                self.assertEqual(computed['not_full'], expected)
+                shops = shop_breakdown_queryset(self.user, self.tea, 100)
+                self.assertEqual(sum(shop['not_full'] for shop in shops), expected)
+
+    def test_pages_show_statistics(self):
+        self.client.force_login(self.user)
+        ProdInfo.objects.filter(title=self.coffee).update(cost=100)
+        expensive = ProdInfo.objects.create(title=self.coffee, account=self.user, weight=250.5, cost=5000)
+        ProdInfo.objects.create(title=self.coffee, account=self.user, weight=250.5, cost=100)
+
+        response = self.client.get(reverse('detail', kwargs={'product_slug': self.coffee.slug}))
+        self.assertEqual(response.context['stats']['outlier_ids'], [expensive.pk])
+        self.assertEqual([unit['pk'] for unit in response.context['product_set'] if unit['outlier']], [expensive.pk])
+        self.assertContains(response, 'выбросов цены: 1')
+
+        # The cards take the fill ratio and the cost per gram from the summary rows
+        with mock.patch('crm.utils1.product_stats') as product_stats:
+            response = self.client.get(reverse('home'))
+        product_stats.assert_not_called()
+        stats = analytics.product_stats(self.user, [self.tea])
+        cards = {card['product']: card for card in inventory_cards(response.context['summary'])}
+        self.assertEqual(cards[self.tea]['fill_percent'], round(stats[self.tea.pk]['fill_ratio'] * 100))
+        self.assertAlmostEqual(cards[self.tea]['cost_per_gram'], stats[self.tea.pk]['cost_per_gram'])
+        self.assertContains(response, 'Заполненность: 70%')
+
+
+class DetailPageTest(InventoryDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+        self.url = reverse('detail', kwargs={'product_slug': self.tea.slug})
+
+    def add_units(self, count):
+        ProdInfo.objects.bulk_create([ProdInfo(title=self.tea, account=self.user, company=self.company_a,
+                                               cost=number, weight=100) for number in range(count)])
+        InventorySummary.objects.rebuild([self.user])
+
+    def test_aggregates(self):
+        response = self.client.get(self.url)
+        totals = response.context['totals']
+        self.assertEqual((totals['count'], totals['not_full'], totals['weight'], totals['cost']), (4, 2, 280.5, 40))
+        self.assertAlmostEqual(totals['average_weight'], 70.125)
+        self.assertEqual(totals['average_cost'], 10)
+        self.assertEqual(list(response.context['shops']), [
+            {'shop__shop': 'Склад', 'count': 4, 'not_full': 2, 'weight': 280.5, 'cost': 40},
+        ])
+        self.assertEqual([unit['weight'] for unit in response.context['product_set']], [0, 80.5, 100, 100])
+        self.assertIsNone(response.context['next_cursor'])
+        self.assertIsNone(response.context['previous_cursor'])
+
+    def test_keyset_pages(self):
+        self.add_units(DETAIL_PAGE_SIZE * 2)
+        expected = list(ProdInfo.objects.filter(account=self.user, title=self.tea)
+                        .order_by('-time_create', '-pk').values_list('pk', flat=True))
+        seen, cursor, pages = [], None, []
+        while True:
+            response = self.client.get(self.url, {'after': cursor} if cursor else {})
+            pages.append(response.context)
+            seen.extend(unit['pk'] for unit in response.context['product_set'])
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(pages), 3)
+
+        back = self.client.get(self.url, {'before': pages[2]['previous_cursor']})
+        self.assertEqual([unit['pk'] for unit in back.context['product_set']],
+                         [unit['pk'] for unit in pages[1]['product_set']])
+        self.assertEqual(back.context['next_cursor'], pages[1]['next_cursor'])
+        self.assertEqual(back.context['previous_cursor'], pages[1]['previous_cursor'])
+
+    def test_deep_page_queries(self):
+        self.add_units(DETAIL_PAGE_SIZE * 3)
+        first = self.client.get(self.url)
+        with self.assertNumQueries(6):
+            self.client.get(self.url)
+        last = ProdInfo.objects.filter(account=self.user, title=self.tea).order_by('time_create', 'pk').values(
+            'pk', 'time_create')[DETAIL_PAGE_SIZE]
+        with self.assertNumQueries(6):
+            response = self.client.get(self.url, {'after': encode_cursor(last)})
+        self.assertEqual(len(response.context['product_set']), DETAIL_PAGE_SIZE)
+        self.assertEqual(len(first.context['product_set']), DETAIL_PAGE_SIZE)
+
+    def test_cursor(self):
+        unit = ProdInfo.objects.values('pk', 'time_create').first()
+        self.assertEqual(decode_cursor(encode_cursor(unit)), (unit['time_create'], unit['pk']))
+        for value in ('garbage', 'bm90fGE', ''):
+            self.assertIsNone(decode_cursor(value))
+        self.assertEqual(self.client.get(self.url, {'after': 'garbage'}).status_code, 404)
+
+
+class DailyRollupTest(InventoryDataMixin, TestCase):
+
+    def stored(self):
+        return sorted((row.account_id, row.product_id, row.day, row.count, row.weight, row.cost)
+                      for row in DailyRollup.objects.all())
+
+    def computed(self):
+        return sorted((row['account'], row['product'], row['day'], row['count'], row['weight'], row['cost'])
+                      for row in DailyRollup.objects.computed())
+
+    def backdate(self, days):
+        """Moves the tea units of the user to the given numbers of days ago and backfills the rollups"""
+
+        for unit, ago in zip(ProdInfo.objects.filter(account=self.user, title=self.tea).order_by('pk'), days):
+            ProdInfo.objects.filter(pk=unit.pk).update(time_create=timezone.now() - datetime.timedelta(days=ago))
+        call_command('backfill_rollups', stdout=StringIO())
+
+    def stock(self):
+        totals = {field: Sum(F(field) - F('removed_' + field)) for field in ('count', 'weight', 'cost')}
+        return sorted((row['account'], row['product'], row['count'], row['weight'], row['cost'])
+                      for row in DailyRollup.objects.values('account', 'product').annotate(**totals)
+                      .filter(count__gt=0).order_by())
+
+    def test_incremental_matches_computed(self):
+        self.assertEqual(self.stored(), self.computed())
+        unit = ProdInfo.objects.filter(account=self.user, title=self.tea).first()
+        unit.weight, unit.cost = 50, 30
+        unit.save()
+        ProdInfo.objects.filter(account=self.user, title=self.coffee).first().delete()
+        for unit in ProdInfo.objects.filter(title=self.sugar):
+            unit.delete()
+        # The added minus the removed units of each product are the units in stock
+        self.assertEqual(self.stock(), sorted((row['account'], row['product'], row['count'], row['weight'],
+                                               row['cost']) for row in InventorySummary.objects.computed()))
+
+    def test_removal_booked_on_its_day(self):
+        self.backdate((10, 10, 3, 0))
+        today = timezone.localdate()
+        earlier = [(day['day'], day['total_count'], day['total_weight'])
+                   for day in inventory_history(self.user, self.tea) if day['day'] < today]
+        unit = ProdInfo.objects.filter(account=self.user, title=self.tea).order_by('pk').first()
+        unit.weight = 30
+        unit.save()
+        ProdInfo.objects.filter(account=self.user, title=self.tea).order_by('pk')[1].delete()
+
+        days = inventory_history(self.user, self.tea)
+        self.assertEqual([(day['day'], day['total_count'], day['total_weight'])
+                          for day in days if day['day'] < today], earlier)
+        self.assertEqual((days[-1]['day'], days[-1]['count'], days[-1]['removed_count'], days[-1]['total_count']),
+                         (today, 2, 2, 3))
+        self.assertEqual(days[-1]['total_weight'], InventorySummary.objects.get(account=self.user,
+                                                                                product=self.tea).weight)
+
+    def test_backfill(self):
+        DailyRollup.objects.all().delete()
+        output = StringIO()
+        call_command('backfill_rollups', user=['other'], stdout=output)
+        self.assertIn('Backfilled 1 daily rollups', output.getvalue())
+        call_command('backfill_rollups', stdout=StringIO())
+        self.assertEqual(self.stored(), self.computed())
+        with self.assertRaises(CommandError):
+            call_command('backfill_rollups', user=['nobody'], stdout=StringIO())
+
+    def test_history(self):
+        self.backdate((10, 10, 3, 0))
+        today = timezone.localdate()
+        days = inventory_history(self.user, self.tea)
+        self.assertEqual([(day['day'], day['count'], day['total_count']) for day in days], [
+            (today - datetime.timedelta(days=10), 2, 2),
+            (today - datetime.timedelta(days=3), 1, 3),
+            (today, 1, 4),
+        ])
+        self.assertEqual(days[-1]['total_weight'], 280.5)
+
+        days = inventory_history(self.user, date_from=today - datetime.timedelta(days=5),
+                                 date_to=today - datetime.timedelta(days=1))
+        self.assertEqual([(day['count'], day['total_count'], day['total_weight']) for day in days], [(1, 3, 280.5)])
+
+    def test_history_views(self):
+        self.backdate((1, 1, 1, 1))
+        self.client.force_login(self.user)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('history_json'), {'product': self.tea.slug})
+        self.assertEqual(response.json(), {'days': [{
+            'day': (timezone.localdate() - datetime.timedelta(days=1)).isoformat(),
+            'count': 4, 'weight': 280.5, 'cost': 40.0, 'removed_count': 0, 'removed_weight': 0.0, 'removed_cost': 0.0,
+            'total_count': 4, 'total_weight': 280.5, 'total_cost': 40.0,
+        }]})
+        response = self.client.get(reverse('history_json'), {'date_from': '2022-02-01', 'date_to': '2022-01-01'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('history'))
+        self.assertContains(response, 'В наличии')
+        self.assertEqual(response.context['days'][-1]['total_count'], 7)
+
+
+class SyntheticDataTest(TestCase):
+
+    def test_generate(self):
+        data = synthetic.generate(users=3, companies=2, shops=2, products=10, units=300, prefix='test')
+        self.assertEqual(ProdInfo.objects.count(), 300)
+        self.assertEqual(InventorySummary.objects.aggregate(units=Sum('count'))['units'], 300)
+        self.assertEqual(DailyRollup.objects.aggregate(units=Sum('count'))['units'], 300)
+        counts = [ProdInfo.objects.filter(account=user).count() for user in data.users]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        self.assertTrue(search_products(data.users[0], 'Чай'))
+        call_command('rebuild_inventory_summary', check=True, stdout=StringIO())
+
+    def test_same_seed_same_data(self):
+        first = synthetic.generate(users=2, products=5, units=50, prefix='first', seed=1)
+        second = synthetic.generate(users=2, products=5, units=50, prefix='second', seed=1)
+        weights = [list(ProdInfo.objects.filter(account__in=data.users).order_by('pk').values_list('weight', flat=True))
+                   for data in (first, second)]
+        self.assertEqual(weights[0], weights[1])
+
+
+class BenchmarkTest(TestCase):
+
+    def test_query_counts_do_not_grow(self):
+        results = benchmarks.run(sizes=(100, 1000), repeat=1)
+        self.assertEqual(len(results), 2 * len(benchmarks.SCENARIOS))
+        self.assertEqual(benchmarks.check_query_growth(results), [])
+        self.assertEqual(ProdInfo.objects.count(), 0)
+
+    def test_growth_is_reported(self):
+        results = [{'scenario': 'main_page', 'size': size, 'queries_cold': queries, 'queries_warm': 1}
+                   for size, queries in ((1000, 12), (100, 5))]
+        self.assertEqual(benchmarks.check_query_growth(results),
+                         ['main_page: queries_cold grew from 5 at size 100 to 12 at size 1000'])
+
+
+class MetricsTest(InventoryDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+        self.client.force_login(self.user)
+
+    def test_server_timing(self):
+        response = self.client.get(reverse('home'))
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'db', 'tpl', 'total'})
+        self.assertRegex(timing['db'], r'^dur=[\d.]+;desc="[1-9]\d* queries"$')
+
+    def test_histograms_by_url_name(self):
+        self.client.get(reverse('home'))
+        self.client.get(reverse('home'))
+        self.client.get(reverse('detail', kwargs={'product_slug': self.tea.slug}))
+        self.assertEqual(metrics.REQUEST_DURATION.series['home'][2], 2)
+        self.assertEqual(metrics.REQUEST_DURATION.series['detail'][2], 1)
+        self.assertGreater(metrics.TEMPLATE_DURATION.series['home'][1], 0)
+        self.assertEqual(sum(metrics.SQL_QUERIES.series['home'][0]), 2)
+
+    def test_prometheus_endpoint(self):
+        self.client.get(reverse('home'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        content = response.content.decode()
+        self.assertIn('# TYPE crm_request_duration_seconds histogram', content)
+        self.assertIn('crm_request_duration_seconds_bucket{view="home",le="+Inf"} 1', content)
+        self.assertIn('crm_request_duration_seconds_count{view="home"} 1', content)
+
+    def test_endpoint_restricted_by_address(self):
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+
+class ProfilingTest(InventoryDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        settings_override = override_settings(PROFILING_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        self.client.force_login(self.user)
+
+    def test_requested_by_staff(self):
+        response = self.client.get(reverse('home'), HTTP_X_PROFILE='1')
+        name = response['X-Profile']
+        self.assertTrue(os.path.exists(os.path.join(self.directory, name + '.prof')))
+        profile = profiling.load()[0]
+        self.assertEqual((profile['name'], profile['view'], profile['user'], profile['trigger']),
+                         (name, 'home', 'storekeeper', 'requested'))
+        self.assertEqual(len(profile['queries']), profile['sql_count'])
+        self.assertTrue(any('crm_inventorysummary' in query['sql'] for query in profile['queries']))
+
+    def test_ignored_for_other_users(self):
+        self.client.force_login(self.other)
+        response = self.client.get(reverse('home'), {'_profile': 1})
+        self.assertNotIn('X-Profile', response)
+        self.assertEqual(profiling.load(), [])
+
+    def test_sampled_requests_kept_when_slow(self):
+        self.client.force_login(self.other)
+        with override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_SLOW_THRESHOLD=60):
+            self.client.get(reverse('home'))
+        self.assertEqual(profiling.load(), [])
+        with override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_SLOW_THRESHOLD=0):
+            self.client.get(reverse('home'))
+        self.assertEqual(profiling.load()[0]['trigger'], 'sampled')
+
+    def test_rotation_and_command(self):
+        with override_settings(PROFILING_MAX_FILES=2):
+            names = [self.client.get(reverse('home'), {'_profile': 1})['X-Profile'] for _ in range(3)]
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted(name + extension for name in names[1:] for extension in ('.json', '.prof')))
+
+        output = StringIO()
+        call_command('list_profiles', stdout=output)
+        self.assertEqual(len(output.getvalue().splitlines()), 2)
+        output = StringIO()
+        call_command('list_profiles', names[-1], limit=5, stdout=output)
+        self.assertIn('Slowest queries:', output.getvalue())
+        self.assertIn('function calls', output.getvalue())
+
+
+class AsyncViewsParityTest(InventoryDataMixin, TestCase):
+    """The asynchronous views must produce the same responses as the synchronous ones, with a cold cache"""
+
+    def responses(self, sync_view, async_view, path, data=None, **kwargs):
+        results = []
+        for view, call in ((sync_view, lambda view, request: view(request, **kwargs)),
+                           (async_view, lambda view, request: async_to_sync(view)(request, **kwargs))):
+            cache.clear()
+            request = RequestFactory().get(path, data or {})
+            request.user = self.user
+            response = call(view, request)
+            if hasattr(response, 'render'):
+                response.render()
+            results.append(response)
+        return results
+
+    def assertSameResponse(self, sync_view, async_view, path, data=None, **kwargs):
+        sync_response, async_response = self.responses(sync_view, async_view, path, data, **kwargs)
+        self.assertEqual(sync_response.status_code, 200)
+        self.assertEqual(async_response.status_code, 200)
+        self.assertEqual(sync_response.content.decode(), async_response.content.decode())
+        return async_response
+
+    def test_main_page(self):
+        for number in range(12):
+            product = Product.objects.create(title='Товар %02d' % number, company=self.company_a, ref_weight=1)
+            ProdInfo.objects.create(title=product, account=self.user, company=self.company_a, weight=1)
+        for page in (None, 2, 'last'):
+            response = self.assertSameResponse(views.MainPage.as_view(), async_views.AsyncMainPage.as_view(), '/',
+                                               {'page': page} if page else None)
+            self.assertContains(response, 'class="card"')
+
+    def test_more_cards(self):
+        for number in range(12):
+            product = Product.objects.create(title='Товар %02d' % number, company=self.company_a, ref_weight=1)
+            ProdInfo.objects.create(title=product, account=self.user, company=self.company_a, weight=1)
+        InventorySummary.objects.rebuild([self.user])
+        response = self.assertSameResponse(views.MoreCards.as_view(), async_views.AsyncMoreCards.as_view(), '/cards/')
+        self.assertContains(response, 'class="next"')
+        cursor = json.loads(self.assertSameResponse(views.MoreCards.as_view(as_json=True),
+                                                    async_views.AsyncMoreCards.as_view(as_json=True),
+                                                    '/cards/json/').content)['next_cursor']
+        response = self.assertSameResponse(views.MoreCards.as_view(), async_views.AsyncMoreCards.as_view(), '/cards/',
+                                           {'after': cursor})
+        self.assertContains(response, 'class="card"')
+
+    def test_search(self):
+        response = self.assertSameResponse(views.Search.as_view(), async_views.AsyncSearch.as_view(),
+                                           '/search_result/', {'q': 'Кофе'})
+        self.assertContains(response, 'Кофе')
+        self.assertSameResponse(views.Search.as_view(), async_views.AsyncSearch.as_view(), '/search_result/')
+
+    def test_detail(self):
+        self.assertSameResponse(views.Detail.as_view(), async_views.AsyncDetail.as_view(), '/detail/chaj/',
+                                product_slug=self.tea.slug)
+        ProdInfo.objects.bulk_create([ProdInfo(title=self.tea, account=self.user, weight=100)
+                                      for _ in range(DETAIL_PAGE_SIZE)])
+        InventorySummary.objects.rebuild([self.user])
+        unit = ProdInfo.objects.filter(title=self.tea).order_by('-time_create', '-pk').values('pk', 'time_create')[5]
+        for data in ({'after': encode_cursor(unit)}, {'before': encode_cursor(unit)}):
+            self.assertSameResponse(views.Detail.as_view(), async_views.AsyncDetail.as_view(), '/detail/chaj/',
+                                    data, product_slug=self.tea.slug)
+
+    def test_load_titles(self):
+        for data in (None, {'company': self.company_a.pk}):
+            sync_response, async_response = self.responses(views.load_titles, async_views.load_titles,
+                                                           '/ajax/load_objects', data)
+            self.assertEqual(json.loads(sync_response.content), json.loads(async_response.content))
+            self.assertEqual(sync_response['Cache-Control'], async_response['Cache-Control'])
+        request = RequestFactory().get('/ajax/load_objects', data, HTTP_IF_NONE_MATCH=async_response['ETag'])
+        self.assertEqual(async_to_sync(async_views.load_titles)(request).status_code, 304)
+
+    def test_errors(self):
+        for view, path, kwargs in ((async_views.AsyncMainPage.as_view(), '/?page=5', {}),
+                                   (async_views.AsyncDetail.as_view(), '/detail/unknown/', {'product_slug': 'x'})):
+            request = RequestFactory().get(path)
+            request.user = self.user
+            with self.assertRaises(Http404):
+                async_to_sync(view)(request, **kwargs)
+
+    def test_login_required(self):
+        from django.contrib.auth.models import AnonymousUser
+
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        response = async_to_sync(async_views.AsyncMainPage.as_view())(request)
+        self.assertEqual(response.status_code, 302)
@@ -1,23 +1,41 @@
+from django.conf import settings
 from django.urls import path, re_path
 from django.views.decorators.cache import cache_page
 
+from . import api, captcha_pool
 from .views import *
 
+if settings.ASYNC_VIEWS:
+    # Under an ASGI server the read-heavy views are served by their asynchronous versions
+    from .async_views import AsyncDetail as Detail, AsyncMainPage as MainPage, AsyncMoreCards as MoreCards, \
+        AsyncSearch as Search, load_titles
+
 urlpatterns = [
     path('', MainPage.as_view(), name='home'),
+    path('cards/', MoreCards.as_view(), name='more_cards'),
+    path('cards/json/', MoreCards.as_view(as_json=True), name='more_cards_json'),
     path('detail/<slug:product_slug>/', Detail.as_view(), name='detail'),
     path('detail/<slug:product_slug>/<int:prodinfo_id>/', DetailProdInfoEdit.as_view(), name='edit_prodinfo'),
     path('detail/<slug:product_slug>/<int:prodinfo_id>/delete', DetailProdInfoDelete.as_view(), name='delete_prodinfo'),
     path('detail/<slug:product_slug>/detail_product/', DetailProductEdit.as_view(), name='edit_product'),
     path('detail/<slug:product_slug>/add_prodinfo/', DetailProdInfoAdd.as_view(), name='add_prodinfo_detail'),
+    path('detail/<slug:product_slug>/add_units/', DetailAddUnits.as_view(), name='add_units_detail'),
     path('add_company/', AddCompany.as_view(), name='add_company'),
     path('add_shop/', AddShop.as_view(), name='add_shop'),
     path('add_newproduct/', AddNewProduct.as_view(), name='add_newproduct'),
     path('add_product/', AddProduct.as_view(), name='add_product'),
+    path('add_units/', AddUnits.as_view(), name='add_units'),
+    path('import_units/', ImportUnits.as_view(), name='import_units'),
+    path('export/<str:export_format>/', ExportUnits.as_view(), name='export_units'),
+    path('history/', InventoryHistory.as_view(), name='history'),
+    path('history/json/', InventoryHistory.as_view(as_json=True), name='history_json'),
     path('ajax/load_objects', load_titles, name='ajax_load_objects'),
     path('login/', LoginUser.as_view(), name='login'),
     path('search_result/', Search.as_view(), name='search_result'),
     path('logout/', logout_user, name='logout'),
     path('registration/', RegUser.as_view(), name='reguser'),
     path("password_reset/", password_reset_request, name='password_reset'),
+    path('metrics', metrics_view, name='metrics'),
+    path('captcha_image/<str:key>/', captcha_pool.image_view, name='captcha_pool_image'),
+    path('api/v1/<str:resource>/', api.resource_view, name='api_v1'),
 ]
\ No newline at end of file
@@ -1,6 +1,23 @@
-from django.db.models import Sum, Count, Q
+import base64
+import hashlib
+import json
 
+from django.core.cache import cache as default_cache
+from django.core.paginator import Paginator
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+from django.http import Http404
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from django.utils.http import urlencode
+
+from . import cache
+from .analytics import product_stats
 from .models import *
+from .search import search_products
 
 "List containing information for loading buttons to create new model units"
 add_dict = [
@@ -8,8 +25,17 @@ add_dict = [
     {'title': 'Новый магазин', 'address': 'add_shop'},
     {'title': 'Добавить новый товар', 'address': 'add_newproduct'},
     {'title': 'Добавить единицу товара', 'address': 'add_product'},
+    {'title': 'Импорт из файла', 'address': 'import_units'},
 ]
 
+PRODUCT_INDEX_KEY = 'crm:product_index'
+
+"Number of units on a page of the Detail view"
+DETAIL_PAGE_SIZE = 50
+
+"Number of cards on a page of the main page and in a batch loaded by the infinite scroll"
+CARDS_PAGE_SIZE = 10
+
 
 def query_context(user, context=None, get_request=None):
     """
@@ -24,7 +50,7 @@ def query_context(user, context=None, get_request=None):
     context: dict, optional
         Passing a context, otherwise creating an empty context
     get_request: str, optional
-        If there is a get request then filter the model Product by request. Built for Search class
+        If there is a get request then find the products of the user matching the request in the search index
 
     Returns
     ----------
@@ -38,12 +64,12 @@ def query_context(user, context=None, get_request=None):
         context = dict()
 
     if get_request:
-        context['products'] = Product.objects.filter(
-            Q(title__icontains=get_request) | Q(company__company__icontains=get_request)
-        )
+        found = search_products(user, get_request)
+        products = Product.objects.select_related('company').in_bulk(found)
+        context['products'] = [products[pk] for pk in found]
 
-    counting = list(ProdInfo.objects.filter(account=user).values('title', 'weight'))
-    if len(counting) == 0:
+    count_sum = inventory_summary(user)
+    if len(count_sum) == 0:
         # If the product model list is empty for the current user, then return an empty dict with loading buttons
         # to create new model units
 
@@ -52,41 +78,468 @@ def query_context(user, context=None, get_request=None):
         return context
 
     context['add_dict'] = add_dict
+    context['count_sum'] = count_sum
+    return context
+
+
+def inventory_summary(user, products=None):
+    """
+    Function to load the inventory totals of the user from the InventorySummary model.
+    For each product it returns the number of units, their total weight and the number of units whose
+    weight does not match the ref_weight field from the Product model.
+
+    Parameters
+    ----------
+    user: str
+        Username to filter data from InventorySummary model
+    products: iterable, optional
+        Product objects, ids or a QuerySet to restrict the summary to
 
-    # ------------------------------------------------------------------------
-    # QuerySet-list for the template with filtering by product name and company.
-    # The list also contains a unique item count and a total weight count.
+    Returns
+    ----------
+    count_sum: list
+        List of dicts with the keys 'title', 'company', 'count', 'weight' and 'not_full',
+        ordered by the product title. The summary of the whole inventory is cached for the user.
+    """
 
-    count_sum = list(ProdInfo.objects.filter(account=user).values('title', 'company')
-                     .annotate(count=Count('title'),
-                               weight=Sum('weight'))
-                     .order_by('title')
-                     )
+    summary = InventorySummary.objects.filter(account=user)
+    if products is not None:
+        summary = summary.filter(product__in=products)
 
-    # print('counting =', counting, len(counting))
-    # print('count_sum =', count_sum, len(count_sum))
+    def load():
+        return list(summary.values('count', 'weight', 'not_full', title=F('product'), company=F('product__company'))
+                    .order_by('product__title')
+                    )
 
-    # products list for selecting the value of ref_weight for each object from counting
-    products = list(Product.objects.values('id', 'ref_weight'))
-    for p in counting:
-        ref = [obj['ref_weight'] for obj in products if p['title'] == obj['id']][0]
+    if products is not None:
+        return load()
+    return cache.get_or_set(user, 'summary', load)
 
-        # assigning to the 'not_full' variable an item of the 'count_sum' list that matches the id of
-        # the 'counting' list
-        for c_s in count_sum:
-            if p['title'] == c_s['title']:
-                not_full = c_s
 
-        # counting elements of the 'counting' list that do not match 'ref_weight'
-        cnt = 0
-        for c in counting:
-            if c['title'] == p['title'] and c['weight'] != ref:
-                cnt += 1
+def summary_rows(user, product_ids):
+    """
+    Function to load InventorySummary rows of the user for the given products, keeping the order of the ids.
 
-        # assigning a new key-value to the selected element count_sum
-        not_full['not_full'] = cnt
+    Parameters
+    ----------
+    user: str
+        Username to filter data from InventorySummary model
+    product_ids: list
+        Ids of the products, e.g. the current page of search results
 
-    # assigning the dictionary "context" the list "count_sum" together with the keys "not_full"
-    context['count_sum'] = count_sum
-    return context
+    Returns
+    ----------
+    summary: list
+        InventorySummary objects with the product and its company loaded
+    """
+
+    rows = {row.product_id: row for row in (InventorySummary.objects.filter(account=user, product__in=product_ids)
+                                            .select_related('product__company'))}
+    return [rows[pk] for pk in product_ids if pk in rows]
+
+
+def inventory_cards(summary):
+    """
+    Function to turn InventorySummary rows into ready-to-render cards for the main page.
+
+    Parameters
+    ----------
+    summary: iterable
+        InventorySummary objects loaded with select_related('product__company')
+
+    Returns
+    ----------
+    cards: list
+        List of dicts with the product, its company, url and photo url, the count of units,
+        the total weight, the number of units that do not match ref_weight, the fill ratio in percent
+        and the cost per gram. All of them come from the summary row, the statistics of crm.analytics
+        are computed only on the Detail page.
+    """
+
+    cards = []
+    for row in summary:
+        product = row.product
+        full_weight = row.count * product.ref_weight
+        cards.append({
+            'product': product,
+            'title': product.title,
+            'company': product.company,
+            'url': product.get_absolute_url(),
+            'photo_url': product.photo.url if product.photo else '',
+            'count': row.count,
+            'weight': row.weight,
+            'not_full': row.not_full,
+            'fill_percent': round(row.weight / full_weight * 100) if full_weight > 0 else None,
+            'cost_per_gram': row.cost / row.weight if row.weight > 0 else None,
+        })
+    return cards
+
+
+def cached_cards_html(user, name, summary, *parts):
+    """
+    Function to render the cards of a page with the crm/card_list.html template, cached for the user.
+
+    Parameters
+    ----------
+    user: str
+        Owner of the cards
+    name: str
+        Name of the cached fragment
+    summary: callable
+        Loads the InventorySummary rows of the page; it is called only on a cache miss
+    parts: optional
+        Values the fragment depends on, e.g. the page number
+    """
+
+    return cache.get_or_set(user, name, lambda: render_to_string('crm/card_list.html', {
+        'cards': inventory_cards(summary()),
+    }), *parts)
+
+
+def cards_queryset(user):
+    """Function to select the InventorySummary rows of the main page cards, ordered by the product title"""
+
+    return (InventorySummary.objects.filter(account=user)
+            .select_related('product__company')
+            .order_by('product__title', 'product_id'))
+
+
+def cards_batch_queryset(user, after=None, size=CARDS_PAGE_SIZE):
+    """
+    Function to select a batch of the main page cards with keyset pagination over (product title, product id).
+    A batch is found through the order of the titles instead of skipping the previous rows, and one more row
+    than size is selected to tell whether there are more cards.
+
+    Parameters
+    ----------
+    user: str
+        Owner of the cards
+    after: tuple, optional
+        Decoded cursor; the batch starts after this position
+    size: int, optional
+        Number of cards in a batch
+    """
+
+    summary = cards_queryset(user)
+    if after:
+        title, pk = after
+        summary = summary.filter(Q(product__title__gt=title) | Q(product__title=title, product_id__gt=pk))
+    return summary[:size + 1]
+
+
+def cards_batch(rows, size=CARDS_PAGE_SIZE):
+    """
+    Function to render a batch of cards and find the cursor of the next batch.
+
+    Parameters
+    ----------
+    rows: list
+        InventorySummary rows of the batch and, when there are more cards, the first row after it
+    size: int, optional
+        Number of cards in a batch
+
+    Returns
+    ----------
+    batch: dict
+        'cards_html' with the rendered cards and 'next_cursor', None for the last batch
+    """
+
+    more = len(rows) > size
+    rows = rows[:size]
+    return {
+        'cards_html': render_to_string('crm/card_list.html', {'cards': inventory_cards(rows)}),
+        'next_cursor': encode_card_cursor(rows[-1]) if more and rows else None,
+    }
+
+
+def cached_cards_batch(user, name, summary, *parts):
+    """
+    Function to render a batch of cards with cards_batch, cached for the user.
+
+    Parameters
+    ----------
+    user: str
+        Owner of the cards
+    name: str
+        Name of the cached batch
+    summary: callable
+        Loads the InventorySummary rows of the batch with one more row; it is called only on a cache miss
+    parts: optional
+        Values the batch depends on, e.g. the cursor
+    """
+
+    return cache.get_or_set(user, name, lambda: cards_batch(list(summary())), *parts)
+
+
+def encode_card_cursor(row):
+    """Function to encode the (product title, product id) position of a card as an opaque URL-safe cursor"""
+
+    value = '%d|%s' % (row.product_id, row.product.title)
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_card_cursor(cursor):
+    """Function to decode a cursor made by encode_card_cursor, returning None for an invalid one"""
+
+    try:
+        pk, title = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|', 1)
+        return title, int(pk)
+    except ValueError:
+        return None
+
+
+def card_cursor(request):
+    """Function to read the ?after= cursor of a batch of cards, an invalid cursor is a missing page"""
+
+    value = request.GET.get('after', '')
+    cursor = decode_card_cursor(value) if value else None
+    if value and cursor is None:
+        raise Http404('Страница не найдена')
+    return value, cursor
+
+
+def cards_batch_url(cursor, as_json=False):
+    """Function to build the URL of the batch of cards after a cursor, None without a cursor"""
+
+    if not cursor:
+        return None
+    return '%s?%s' % (reverse('more_cards_json' if as_json else 'more_cards'), urlencode({'after': cursor}))
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator taking the total number of objects from the versioned cache of the user"""
+
+    def __init__(self, *args, user=None, name='count', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = user
+        self.name = name
+
+    @cached_property
+    def count(self):
+        return cache.get_or_set(self.user, self.name, lambda: Paginator.count.func(self))
+
+
+def product_index():
+    """
+    Function to get the index of the products of each company, used by the dependent product dropdowns.
+    The index is shared by all users and cached until a product is saved or deleted (see crm.signals).
+
+    Returns
+    ----------
+    index: dict
+        'companies' maps company ids (as strings, like the keys of a JSON object) to lists of [id, title] pairs
+        ordered by title; 'etag' is a hash of the content and 'modified' the time the index was built
+    """
+
+    return default_cache.get_or_set(PRODUCT_INDEX_KEY, lambda: build_product_index(product_index_rows()), None)
+
+
+def product_index_rows():
+    return (Product.objects.filter(company__isnull=False).order_by('title', 'pk')
+            .values_list('pk', 'company', 'title'))
+
+
+def build_product_index(rows):
+    """Function to build the product index from (id, company id, title) rows"""
+
+    companies = {}
+    for pk, company_id, title in rows:
+        companies.setdefault(str(company_id), []).append([pk, title])
+    content = json.dumps(companies, sort_keys=True).encode()
+    return {'companies': companies, 'etag': hashlib.md5(content, usedforsecurity=False).hexdigest(),
+            'modified': timezone.now().replace(microsecond=0)}
+
+
+def invalidate_product_index():
+    default_cache.delete(PRODUCT_INDEX_KEY)
+
+
+def encode_cursor(unit):
+    """Function to encode the (time_create, pk) position of a unit as an opaque URL-safe cursor"""
+
+    value = '%s|%d' % (unit['time_create'].isoformat(), unit['pk'])
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Function to decode a cursor made by encode_cursor, returning None for an invalid one"""
+
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        time_create, pk = value.split('|')
+        time_create = parse_datetime(time_create)
+        return (time_create, int(pk)) if time_create else None
+    except ValueError:
+        return None
+
+
+def detail_cursors(request):
+    """Function to read the ?after= and ?before= cursors of the Detail page, an invalid cursor is a missing page"""
+
+    cursors = []
+    for name in ('after', 'before'):
+        value = request.GET.get(name)
+        cursor = decode_cursor(value) if value else None
+        if value and cursor is None:
+            raise Http404('Страница не найдена')
+        cursors.append(cursor)
+    return cursors
+
+
+def units_page_queryset(user, product, after=None, before=None, size=DETAIL_PAGE_SIZE):
+    """
+    Function to select a page of the units of a product with keyset pagination over (time_create, pk),
+    newest first. A page is found through the index instead of skipping the previous rows,
+    so every page costs the same as the first one.
+
+    Parameters
+    ----------
+    user: str
+        Owner of the units
+    product: Product or dict
+        Product of the units, or lookups selecting it, e.g. {'title__slug': slug}
+    after: tuple, optional
+        Decoded cursor; the page starts after this position
+    before: tuple, optional
+        Decoded cursor; the page ends before this position. The rows are then in the reverse order
+    size: int, optional
+        Number of units on a page; one more row is selected to tell whether there are more
+
+    Returns
+    ----------
+    units: QuerySet
+        Dicts with the keys 'pk', 'shop__shop', 'cost', 'weight' and 'time_create'
+    """
+
+    units = ProdInfo.objects.filter(account=user, **(product if isinstance(product, dict) else {'title': product}))
+    if before:
+        time_create, pk = before
+        units = (units.filter(Q(time_create__gt=time_create) | Q(time_create=time_create, pk__gt=pk))
+                 .order_by('time_create', 'pk'))
+    else:
+        if after:
+            time_create, pk = after
+            units = units.filter(Q(time_create__lt=time_create) | Q(time_create=time_create, pk__lt=pk))
+        units = units.order_by('-time_create', '-pk')
+    return units.values('pk', 'shop__shop', 'cost', 'weight', 'time_create')[:size + 1]
+
+
+def units_page(rows, after=None, before=None, size=DETAIL_PAGE_SIZE):
+    """
+    Function to turn the rows selected by units_page_queryset into a page.
+
+    Returns
+    ----------
+    page: dict
+        'product_set' with the units of the page, newest first, and the cursors of the next and the previous page,
+        None when there is no such page
+    """
+
+    rows = list(rows)
+    more = len(rows) > size
+    rows = rows[:size]
+    if before:
+        rows.reverse()
+    has_next = True if before else more
+    has_previous = more if before else after is not None
+    return {
+        'product_set': rows,
+        'next_cursor': encode_cursor(rows[-1]) if has_next and rows else None,
+        'previous_cursor': encode_cursor(rows[0]) if has_previous and rows else None,
+    }
+
+
+def shop_breakdown_queryset(user, product, ref_weight):
+    """Function to aggregate the units of a product by shop, largest groups first"""
+
+    units = ProdInfo.objects.filter(account=user, **(product if isinstance(product, dict) else {'title': product}))
+    # 'not_full' goes before 'weight' so that its filter refers to the field, not to the Sum alias
+    return (units.values('shop__shop')
+            .annotate(count=Count('pk'), not_full=Count('pk', filter=not_full_condition('weight', ref_weight)),
+                      weight=Sum('weight'), cost=Sum('cost'))
+            .order_by('-count', 'shop__shop'))
+
+
+def unit_totals(summary):
+    """
+    Function to build the totals of a product from its InventorySummary row.
+
+    Returns
+    ----------
+    totals: dict
+        The count of units, the number of units not matching ref_weight, the total and the average weight and cost
+    """
+
+    if summary is None or not summary.count:
+        return {'count': 0, 'not_full': 0, 'weight': 0, 'cost': 0, 'average_weight': 0, 'average_cost': 0}
+    return {
+        'count': summary.count,
+        'not_full': summary.not_full,
+        'weight': summary.weight,
+        'cost': summary.cost,
+        'average_weight': summary.weight / summary.count,
+        'average_cost': summary.cost / summary.count,
+    }
+
+
+def load_product_stats(user, product):
+    """Function to compute the statistics of the units of a product, an empty dict if the user has none"""
+
+    return product_stats(user, [product]).get(product.pk, {})
+
+
+def cached_product_stats(user, product):
+    """Function to get the statistics of the units of a product, see crm.analytics, cached for the user"""
+
+    return cache.get_or_set(user, 'product_stats', lambda: load_product_stats(user, product), product.pk)
+
+
+def mark_outliers(units, stats):
+    """Function to flag the units of a page whose price per gram is an outlier of the product"""
+
+    outliers = set(stats.get('outlier_ids', ()))
+    for unit in units:
+        unit['outlier'] = unit['pk'] in outliers
+    return units
+
+
+def inventory_history(user, product=None, date_from=None, date_to=None):
+    """
+    Function to build the daily history of the inventory of a user from the DailyRollup model only,
+    so its cost depends on the number of days and not on the number of units.
+
+    Parameters
+    ----------
+    user: User
+        Owner of the inventory
+    product: Product, optional
+        Product to restrict the history to
+    date_from, date_to: date, optional
+        First and last day of the history
+
+    Returns
+    ----------
+    days: list
+        Dicts, one per day with added or removed units, with the keys 'day', 'count', 'weight' and 'cost'
+        of the units added on the day, 'removed_count', 'removed_weight' and 'removed_cost' of the units removed
+        on it and 'total_count', 'total_weight' and 'total_cost' of the units in stock at the end of the day
+    """
+
+    rollups = DailyRollup.objects.filter(account=user)
+    if product is not None:
+        rollups = rollups.filter(product=product)
+    totals = {'count': 0, 'weight': 0, 'cost': 0}
+    if date_from:
+        totals = rollups.filter(day__lt=date_from).aggregate(**{
+            field: Coalesce(Sum(F(field) - F('removed_' + field)), 0, output_field=DailyRollup._meta.get_field(field))
+            for field in totals})
+        rollups = rollups.filter(day__gte=date_from)
+    if date_to:
+        rollups = rollups.filter(day__lte=date_to)
 
+    days = list(rollups.values('day').annotate(**{field: Sum(field) for field in ROLLUP_FIELDS}).order_by('day'))
+    for day in days:
+        for field in ('count', 'weight', 'cost'):
+            totals[field] += day[field] - day['removed_' + field]
+            day['total_' + field] = totals[field]
+    return days
@@ -1,10 +1,84 @@
+from django.core.files.base import File
 from django.core.files.storage import FileSystemStorage
+from django.core.files.utils import validate_file_name
 from django.conf import settings
+from django.utils.deconstruct import deconstructible
+import hashlib
 import os
+import tempfile
+
 
 class OverwriteStorage(FileSystemStorage):
+    """Storage replacing a file with the same name. Kept for photos uploaded before ContentAddressedStorage."""
 
     def get_available_name(self, name, max_length=None):
         if self.exists(name):
             os.remove(os.path.join(settings.MEDIA_ROOT, name))
-        return name
\ No newline at end of file
+        return name
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Storage naming files by the SHA-256 hash of their content, as <upload dir>/<2 hash chars>/<hash>.<ext>.
+    Identical files are stored once: if the blob already exists nothing is written. New blobs are written
+    to a temporary file in the target directory and renamed, so a partially written file is never visible.
+    Blobs are never overwritten; the Blob model counts the references to them and the collect_blobs
+    command deletes the ones that are no longer used.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        name = self.hashed_name(name, content)
+        validate_file_name(name, allow_relative_path=True)
+        if not self.exists(name):
+            self.save_exact(name, content)
+        return name
+
+    @staticmethod
+    def hashed_name(name, content):
+        """Function to build the name of a blob from the directory and extension of the name and the content hash"""
+
+        digest = hashlib.sha256()
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk if isinstance(chunk, bytes) else chunk.encode())
+        digest = digest.hexdigest()
+        directory, basename = os.path.split(name)
+        extension = os.path.splitext(basename)[1].lower()
+        return '/'.join(filter(None, (directory.replace('\\', '/'), digest[:2], digest + extension)))
+
+    def save_exact(self, name, content):
+        """Function to atomically write the content under exactly the given name, replacing an existing file"""
+
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        if self.directory_permissions_mode is not None:
+            old_umask = os.umask(0o777 & ~self.directory_permissions_mode)
+            try:
+                os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+        fd, temporary_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    file.write(chunk if isinstance(chunk, bytes) else chunk.encode())
+            # mkstemp creates the file readable by the owner only
+            os.chmod(temporary_path, 0o644 if self.file_permissions_mode is None else self.file_permissions_mode)
+            os.replace(temporary_path, full_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        return name
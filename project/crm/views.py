@@ -1,60 +1,113 @@
+from django.conf import settings
 from django.contrib.auth import logout, login
 from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.auth.views import LoginView
-from django.core.mail import send_mail, BadHeaderError
-from django.shortcuts import render, redirect
-from django.http import HttpResponse, HttpResponseNotFound
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import get_object_or_404, render, redirect
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, Http404, JsonResponse, \
+    StreamingHttpResponse
 from django.template.loader import render_to_string
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_encode
-from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.views.generic import View, ListView, DetailView, CreateView, UpdateView, DeleteView, FormView
 from django.contrib.auth.mixins import LoginRequiredMixin
 
+from . import cache, mail_queue, metrics
+from .exporter import CONTENT_TYPES, ENCODERS, export_queryset
 from .forms import *
+from .importer import import_units
 from .utils1 import *
 
 
 class MainPage(LoginRequiredMixin, ListView):
     """The class displays the main page when the user is logged in. The main page displays cards with
-    information about each unique product from the model. The card also displays information about
+    information about each unique product the user holds. The card also displays information about
     the quantity of goods, the total weight and the number of packs that do not correspond to the field ref_weight of
-    the Product model. """
+    the Product model. Only the products of the current page are loaded, the next cards are loaded by MoreCards
+    when the page is scrolled. """
 
-    paginate_by = 10
-    model = Product
+    paginate_by = CARDS_PAGE_SIZE
+    model = InventorySummary
     template_name = 'crm/cards.html'
-    context_object_name = 'products'
+    context_object_name = 'summary'
     login_url = reverse_lazy('login')
 
     def get_context_data(self, *, object_list=None, **kwargs):
         """A function to load data(context) to display the page. """
 
         context = super().get_context_data(**kwargs)
-        # query_context is a function to load data for cards from Product model and ProdInfo
-        context = query_context(self.request.user, context)  # getting username to filter products by user
+        context['add_dict'] = add_dict
+        # The summary of the current page is loaded and rendered into cards only if they are not cached,
+        # with one more row to find the cursor of the next batch
+        start = (context['page_obj'].number - 1) * CARDS_PAGE_SIZE
+        batch = cached_cards_batch(self.request.user, 'cards_page',
+                                   lambda: self.object_list[start:start + CARDS_PAGE_SIZE + 1],
+                                   context['page_obj'].number)
+        context['cards_html'] = batch['cards_html']
+        context['next_url'] = cards_batch_url(batch['next_cursor'])
         return context
 
     def get_queryset(self):
-        return Product.objects.all().select_related('company')
+        return cards_queryset(self.request.user)
 
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        return CachedCountPaginator(queryset, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page,
+                                    user=self.request.user, name='cards_count', **kwargs)
 
-class Search(ListView):
-    """Implements site search based on Product model."""
 
-    model = Product
-    context_object_name = 'products'
+class MoreCards(LoginRequiredMixin, View):
+    """
+    Returns the batch of cards of the main page after the ?after= cursor, for the infinite scroll:
+    an HTML fragment with the link to the next batch, or the same data as JSON.
+    Only the summary of the batch is loaded; the products are not counted.
+    """
+
+    template_name = 'crm/card_batch.html'
+    login_url = reverse_lazy('login')
+    as_json = False
+
+    def get(self, request):
+        value, after = card_cursor(request)
+        batch = cached_cards_batch(request.user, 'cards_batch', lambda: cards_batch_queryset(request.user, after),
+                                   value)
+        if self.as_json:
+            return JsonResponse({'cards_html': batch['cards_html'], 'next_cursor': batch['next_cursor'],
+                                 'next_url': cards_batch_url(batch['next_cursor'], as_json=True)})
+        return render(request, self.template_name, {'cards_html': batch['cards_html'],
+                                                    'next_url': cards_batch_url(batch['next_cursor'])})
+
+
+class Search(LoginRequiredMixin, ListView):
+    """Implements site search over the products of the user, based on the search index."""
+
+    paginate_by = CARDS_PAGE_SIZE
     template_name = "crm/search_result.html"
+    context_object_name = 'found'
+    login_url = reverse_lazy('login')
 
     def get_queryset(self):
         """
         The function receives the input data in the search field and, based on it,
-        filters the data for display.
+        finds the ids of the user's products ranked by relevance.
         """
-        get_request = self.request.GET.get('q')
+        get_request = self.request.GET.get('q', '').strip()
+        if not get_request:
+            return []
         user = self.request.user
-        context = query_context(user, get_request=get_request)  # getting username to filter products by user
+        return cache.get_or_set(user, 'search', lambda: search_products(user, get_request), get_request)
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['add_dict'] = add_dict
+        context['q'] = self.request.GET.get('q', '')
+        # only the products of the current page are joined with their summary
+        context['cards_html'] = cached_cards_html(self.request.user, 'search_cards',
+                                                  lambda: summary_rows(self.request.user, context['found']),
+                                                  context['q'].strip(), context['page_obj'].number)
         return context
 
 
@@ -91,6 +144,13 @@ class AddProduct(CreateView):
     template_name = 'crm/add/add_product.html'
     success_url = reverse_lazy('home')
 
+    def get_context_data(self, **kwargs):
+        """The product index is embedded in the page, so choosing a company does not need a request"""
+
+        context = super().get_context_data(**kwargs)
+        context['product_index'] = product_index()['companies']
+        return context
+
     def get_form_kwargs(self):
         """Selects the user from the request for further binding of the object to the user"""
         
@@ -101,22 +161,135 @@ class AddProduct(CreateView):
         return kwargs
 
 
+class AddUnits(LoginRequiredMixin, View):
+    """
+    Implements adding many objects of the "ProdInfo" model at once: the product and the shop are chosen once,
+    each row of the formset gives the weight, the cost and the number of identical packs
+    """
+
+    template_name = 'crm/add/add_units.html'
+    login_url = reverse_lazy('login')
+
+    def get_product(self):
+        return None
+
+    def get_success_url(self, product):
+        return reverse('home')
+
+    def render_forms(self, form, formset):
+        product = form.product
+        return render(self.request, self.template_name, {
+            'form': form, 'formset': formset, 'product': product,
+            'product_index': product_index()['companies'] if product is None else None,
+        })
+
+    def get(self, request, **kwargs):
+        return self.render_forms(UnitBatchForm(product=self.get_product()), UnitRowFormSet())
+
+    def post(self, request, **kwargs):
+        form = UnitBatchForm(request.POST, product=self.get_product())
+        formset = UnitRowFormSet(request.POST)
+        if not (form.is_valid() and formset.is_valid()):
+            return self.render_forms(form, formset)
+        product = form.cleaned_data['title']
+        formset.save(request.user, product, form.cleaned_data['shop'])
+        return redirect(self.get_success_url(product))
+
+
+class DetailAddUnits(AddUnits):
+    """Implements adding many objects of the "ProdInfo" model of the product from the Detail page"""
+
+    def get_product(self):
+        return get_object_or_404(Product.objects.select_related('company'), slug=self.kwargs['product_slug'])
+
+    def get_success_url(self, product):
+        return reverse('detail', kwargs={'product_slug': product.slug})
+
+
+class ImportUnits(LoginRequiredMixin, FormView):
+    """Implements the import of "ProdInfo" model objects from a CSV or XLSX file"""
+
+    form_class = ImportUnitsForm
+    template_name = 'crm/add/import_units.html'
+    login_url = reverse_lazy('login')
+
+    def form_valid(self, form):
+        """Imports the file and displays the number of imported rows and the errors of the rest"""
+
+        file = form.cleaned_data['file']
+        result = import_units(self.request.user, file, file.name)
+        return self.render_to_response(self.get_context_data(form=form, result=result))
+
+
+class ExportUnits(LoginRequiredMixin, View):
+    """
+    Streams the "ProdInfo" model objects of the user as CSV or JSON Lines.
+    The rows can be filtered by product, shop and date range with the GET parameters of ExportUnitsForm.
+    """
+
+    login_url = reverse_lazy('login')
+
+    def get(self, request, export_format):
+        if export_format not in ENCODERS:
+            raise Http404
+        form = ExportUnitsForm(request.GET)
+        if not form.is_valid():
+            return HttpResponseBadRequest(form.errors.as_json(), content_type='application/json')
+        rows = export_queryset(request.user, **form.cleaned_data)
+        response = StreamingHttpResponse(ENCODERS[export_format](rows), content_type=CONTENT_TYPES[export_format])
+        response['Content-Disposition'] = 'attachment; filename="inventory.%s"' % export_format
+        return response
+
+
+class InventoryHistory(LoginRequiredMixin, View):
+    """
+    Displays how the inventory of the user evolves day by day, or returns the same data as JSON for charts.
+    The history is read from the DailyRollup model only and can be filtered with the GET parameters of HistoryForm.
+    """
+
+    template_name = 'crm/history.html'
+    login_url = reverse_lazy('login')
+    as_json = False
+
+    def get(self, request):
+        form = HistoryForm(request.GET)
+        if not form.is_valid():
+            if self.as_json:
+                return HttpResponseBadRequest(form.errors.as_json(), content_type='application/json')
+            return render(request, self.template_name, {'form': form, 'days': []})
+        days = inventory_history(request.user, **form.cleaned_data)
+        if self.as_json:
+            return JsonResponse({'days': days})
+        return render(request, self.template_name, {'form': form, 'days': days})
+
+
+def product_index_etag(request):
+    company = request.GET.get('company')
+    etag = product_index()['etag']
+    return '%s-%s' % (etag, company) if company else etag
+
+
+def product_index_modified(request):
+    return product_index()['modified']
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=product_index_etag, last_modified_func=product_index_modified)
 def load_titles(request):
     """
-    Loads data from the 'product' model if the query contains 'company' data,
-    otherwise a dictionary with a message for the user.
+    Returns the products of a company from the cached product index as JSON, or the index of all companies
+    if the query contains no 'company' data. Responses carry ETag and Last-Modified headers,
+    so the browser revalidates its copy and gets a 304 response while the index is unchanged.
 
     Parameters
     ----------
     request: str
         Request containing GET data
     """
+    companies = product_index()['companies']
     if request.GET.get('company'):
-        company_id = request.GET.get('company')
-        titles = Product.objects.filter(company_id=company_id).order_by('title')
-    else:
-        titles = ({'pk': '', 'title': 'Выберите сначала производителя'},)
-    return render(request, 'crm/product_dropdown_list_options.html', {'titles': titles})
+        return JsonResponse({'titles': companies.get(request.GET.get('company'), [])})
+    return JsonResponse({'companies': companies})
 
 
 class Detail(LoginRequiredMixin, DetailView):
@@ -132,10 +305,21 @@ class Detail(LoginRequiredMixin, DetailView):
     raise_exception = True
 
     def get_context_data(self, **kwargs):
+        """
+        Loads a page of the units of the user, newest first, with keyset pagination: the ?after= and ?before=
+        cursors point at the last unit of the previous page or the first unit of the next one.
+        The totals come from the InventorySummary row and the breakdown by shop is aggregated by the database;
+        the statistics of the weights and prices are computed by crm.analytics and cached for the user.
+        """
+
         context = super().get_context_data(**kwargs)
-        product_set = self.object
-        context['product_set'] = (ProdInfo.objects.filter(account=self.request.user, title=product_set)
-                                  .values('pk', 'shop__shop', 'cost', 'weight'))
+        user, product = self.request.user, self.object
+        after, before = detail_cursors(self.request)
+        context.update(units_page(units_page_queryset(user, product, after, before), after, before))
+        context['totals'] = unit_totals(InventorySummary.objects.filter(account=user, product=product).first())
+        context['shops'] = shop_breakdown_queryset(user, product, product.ref_weight)
+        context['stats'] = cached_product_stats(user, product)
+        mark_outliers(context['product_set'], context['stats'])
         return context
 
     def get_queryset(self):
@@ -260,7 +444,10 @@ def logout_user(request):
 
 
 def password_reset_request(request):
-    """Implements password recovery with confirmation sent to the user's email"""
+    """
+    Implements password recovery with confirmation sent to the user's email.
+    The emails are only queued, the send_queued_mail command sends them
+    """
 
     if request.method == "POST":
         password_reset_form = PasswordResetForm(request.POST)
@@ -281,15 +468,20 @@ def password_reset_request(request):
                         'protocol': 'http',
                     }
                     email = render_to_string(email_template_name, c)
-                    try:
-                        send_mail(subject, email, 'admin@example.com', [user.email], fail_silently=False)
-                    except BadHeaderError:
-                        return HttpResponse('Invalid header found.')
-                    return redirect('/password_reset/done/')
+                    mail_queue.enqueue(subject, email, [user.email])
+                return redirect('/password_reset/done/')
     password_reset_form = PasswordResetForm()
     return render(request=request, template_name='crm/password/password_reset.html',
                   context={'password_reset_form': password_reset_form})
 
 
+def metrics_view(request):
+    """Serves the aggregated request metrics in the Prometheus text format to the addresses from the settings"""
+
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'METRICS_ALLOWED_IPS', ()):
+        raise PermissionDenied
+    return HttpResponse(metrics.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 def pageNotFound(request, exception):
     return HttpResponseNotFound('<h1>Страница не найдена</h1>')